@@ -0,0 +1,80 @@
+"""Measures what batching costs a lone request and what it saves a burst.
+
+request/response: a client puts one small message into a FrameQueue, the link takes it out
+with `get` (batching off) or `get_batch` (batching on) and hands it to a peer, which answers
+over a second queue taken out the same way. The round trips are reported as percentiles, with
+batching on they should take no longer than with batching off.
+
+burst: `STREAMS` tasks each queue a small message at the same time, over and over. The
+link reports how many websocket messages it needed for them.
+
+run: python benchmarks/bench_batch.py [round trips]
+"""
+import asyncio
+import sys
+import time
+
+from wsgateway.batch import FrameQueue, DEFAULT_BATCH_MAX_SIZE, DEFAULT_BATCH_DELAY_US
+from wsgateway.messages import iter_msg_batch, pack_msg_data, pack_msg_provider, unpack_msg_provider, CONTROL_STREAM_ID
+
+MESSAGE = pack_msg_provider(1, pack_msg_data(b"x" * 64))
+STREAMS = 32
+BURSTS = 200
+
+def take(queue: FrameQueue, batching: bool):
+    if batching:
+        return queue.get_batch(DEFAULT_BATCH_MAX_SIZE, DEFAULT_BATCH_DELAY_US)
+    return queue.get()
+
+async def request_response(batching: bool, round_trips: int):
+    requests = FrameQueue()
+    responses = FrameQueue()
+
+    async def peer():
+        while True:
+            await take(requests, batching)
+            responses.put_nowait(MESSAGE)
+
+    task = asyncio.ensure_future(peer())
+    latencies = []
+    for _ in range(round_trips):
+        started = time.perf_counter()
+        requests.put_nowait(MESSAGE)
+        await take(responses, batching)
+        latencies.append(time.perf_counter() - started)
+    task.cancel()
+    return sorted(latencies)
+
+async def burst(batching: bool):
+    queue = FrameQueue()
+    sent = 0
+    received = 0
+
+    async def stream():
+        for _ in range(BURSTS):
+            queue.put_nowait(MESSAGE)
+            await asyncio.sleep(0.001)
+
+    tasks = [ asyncio.ensure_future(stream()) for _ in range(STREAMS) ]
+    while received < STREAMS * BURSTS:
+        message = await take(queue, batching)
+        sent += 1
+        client_id, inner = unpack_msg_provider(message)
+        received += sum(1 for _ in iter_msg_batch(inner)) if client_id == CONTROL_STREAM_ID else 1
+    await asyncio.gather(*tasks)
+    return sent
+
+def percentile(values, fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000000
+
+def main():
+    round_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("{:<10} {:>10} {:>10} {:>10} {:>16}".format("batching", "p50 us", "p99 us", "max us", "burst messages"))
+    for batching in (False, True):
+        latencies = asyncio.run(request_response(batching, round_trips))
+        sent = asyncio.run(burst(batching))
+        print("{:<10} {:>10.1f} {:>10.1f} {:>10.1f} {:>16}".format(
+            "on" if batching else "off", percentile(latencies, 0.5), percentile(latencies, 0.99), percentile(latencies, 1.0), sent))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measures the cost of forwarding frames through the gateway relay path.
+
+Both directions are measured:
+- client -> provider: the inner message gets a routing header (`pack_msg_provider_gathered`)
+- provider -> client: the routing header is stripped (`unpack_msg_provider`)
+
+The "copy" variant is the previous implementation, which concatenated and sliced bytes.
+For every variant the throughput and the number of bytes that had to be newly allocated
+per forwarded payload byte are reported.
+
+run: python benchmarks/bench_forwarding.py
+"""
+import struct
+import time
+import tracemalloc
+import os
+
+from wsgateway.messages import pack_msg_data, pack_msg_provider, pack_msg_provider_gathered, unpack_msg_provider
+
+def copy_pack_msg_provider(client_id: int, inner_msg: bytes):
+    return struct.pack("!II", client_id, len(inner_msg)) + inner_msg
+
+def copy_unpack_msg_provider(msg: bytes):
+    client_id, client_msg_len = struct.unpack("!II", msg[:8])
+    return client_id, msg[-client_msg_len:]
+
+def forward_to_provider_copy(msg: bytes):
+    return copy_pack_msg_provider(1, msg)
+
+def forward_to_provider_gathered(msg: bytes):
+    return pack_msg_provider_gathered(1, msg)
+
+def forward_to_client_copy(msg: bytes):
+    return copy_unpack_msg_provider(msg)[1]
+
+def forward_to_client_view(msg: bytes):
+    return unpack_msg_provider(msg)[1]
+
+def measure_copied_bytes(forward, messages, payload_size: int):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    results = [ forward(msg) for msg in messages ]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return (after - before) / (payload_size * len(messages))
+
+def measure_throughput(forward, messages, payload_size: int, rounds: int):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for msg in messages:
+            forward(msg)
+    duration = time.perf_counter() - start
+    return payload_size * len(messages) * rounds / duration / 1e6
+
+def main():
+    print("{:<10} {:<10} {:<10} {:>12} {:>16}".format("direction", "size", "variant", "MB/s", "bytes/fwd byte"))
+    for payload_size in [ 512, 4096, 65536, 1048576 ]:
+        count = max(16, 16 * 1048576 // payload_size)
+        rounds = 4
+        client_msgs = [ pack_msg_data(os.urandom(payload_size)) for _ in range(8) ] * (count // 8)
+        provider_msgs = [ pack_msg_provider(1, msg) for msg in client_msgs ]
+
+        cases = [
+            ("to-prov", "copy", forward_to_provider_copy, client_msgs),
+            ("to-prov", "gathered", forward_to_provider_gathered, client_msgs),
+            ("to-client", "copy", forward_to_client_copy, provider_msgs),
+            ("to-client", "view", forward_to_client_view, provider_msgs),
+        ]
+        for direction, variant, forward, messages in cases:
+            copied = measure_copied_bytes(forward, messages, payload_size)
+            throughput = measure_throughput(forward, messages, payload_size, rounds)
+            print("{:<10} {:<10} {:<10} {:>12.0f} {:>16.3f}".format(direction, payload_size, variant, throughput, copied))
+
+if __name__ == "__main__":
+    main()
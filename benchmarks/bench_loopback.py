@@ -0,0 +1,329 @@
+"""Measures the whole relay path on loopback: client -> gateway -> provider -> echo server.
+
+Starts the real gateway, provider and client (`python -m wsgateway.tools.*`, the same code as
+the `wsgw-*` entry points) with generated configs, in front of an echo server in a separate
+process, and runs these scenarios against the client port:
+- bulk: throughput of a single stream sending `--bulk-size` bytes and reading them back
+- streams: `--streams` concurrent streams each sending `--stream-size` bytes and reading them back
+- latency: round trips of `--message-size` bytes on one stream, as percentiles
+- connect: new connections per second, each with a one byte round trip before closing, and
+  the time from connecting until that byte came back
+
+The results are printed as a single JSON object (or written to `--output`) together with the
+commit and the settings, so runs can be compared from commit to commit. Settings of the tools
+are passed with `--set section.key=value`, e.g. `--set client.multiplex=yes --set batch.enabled=yes`,
+and apply to every tool.
+
+run: python benchmarks/bench_loopback.py [--scenario bulk --scenario latency ...] [--output results.json]
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+SCENARIOS = ("bulk", "streams", "latency", "connect")
+PASSWORD = "benchmark"
+PROVIDER_NAME = "bench"
+READ_SIZE = 65536
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def run_echo_server(port: int):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, "localhost", port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+def write_config(path: str, sections: Dict[str, Dict[str, str]], settings: List[str]):
+    config = configparser.ConfigParser()
+    config.read_dict(sections)
+    for setting in settings:
+        key, value = setting.split("=", 1)
+        section, option = key.split(".", 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][option] = value
+    with open(path, "w") as f:
+        config.write(f)
+
+class Loopback(object):
+    """The tools and the echo server, started on free ports."""
+    directory: str
+    settings: List[str]
+    client_port: int
+    processes: List[subprocess.Popen]
+    echo_process: multiprocessing.Process
+
+    def __init__(self, directory: str, settings: List[str]):
+        self.directory = directory
+        self.settings = settings
+        self.client_port = free_port()
+        self.processes = []
+        self.echo_process = None
+
+    def start_tool(self, name: str, sections: Dict[str, Dict[str, str]]):
+        config_path = os.path.join(self.directory, name + ".ini")
+        write_config(config_path, sections, self.settings)
+        log = open(os.path.join(self.directory, name + ".log"), "w")
+        self.processes.append(subprocess.Popen([ sys.executable, "-m", "wsgateway.tools." + name, "--config", config_path ],
+            stdout=log, stderr=subprocess.STDOUT))
+
+    def start(self):
+        echo_port = free_port()
+        gateway_port = free_port()
+        gateway_url = "ws://localhost:{}/".format(gateway_port)
+
+        self.echo_process = multiprocessing.Process(target=run_echo_server, args=(echo_port,), daemon=True)
+        self.echo_process.start()
+
+        self.start_tool("gateway", {
+            "gateway": { "port": str(gateway_port), "password": PASSWORD },
+        })
+        wait_for_port(gateway_port)
+        self.start_tool("provider", {
+            "provider": { "name": PROVIDER_NAME },
+            "gateway": { "url": gateway_url, "password": PASSWORD },
+        })
+        self.start_tool("client", {
+            "provider": { "name": PROVIDER_NAME, "hostname": "localhost", "port": str(echo_port) },
+            "client": { "port": str(self.client_port) },
+            "gateway": { "url": gateway_url, "password": PASSWORD },
+        })
+        wait_for_port(self.client_port)
+        # the provider is connected to the gateway once a round trip succeeds
+        asyncio.run(wait_for_round_trip(self.client_port))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.echo_process:
+            self.echo_process.terminate()
+            self.echo_process.join()
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("port {} did not open within {}s".format(port, timeout))
+            time.sleep(0.05)
+
+async def round_trip(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes):
+    writer.write(data)
+    await writer.drain()
+    await reader.readexactly(len(data))
+
+async def wait_for_round_trip(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection("localhost", port)
+            try:
+                await asyncio.wait_for(round_trip(reader, writer, b"x"), 1)
+                return
+            finally:
+                writer.close()
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            if time.monotonic() > deadline:
+                raise RuntimeError("no round trip through the client within {}s".format(timeout))
+            await asyncio.sleep(0.1)
+
+async def echo_stream(port: int, size: int, chunk_size: int):
+    """Sends `size` bytes while reading them back, returns once all of them came back."""
+    reader, writer = await asyncio.open_connection("localhost", port)
+    chunk = os.urandom(min(chunk_size, size))
+
+    async def send():
+        remaining = size
+        while remaining > 0:
+            writer.write(chunk[:remaining])
+            remaining -= len(chunk)
+            await writer.drain()
+
+    async def receive():
+        received = 0
+        while received < size:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("stream closed after {} of {} bytes".format(received, size))
+            received += len(data)
+
+    try:
+        await asyncio.gather(send(), receive())
+    finally:
+        writer.close()
+
+async def bench_bulk(port: int, args: argparse.Namespace):
+    started = time.perf_counter()
+    await echo_stream(port, args.bulk_size, args.chunk_size)
+    elapsed = time.perf_counter() - started
+    return {
+        "bytes": args.bulk_size,
+        "seconds": elapsed,
+        "mbytes_per_second": args.bulk_size / elapsed / 1e6,
+    }
+
+async def bench_streams(port: int, args: argparse.Namespace):
+    started = time.perf_counter()
+    await asyncio.gather(*[ echo_stream(port, args.stream_size, args.chunk_size) for _ in range(args.streams) ])
+    elapsed = time.perf_counter() - started
+    return {
+        "streams": args.streams,
+        "bytes_per_stream": args.stream_size,
+        "seconds": elapsed,
+        "streams_per_second": args.streams / elapsed,
+        "mbytes_per_second": args.streams * args.stream_size / elapsed / 1e6,
+    }
+
+def percentile(sorted_values: List[float], fraction: float):
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+async def bench_latency(port: int, args: argparse.Namespace):
+    reader, writer = await asyncio.open_connection("localhost", port)
+    message = os.urandom(args.message_size)
+    latencies = []
+    try:
+        for i in range(args.warmup + args.round_trips):
+            started = time.perf_counter()
+            await round_trip(reader, writer, message)
+            if i >= args.warmup:
+                latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+    latencies.sort()
+    result = { "round_trips": len(latencies), "message_size": args.message_size }
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)):
+        result[name + "_us"] = percentile(latencies, fraction) * 1e6
+    result["max_us"] = latencies[-1] * 1e6
+    result["mean_us"] = sum(latencies) / len(latencies) * 1e6
+    return result
+
+async def bench_connect(port: int, args: argparse.Namespace):
+    setup_times = []
+
+    async def connect_loop(count: int):
+        for _ in range(count):
+            started = time.perf_counter()
+            reader, writer = await asyncio.open_connection("localhost", port)
+            try:
+                await round_trip(reader, writer, b"x")
+                setup_times.append(time.perf_counter() - started)
+            finally:
+                writer.close()
+
+    per_task = max(args.connections // args.connect_concurrency, 1)
+    started = time.perf_counter()
+    await asyncio.gather(*[ connect_loop(per_task) for _ in range(args.connect_concurrency) ])
+    elapsed = time.perf_counter() - started
+    connections = per_task * args.connect_concurrency
+    setup_times.sort()
+    return {
+        "connections": connections,
+        "concurrency": args.connect_concurrency,
+        "seconds": elapsed,
+        "connections_per_second": connections / elapsed,
+        # from connecting until the first byte came back
+        "first_byte_p50_us": percentile(setup_times, 0.5) * 1e6,
+        "first_byte_p99_us": percentile(setup_times, 0.99) * 1e6,
+    }
+
+BENCHMARKS = {
+    "bulk": bench_bulk,
+    "streams": bench_streams,
+    "latency": bench_latency,
+    "connect": bench_connect,
+}
+
+def git_commit():
+    try:
+        return subprocess.run([ "git", "rev-parse", "HEAD" ], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="loopback benchmarks of gateway, provider and client")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="scenarios to run, all by default")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE", help="config setting of every tool")
+    parser.add_argument("--output", help="file to write the results to, stdout by default")
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    parser.add_argument("--bulk-size", type=int, default=200 * 1024 * 1024)
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--stream-size", type=int, default=16384)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--round-trips", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--connect-concurrency", type=int, default=10)
+    args = parser.parse_args()
+    for setting in args.set:
+        if "=" not in setting or "." not in setting.split("=", 1)[0]:
+            parser.error("invalid setting '{}', expected SECTION.KEY=VALUE".format(setting))
+    return args
+
+def main():
+    args = parse_args()
+    scenarios = args.scenario or list(SCENARIOS)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="wsgw-bench-") as directory:
+        loopback = Loopback(directory, args.set)
+        try:
+            loopback.start()
+            for scenario in scenarios:
+                print("running {}...".format(scenario), file=sys.stderr)
+                results[scenario] = asyncio.run(BENCHMARKS[scenario](loopback.client_port, args))
+        finally:
+            loopback.stop()
+
+    report = json.dumps({
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "settings": args.set,
+        "arguments": { name: value for name, value in vars(args).items() if name not in ("scenario", "set", "output") },
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Measures messages/sec through a bidirectional relay between a websocket and a pair of queues.
+
+A websocket server on loopback relays every received message into an outbound queue and sends
+every message of an inbound queue back over the websocket, once with the previous
+ensure_future/asyncio.wait loop and once with `run_relay`.
+
+run: python benchmarks/bench_relay.py [message count]
+"""
+import asyncio
+import sys
+import time
+import websockets
+
+from wsgateway.relay import pump, run_relay
+
+PORT = 18765
+
+async def wait_loop_relay(websocket, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+    while websocket.open:
+        listener_task = asyncio.ensure_future(websocket.recv())
+        producer_task = asyncio.ensure_future(in_queue.get())
+
+        done, pending = await asyncio.wait(
+            [listener_task, producer_task],
+            return_when=asyncio.FIRST_COMPLETED)
+
+        if listener_task in done:
+            await out_queue.put(listener_task.result())
+        else:
+            listener_task.cancel()
+
+        if producer_task in done:
+            await websocket.send(producer_task.result())
+        else:
+            producer_task.cancel()
+
+async def pump_relay(websocket, in_queue: asyncio.Queue, out_queue: asyncio.Queue):
+    await run_relay(
+        pump(websocket.recv, out_queue.put),
+        pump(in_queue.get, websocket.send))
+
+async def measure(relay, count: int):
+    in_queue = asyncio.Queue()
+    out_queue = asyncio.Queue()
+
+    async def handler(websocket, path):
+        try:
+            await relay(websocket, in_queue, out_queue)
+        except websockets.ConnectionClosed:
+            pass
+
+    message = b"x" * 64
+    async with websockets.serve(handler, "localhost", PORT, compression=None):
+        async with websockets.connect("ws://localhost:{}/".format(PORT), compression=None) as websocket:
+            async def send_upstream():
+                for _ in range(count):
+                    await websocket.send(message)
+
+            async def send_downstream():
+                for _ in range(count):
+                    await in_queue.put(message)
+
+            async def receive_upstream():
+                for _ in range(count):
+                    await out_queue.get()
+
+            async def receive_downstream():
+                for _ in range(count):
+                    await websocket.recv()
+
+            start = time.perf_counter()
+            await asyncio.gather(send_upstream(), send_downstream(), receive_upstream(), receive_downstream())
+            duration = time.perf_counter() - start
+
+    return 2 * count / duration
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for name, relay in [ ("wait-loop", wait_loop_relay), ("run_relay", pump_relay) ]:
+        rate = asyncio.run(measure(relay, count))
+        print("{:<10} {:>10.0f} msgs/s".format(name, rate))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measures stream lookups/sec and id allocations/sec of the routing table.
+
+Lookups are compared with the previous routing map, which awaited an `asyncio.Lock` for
+every lookup. Allocation is measured with the table filled to `streams` entries, cycling
+through allocate and remove so the ids wrap around.
+
+run: python benchmarks/bench_routing.py [lookup count] [streams]
+"""
+import asyncio
+import sys
+import time
+
+from wsgateway.routing import RoutingTable
+
+class LockedQueueMap(object):
+    """The lookup path of the previous routing map."""
+    def __init__(self):
+        self.queue_map = {}
+        self.queue_map_lock = asyncio.Lock()
+
+    async def get_queue(self, id: int):
+        async with self.queue_map_lock:
+            return self.queue_map[id] if id in self.queue_map else None
+
+async def measure_locked(count: int, streams: int):
+    queue_map = LockedQueueMap()
+    for stream_id in range(1, streams + 1):
+        queue_map.queue_map[stream_id] = object()
+
+    started = time.perf_counter()
+    for i in range(count):
+        await queue_map.get_queue(i % streams + 1)
+    return count / (time.perf_counter() - started)
+
+def measure_table(count: int, streams: int):
+    table = RoutingTable()
+    for _ in range(streams):
+        table.allocate(object())
+
+    started = time.perf_counter()
+    for i in range(count):
+        table.get(i % streams + 1)
+    return count / (time.perf_counter() - started)
+
+def measure_allocation(count: int, streams: int):
+    # a small id space, so the allocation wraps around and has to skip ids in use
+    table = RoutingTable(max_id=streams * 2)
+    stream_ids = [ table.allocate(object()) for _ in range(streams) ]
+
+    started = time.perf_counter()
+    for i in range(count):
+        table.remove(stream_ids[i % streams])
+        stream_ids[i % streams] = table.allocate(object())
+    return count / (time.perf_counter() - started)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    streams = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    print("locked map lookups:    {:>12,.0f}/s".format(asyncio.run(measure_locked(count, streams))))
+    print("routing table lookups: {:>12,.0f}/s".format(measure_table(count, streams)))
+    print("allocate + remove:     {:>12,.0f}/s".format(measure_allocation(count, streams)))
+
+if __name__ == "__main__":
+    main()
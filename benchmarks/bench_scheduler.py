@@ -0,0 +1,93 @@
+"""Measures the latency of an interactive stream sharing a link with bulk streams.
+
+A sender pushes 64 KiB messages of `BULK_STREAMS` bulk streams into a FrameQueue, keeping
+`BULK_BACKLOG` bytes of each queued like a flow control window would. An interactive stream
+queues a 100 byte message every few milliseconds. The link takes the messages out at
+`LINK_RATE` bytes per second. The time every interactive message waited is reported as
+percentiles, for the FIFO queue and the deficit round-robin scheduler, and the bulk
+throughput with a per stream rate limit.
+
+run: python benchmarks/bench_scheduler.py [seconds]
+"""
+import asyncio
+import os
+import sys
+import time
+
+from wsgateway.batch import FrameQueue
+from wsgateway.messages import pack_msg_data, pack_msg_provider_gathered, frame_len
+from wsgateway.scheduler import StreamScheduler
+
+LINK_RATE = 50 * 1048576
+BULK_STREAMS = 4
+BULK_MESSAGE = pack_msg_data(os.urandom(65536))
+BULK_BACKLOG = 262144
+INTERACTIVE_STREAM = 1000
+INTERACTIVE_MESSAGE = pack_msg_data(os.urandom(100))
+INTERACTIVE_INTERVAL = 0.005
+
+async def run(queue: FrameQueue, seconds: float):
+    latencies = []
+    sent_at = {}
+    bulk_sent = [ 0 ] * BULK_STREAMS
+    bulk_queued = [ 0 ] * BULK_STREAMS
+    bulk_waiters = [ asyncio.Event() for _ in range(BULK_STREAMS) ]
+
+    async def bulk(index: int):
+        while True:
+            while bulk_queued[index] >= BULK_BACKLOG:
+                bulk_waiters[index].clear()
+                await bulk_waiters[index].wait()
+            bulk_queued[index] += len(BULK_MESSAGE)
+            queue.put_nowait(pack_msg_provider_gathered(index + 1, BULK_MESSAGE))
+            await asyncio.sleep(0)
+
+    async def interactive():
+        sequence = 0
+        while True:
+            await asyncio.sleep(INTERACTIVE_INTERVAL)
+            sent_at[sequence] = time.perf_counter()
+            queue.put_nowait(pack_msg_provider_gathered(INTERACTIVE_STREAM, INTERACTIVE_MESSAGE + sequence.to_bytes(4, "big")))
+            sequence += 1
+
+    async def link():
+        while True:
+            frame = await queue.get()
+            size = frame_len(frame)
+            # the time the link takes to send the message
+            await asyncio.sleep(size / LINK_RATE)
+            stream_id = int.from_bytes((frame[0] if isinstance(frame, list) else frame)[:4], "big")
+            if stream_id == INTERACTIVE_STREAM:
+                payload = frame[1] if isinstance(frame, list) else frame[8:]
+                latencies.append(time.perf_counter() - sent_at.pop(int.from_bytes(payload[-4:], "big")))
+            else:
+                bulk_sent[stream_id - 1] += size
+                bulk_queued[stream_id - 1] -= size
+                bulk_waiters[stream_id - 1].set()
+
+    tasks = [ asyncio.ensure_future(bulk(index)) for index in range(BULK_STREAMS) ]
+    tasks += [ asyncio.ensure_future(interactive()), asyncio.ensure_future(link()) ]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return sorted(latencies), sum(bulk_sent) / seconds
+
+def percentile(values, fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float("nan")
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    variants = [
+        ("fifo", lambda: FrameQueue()),
+        ("drr", lambda: FrameQueue(scheduler=StreamScheduler())),
+        ("drr, 2 MiB/s per stream", lambda: FrameQueue(scheduler=StreamScheduler(stream_rate=2097152))),
+    ]
+    print("{:<26} {:>9} {:>9} {:>9} {:>9} {:>12}".format("queue", "p50 ms", "p90 ms", "p99 ms", "max ms", "bulk MiB/s"))
+    for name, create in variants:
+        latencies, bulk_rate = asyncio.run(run(create(), seconds))
+        print("{:<26} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>12.1f}".format(
+            name, percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99), percentile(latencies, 1.0), bulk_rate / 1048576))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Measures the memory of idle streams in the gateway and the provider.
+
+Opens 10k, 50k and 100k streams and leaves them idle, like long-lived websockets or
+keepalive connections behind the tunnel, then reports the resident set size they added
+to the process, the bytes per stream and the tasks left running. Every count is measured
+in a fresh process.
+
+- gateway: streams of a multiplexed client connection, opened with the real message
+  handlers, placed on a provider connection and answered with OPEN_ACK and a window
+- provider: streams opened with the real `handle_client`, whose upstream pool hands out
+  `TCPStream`s without a socket. 100k sockets need more file descriptors and ports than
+  a benchmark can count on, the memory of a socket and its transport is the same for
+  every layout of the stream state
+
+run: python benchmarks/bench_stream_memory.py [gateway|provider] [stream count ...]
+"""
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+
+from wsgateway.flow import DEFAULT_MAX_WINDOW_SIZE, DEFAULT_WINDOW_SIZE
+from wsgateway.messages import pack_msg_open, pack_msg_open_ack, pack_msg_provider, pack_msg_window_update
+from wsgateway.scheduler import DEFAULT_QUANTUM
+from wsgateway.tcp import TCPStream
+from wsgateway.tools import gateway, provider
+
+COUNTS = (10000, 50000, 100000)
+
+def rss():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def drain(queue: asyncio.Queue):
+    while not queue.empty():
+        queue.get_nowait()
+
+async def open_gateway_streams(count: int):
+    gateway.FLOW_MAX_WINDOW = DEFAULT_MAX_WINDOW_SIZE
+    gateway.SCHEDULER_QUANTUM = DEFAULT_QUANTUM
+    provider_connection = gateway.ProviderConnection("bench")
+    gateway.provider_connection_map["bench"] = [ provider_connection ]
+    connection = gateway.MultiplexedClientConnection()
+
+    for stream_id in range(1, count + 1):
+        await gateway.handle_multiplexed_client_message(pack_msg_provider(stream_id, pack_msg_open("localhost", 22)), connection, "bench")
+        client_id = connection.streams[stream_id].client_id
+        await gateway.handle_provider_message(pack_msg_provider(client_id, pack_msg_open_ack()), provider_connection)
+        await gateway.handle_provider_message(pack_msg_provider(client_id, pack_msg_window_update(DEFAULT_WINDOW_SIZE)), provider_connection)
+        drain(provider_connection.queue)
+        drain(connection.send_queue)
+    return connection
+
+class UnconnectedPool(object):
+    async def acquire(self, hostname: str, port: int, unix: bool = False):
+        return TCPStream()
+
+async def open_provider_streams(count: int):
+    provider.FLOW_WINDOW = DEFAULT_WINDOW_SIZE
+    provider.upstream_pool = UnconnectedPool()
+    connection = provider.GatewayConnection()
+
+    for client_id in range(1, count + 1):
+        connection.recv_queues.add(client_id, provider.StreamRelay(connection.send_queue, client_id))
+        await provider.handle_client(connection, client_id, pack_msg_open("localhost", 22))
+        drain(connection.send_queue)
+    return connection
+
+async def measure(side: str, count: int):
+    open_streams = open_gateway_streams if side == "gateway" else open_provider_streams
+    # the first stream allocates everything that is shared
+    await open_streams(1)
+    gc.collect()
+    before = rss()
+    streams = await open_streams(count)
+    for _ in range(10):
+        await asyncio.sleep(0)
+    gc.collect()
+    added = rss() - before
+    tasks = len(asyncio.all_tasks()) - 1
+    print("{} {} {} {}".format(side, count, added, tasks))
+    return streams
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        asyncio.run(measure(sys.argv[2], int(sys.argv[3])))
+        return
+
+    sides = [ arg for arg in sys.argv[1:] if not arg.isdigit() ] or [ "gateway", "provider" ]
+    counts = [ int(arg) for arg in sys.argv[1:] if arg.isdigit() ] or COUNTS
+    print("{:<10} {:>8} {:>10} {:>14} {:>8}".format("side", "streams", "RSS MiB", "bytes/stream", "tasks"))
+    for side in sides:
+        for count in counts:
+            result = subprocess.run([ sys.executable, __file__, "--child", side, str(count) ], stdout=subprocess.PIPE, check=True, text=True)
+            _, _, added, tasks = result.stdout.split()
+            print("{:<10} {:>8} {:>10.1f} {:>14.0f} {:>8}".format(side, count, int(added) / 1048576, int(added) / count, tasks))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Measures the cost per frame of the log calls on the hot path.
+
+Compares the eager `log_outbound("... {}".format(client_id))` calls with the tracer, once
+with tracing disabled (level WARNING) and once enabled (level INFO) with sampling, writing
+through the queue listener to /dev/null.
+
+run: python benchmarks/bench_tracing.py [frame count] [trace sample]
+"""
+import logging
+import os
+import sys
+import time
+
+from wsgateway.log import configure_logging, stop_logging, log_outbound, tracer
+from wsgateway.messages import MSG_TYPE_DATA
+
+def measure_eager(count: int):
+    started = time.perf_counter()
+    for client_id in range(count):
+        log_outbound("sending message to client with id {}".format(client_id))
+    return (time.perf_counter() - started) / count
+
+def measure_tracer(count: int):
+    started = time.perf_counter()
+    for client_id in range(count):
+        if tracer.enabled:
+            tracer.frame("provider->client", client_id, MSG_TYPE_DATA, 1024)
+    return (time.perf_counter() - started) / count
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    sample = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    # the listener writes to stderr, which is silenced for the measurement
+    stderr = os.dup(2)
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+    try:
+        configure_logging(logging.WARNING, trace_sample=sample)
+        eager_disabled = measure_eager(count)
+        tracer_disabled = measure_tracer(count)
+
+        configure_logging(logging.INFO, trace_sample=sample)
+        tracer_enabled = measure_tracer(count)
+        stop_logging()
+    finally:
+        os.dup2(stderr, 2)
+
+    print("eager log call, level WARNING:        {:8.1f} ns/frame".format(eager_disabled * 1e9))
+    print("tracer, level WARNING:                {:8.1f} ns/frame".format(tracer_disabled * 1e9))
+    print("tracer, level INFO, 1 in {:<5}:       {:8.1f} ns/frame".format(sample, tracer_enabled * 1e9))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Measures the size and the encode/decode cost of messages in version 1 and 2 of the wire format.
+
+Encoding is what a multiplexed link does to send an inner message: `pack_msg_provider` for
+version 1, followed by the translation into version 2 on a version 2 link. Decoding is what
+it does with a received message until the stream has its inner message: `unpack_msg_provider`,
+preceded by the translation into version 1 on a version 2 link. Payloads are unpacked as well,
+so the copies of both versions are counted.
+
+run: python benchmarks/bench_wire.py [iterations]
+"""
+import os
+import sys
+import time
+
+from wsgateway.messages import pack_msg_data, pack_msg_open, pack_msg_provider_gathered, pack_msg_window_update, unpack_msg_data, unpack_msg_provider, frame_len, OPEN_FLAG_COMPRESS
+from wsgateway.wire import pack_msg_v2_provider, unpack_msg_v2_provider
+
+STREAM_ID = 42
+
+MESSAGES = [
+    ("data 1 byte (keystroke)", pack_msg_data(b"a")),
+    ("data 64 bytes", pack_msg_data(os.urandom(64))),
+    ("data 1 KiB", pack_msg_data(os.urandom(1024))),
+    ("data 64 KiB", pack_msg_data(os.urandom(65536))),
+    ("window update", pack_msg_window_update(65536)),
+    ("open", pack_msg_open("example.com", 22, OPEN_FLAG_COMPRESS)),
+]
+
+def joined(frame):
+    return b"".join(frame) if isinstance(frame, list) else frame
+
+def measure(function, count: int):
+    started = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - started) / count * 1e9
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print("{:<24} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}".format("message", "v1 size", "v2 size", "v1 enc ns", "v2 enc ns", "v1 dec ns", "v2 dec ns"))
+    for name, msg in MESSAGES:
+        iterations = count if len(msg) < 4096 else count // 20
+        v1 = joined(pack_msg_provider_gathered(STREAM_ID, msg))
+        v2 = joined(pack_msg_v2_provider(pack_msg_provider_gathered(STREAM_ID, msg)))
+
+        def decode_v1(message=v1):
+            _, inner = unpack_msg_provider(message)
+            if inner[0] == 0:
+                unpack_msg_data(inner)
+
+        def decode_v2(message=v2):
+            decode_v1(unpack_msg_v2_provider(message))
+
+        print("{:<24} {:>8} {:>8} {:>10.0f} {:>10.0f} {:>10.0f} {:>10.0f}".format(
+            name, len(v1), frame_len(v2),
+            measure(lambda: pack_msg_provider_gathered(STREAM_ID, msg), iterations),
+            measure(lambda: pack_msg_v2_provider(pack_msg_provider_gathered(STREAM_ID, msg)), iterations),
+            measure(decode_v1, iterations),
+            measure(decode_v2, iterations)))
+
+if __name__ == "__main__":
+    main()
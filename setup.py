@@ -26,6 +26,7 @@ setup(
             "wsgw-gateway=wsgateway.tools.gateway:main",
             "wsgw-provider=wsgateway.tools.provider:main",
             "wsgw-client=wsgateway.tools.client:main",
+            "wsgw-replay=wsgateway.tools.replay:main",
         ]
     }
 )
\ No newline at end of file
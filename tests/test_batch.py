@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+import pytest
+
+from wsgateway.batch import FrameQueue
+from wsgateway.messages import *
+from wsgateway.scheduler import StreamScheduler
+
+def joined(frame):
+    return b"".join(bytes(part) for part in frame) if isinstance(frame, list) else frame
+
+def unpack_batch(batch):
+    client_id, inner = unpack_msg_provider(joined(batch))
+    assert client_id == CONTROL_STREAM_ID and inner[0] == MSG_TYPE_BATCH
+    return [ (stream_id, bytes(msg)) for stream_id, msg in iter_msg_batch(inner) ]
+
+def test_batch_round_trip():
+    messages = [ (1, pack_msg_data(b"a")), (2, pack_msg_window_update(1024)), (3, pack_msg_close()) ]
+    batch = pack_msg_batch([ pack_msg_provider(stream_id, msg) for stream_id, msg in messages ])
+    assert isinstance(batch, bytes)
+    assert unpack_batch(batch) == messages
+
+def test_batch_passes_gathered_messages_on():
+    large = pack_msg_data(os.urandom(65536))
+    messages = [ (1, pack_msg_data(b"a")), (2, large), (3, pack_msg_data(b"b")) ]
+    batch = pack_msg_batch([ pack_msg_provider_gathered(stream_id, msg) for stream_id, msg in messages ])
+    assert isinstance(batch, list)
+    assert any(part is large for part in batch)
+    assert frame_len(batch) == len(joined(batch))
+    assert unpack_batch(batch) == messages
+
+def test_large_batch_is_a_view():
+    messages = [ (stream_id, pack_msg_data(os.urandom(4096))) for stream_id in range(1, 9) ]
+    _, inner = unpack_msg_provider(joined(pack_msg_batch([ pack_msg_provider(stream_id, msg) for stream_id, msg in messages ])))
+    assert isinstance(inner, memoryview)
+    assert [ (stream_id, bytes(msg)) for stream_id, msg in iter_msg_batch(inner) ] == messages
+
+def test_lone_message_is_sent_right_away():
+    async def main():
+        queue = FrameQueue()
+        frame = pack_msg_provider(1, pack_msg_data(b"a"))
+        queue.put_nowait(frame)
+        other_callbacks = []
+        asyncio.get_running_loop().call_soon(other_callbacks.append, True)
+        # taken without letting the event loop run, which would wait for a timer tick
+        assert await queue.get_batch(65536, 100) is frame
+        assert not other_callbacks
+        assert queue.queued_bytes == 0 and not queue.stream_bytes
+    asyncio.run(main())
+
+def test_burst_is_batched():
+    async def main():
+        queue = FrameQueue()
+        frames = [ pack_msg_provider(stream_id, pack_msg_data(b"x" * 64)) for stream_id in range(1, 33) ]
+
+        async def stream(frame):
+            queue.put_nowait(frame)
+
+        tasks = [ asyncio.ensure_future(stream(frame)) for frame in frames ]
+        queue.put_nowait(pack_msg_provider(100, pack_msg_data(b"first")))
+        queue.put_nowait(pack_msg_provider(101, pack_msg_data(b"second")))
+        batch = await queue.get_batch(65536, 100000)
+        await asyncio.gather(*tasks)
+        assert [ stream_id for stream_id, _ in unpack_batch(batch) ] == [ 100, 101 ] + list(range(1, 33))
+        assert queue.empty() and queue.queued_bytes == 0
+    asyncio.run(main())
+
+def test_batch_size_is_limited():
+    async def main():
+        queue = FrameQueue()
+        frames = [ pack_msg_provider(stream_id, pack_msg_data(b"x" * 1000)) for stream_id in range(1, 11) ]
+        for frame in frames:
+            queue.put_nowait(frame)
+        batch = await queue.get_batch(3000, 0)
+        assert [ stream_id for stream_id, _ in unpack_batch(batch) ] == [ 1, 2, 3 ]
+        assert queue.qsize() == 7
+        assert queue.queued_bytes == sum(len(frame) for frame in frames[3:])
+        assert await queue.get_batch(100, 0) is frames[3]
+    asyncio.run(main())
+
+def test_put_back_and_stream_bytes():
+    queue = FrameQueue()
+    first = pack_msg_provider(1, pack_msg_data(b"a"))
+    second = pack_msg_provider(2, pack_msg_data(b"bb"))
+    queue.put_nowait(first)
+    queue.put_nowait(second)
+    assert queue.stream_queued(1) == len(first) and queue.stream_queued(2) == len(second)
+
+    frame = queue.get_nowait()
+    assert frame is first and queue.stream_queued(1) == 0 and 1 not in queue.stream_bytes
+    queue.put_back(frame)
+    assert queue.get_nowait() is first
+    assert queue.get_nowait() is second
+    assert queue.queued_bytes == 0 and not queue.stream_bytes
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+def test_get_waits_for_a_message():
+    async def main():
+        queue = FrameQueue(scheduler=StreamScheduler())
+        frame = pack_msg_provider(1, pack_msg_data(b"a"))
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.put_nowait(frame)
+        assert await asyncio.wait_for(getter, 1) is frame
+    asyncio.run(main())
+
+def test_cancelled_batch_keeps_the_message():
+    async def main():
+        queue = FrameQueue()
+        first = pack_msg_provider(1, pack_msg_data(b"a"))
+        queue.put_nowait(first)
+        queue.put_nowait(pack_msg_provider(2, pack_msg_data(b"b")))
+        getter = asyncio.ensure_future(queue.get_batch(65536, 1000000))
+        await asyncio.sleep(0)
+        getter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await getter
+        assert queue.qsize() == 2 and queue.get_nowait() is first
+    asyncio.run(main())
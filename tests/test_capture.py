@@ -0,0 +1,64 @@
+from wsgateway.capture import *
+from wsgateway.messages import pack_msg_close, pack_msg_data, pack_msg_open, MSG_TYPE_CLOSE, MSG_TYPE_DATA, MSG_TYPE_OPEN
+
+def write_segment(path, frames, payload: bool):
+    writer = CaptureWriter(str(path), payload)
+    for direction, stream_id, msg in frames:
+        writer.frame(direction, stream_id, msg)
+    writer.close()
+
+FRAMES = [
+    (CAPTURE_TO_PROVIDER, 1, pack_msg_open("example.com", 22)),
+    (CAPTURE_TO_PROVIDER, 1, pack_msg_data(b"hello")),
+    (CAPTURE_TO_CLIENT, 1, pack_msg_data(b"x" * 70000)),
+    (CAPTURE_TO_CLIENT, 1, pack_msg_close()),
+]
+
+def test_records_without_payload(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_segment(path, FRAMES, payload=False)
+    records = list(read_capture(path.read_bytes()))
+    assert [ (record.direction, record.stream_id, record.msg_type, record.size) for record in records ] == [
+        (direction, stream_id, msg[0], len(msg)) for direction, stream_id, msg in FRAMES ]
+    assert all(record.payload is None and record.segment == 0 for record in records)
+    assert [ record.time for record in records ] == sorted(record.time for record in records)
+
+def test_records_with_payload(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_segment(path, FRAMES, payload=True)
+    capture = open_capture(str(path))
+    records = list(read_capture(capture))
+    assert [ bytes(record.payload) for record in records ] == [ msg for _, _, msg in FRAMES ]
+    for record in records:
+        record.payload.release()
+    capture.close()
+
+def test_segments(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_segment(path, FRAMES[:2], payload=False)
+    write_segment(path, FRAMES[2:], payload=True)
+    records = list(read_capture(path.read_bytes()))
+    assert [ record.segment for record in records ] == [ 0, 0, 1, 1 ]
+    assert [ record.payload is not None for record in records ] == [ False, False, True, True ]
+    # later segments continue after the earlier ones
+    assert records[2].time >= records[1].time
+
+def test_truncated_payload(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_segment(path, FRAMES, payload=True)
+    data = path.read_bytes()
+    # the gateway stopped while writing the payload of the large message
+    records = list(read_capture(data[:-(len(FRAMES[3][2]) + CAPTURE_RECORD.size + 1000)]))
+    assert [ record.msg_type for record in records ] == [ MSG_TYPE_OPEN, MSG_TYPE_DATA ]
+
+def test_truncated_record(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_segment(path, FRAMES, payload=False)
+    data = path.read_bytes()
+    records = list(read_capture(data[:-3]))
+    assert [ record.msg_type for record in records ] == [ MSG_TYPE_OPEN, MSG_TYPE_DATA, MSG_TYPE_DATA ]
+    assert [ record.msg_type for record in read_capture(data) ][-1] == MSG_TYPE_CLOSE
+
+def test_empty_capture():
+    assert list(read_capture(b"")) == []
+    assert list(read_capture(CAPTURE_MAGIC)) == []
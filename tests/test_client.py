@@ -0,0 +1,143 @@
+import asyncio
+import struct
+
+import pytest
+import websockets
+
+from wsgateway.messages import *
+from wsgateway.proxy import SOCKS_VERSION, SOCKS_AUTH_NONE, SOCKS_CMD_CONNECT, SOCKS_ATYP_IPV4, SOCKS_REPLY_FAILURE
+from wsgateway.tcp import start_tcp_server
+from wsgateway.tools import client
+from wsgateway.utils import TCPStreamEndpoint
+
+class DeadWebsocket(object):
+    """A pooled websocket which was closed by the gateway, the pool didn't notice yet."""
+    open = True
+
+    async def send(self, message: bytes):
+        self.open = False
+        raise websockets.ConnectionClosed(None, None)
+
+class DeadPool(object):
+    async def acquire(self):
+        return DeadWebsocket()
+
+def test_socks_client_is_refused_on_a_dead_websocket(monkeypatch):
+    async def main():
+        monkeypatch.setattr(client, "websocket_pool", DeadPool())
+        handled = asyncio.get_running_loop().create_future()
+
+        async def handle(stream):
+            await client.handle_proxy_client(stream)
+            handled.set_result(stream.is_closing())
+
+        server = await start_tcp_server(handle, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(bytes([ SOCKS_VERSION, 1, SOCKS_AUTH_NONE, SOCKS_VERSION, SOCKS_CMD_CONNECT, 0, SOCKS_ATYP_IPV4, 127, 0, 0, 1 ]) + struct.pack("!H", 22))
+        answer = await asyncio.wait_for(reader.read(), 5)
+        assert answer[2:4] == bytes([ SOCKS_VERSION, SOCKS_REPLY_FAILURE ])
+        assert await handled
+        writer.close()
+        server.close()
+    asyncio.run(main())
+
+def test_prewarm_survives_a_connect_timeout(monkeypatch):
+    async def connect_gateway():
+        raise asyncio.TimeoutError()
+
+    async def main():
+        monkeypatch.setattr(client, "connect_gateway", connect_gateway)
+        pool = client.WebsocketPool(1)
+        pool.connecting = 1
+        await pool.prewarm()
+        assert pool.connecting == 0 and not pool.websockets
+    asyncio.run(main())
+
+async def connected_endpoint():
+    """Returns an endpoint for a client connected to a server, the client's reader and writer."""
+    accepted = asyncio.get_running_loop().create_future()
+
+    async def handle(stream):
+        accepted.set_result(stream)
+
+    server = await start_tcp_server(handle, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+    stream = await asyncio.wait_for(accepted, 1)
+    server.close()
+
+    async def send_message(message: bytes):
+        pass
+
+    return TCPStreamEndpoint(stream, send_message), reader, writer
+
+class Request(object):
+    """A proxy request which records its replies."""
+    protocol = "socks5"
+    hostname = "example.com"
+    port = 22
+
+    def __init__(self):
+        self.replies = []
+
+    def reply(self, stream, failure=None):
+        self.replies.append(failure)
+
+def test_first_open_waits_for_an_answering_provider(monkeypatch):
+    async def main():
+        monkeypatch.setattr(client, "provider_answers_open", False)
+        endpoint, _, writer = await connected_endpoint()
+        writer.write(b"hello")
+        await writer.drain()
+        assert unpack_msg_open_data(await client.pack_open(endpoint)) == b""
+        await endpoint.write_message(pack_msg_open_ack())
+        await asyncio.sleep(0)
+        assert client.provider_answers_open
+        writer.close()
+    asyncio.run(main())
+
+def test_fast_open_sends_the_first_data(monkeypatch):
+    async def main():
+        monkeypatch.setattr(client, "provider_answers_open", True)
+        monkeypatch.setattr(client, "FAST_OPEN_WAIT", 1.0)
+        endpoint, _, writer = await connected_endpoint()
+        writer.write(b"hello")
+        await writer.drain()
+        message = await client.pack_open(endpoint)
+        assert unpack_msg_open_flags(message) & OPEN_FLAG_DATA and unpack_msg_open_data(message) == b"hello"
+        # proxy clients wait for the reply before sending
+        writer.write(b"more")
+        await writer.drain()
+        message = await client.pack_open(endpoint, Request())
+        assert unpack_msg_open(message) == ("example.com", 22) and unpack_msg_open_data_len(message) == 0
+        monkeypatch.setattr(client, "CLIENT_FAST_OPEN", False)
+        assert unpack_msg_open_data_len(await client.pack_open(endpoint)) == 0
+        writer.close()
+    asyncio.run(main())
+
+async def answer(messages):
+    """Runs `answer_proxy_request` with the given provider messages, returns its result and replies."""
+    endpoint, reader, writer = await connected_endpoint()
+    queue = asyncio.Queue()
+    for message in messages:
+        queue.put_nowait(message)
+    request = Request()
+    opened = await client.answer_proxy_request(endpoint, request, queue.get)
+    endpoint.stream.close()
+    received = await asyncio.wait_for(reader.read(), 1)
+    writer.close()
+    return opened, request.replies, received
+
+@pytest.mark.parametrize("answers_open", [ True, False ])
+def test_proxy_request_answers(monkeypatch, answers_open):
+    async def main():
+        monkeypatch.setattr(client, "provider_answers_open", answers_open)
+        monkeypatch.setattr(client, "OPEN_ANSWER_TIMEOUT", 0.01)
+        monkeypatch.setattr(client, "LEGACY_OPEN_WAIT", 0.01)
+        assert await answer([ pack_msg_open_ack(), pack_msg_data(b"banner") ]) == (True, [ None ], b"")
+        assert await answer([ pack_msg_open_fail(OPEN_FAIL_UNREACHABLE, "unreachable") ]) == (False, [ OPEN_FAIL_UNREACHABLE ], b"")
+        # the data of providers which don't answer OPEN comes after the reply
+        assert await answer([ pack_msg_data(b"banner") ]) == (True, [ None ], b"banner")
+        assert (await answer([ pack_msg_close() ]))[:2] == (False, [ OPEN_FAIL_ERROR ])
+        # without any message only legacy providers are assumed to have connected
+        assert await answer([]) == (not answers_open, [ OPEN_FAIL_TIMEOUT if answers_open else None ], b"")
+    asyncio.run(main())
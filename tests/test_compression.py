@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from wsgateway.compression import StreamCompressor, StreamDecompressor, compression_stats, PROBE_SIZE
+from wsgateway.messages import *
+
+def test_frames_share_the_context():
+    compressor = StreamCompressor()
+    decompressor = StreamDecompressor()
+    frames = [ b"GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n" ] * 3
+    compressed = [ compressor.compress(frame) for frame in frames ]
+    # later frames refer to the earlier ones
+    assert len(compressed[1]) < len(compressed[0]) // 2
+    assert [ decompressor.decompress(payload, len(frame)) for payload, frame in zip(compressed, frames) ] == frames
+    assert compressor.raw_bytes == sum(map(len, frames)) and compressor.compressed_bytes == sum(map(len, compressed))
+
+def test_incompressible_streams_are_bypassed():
+    compressor = StreamCompressor()
+    decompressor = StreamDecompressor()
+    bypassed = compression_stats.bypassed_streams
+    chunks = [ os.urandom(16384) for _ in range(PROBE_SIZE // 16384) ]
+    # every probed frame is sent compressed, the last one turns compression off
+    for chunk in chunks:
+        assert decompressor.decompress(compressor.compress(chunk), len(chunk)) == chunk
+    assert not compressor.active and compression_stats.bypassed_streams == bypassed + 1
+    assert compressor.compress(b"more") is None
+
+def test_compressible_streams_stay_compressed():
+    compressor = StreamCompressor()
+    for _ in range(PROBE_SIZE // 1024 + 1):
+        compressor.compress(b"x" * 1024)
+    assert compressor.active
+
+def test_decompressed_length_is_checked():
+    payload = StreamCompressor().compress(b"abcdef")
+    with pytest.raises(ValueError):
+        StreamDecompressor().decompress(payload, 5)
+    with pytest.raises(ValueError):
+        StreamDecompressor().decompress(payload, 7)
+    with pytest.raises(ValueError):
+        StreamDecompressor().decompress(payload, 0)
+
+def test_compressed_data_message():
+    data = b"hello " * 100
+    payload = StreamCompressor().compress(data)
+    msg = pack_msg_data_compressed(len(data), payload)
+    raw_len, compressed = unpack_msg_data_compressed(msg)
+    assert raw_len == len(data) and bytes(compressed) == payload
+    # flow control counts the uncompressed bytes
+    assert unpack_msg_data_len(msg) == len(data)
+    assert StreamDecompressor().decompress(compressed, raw_len) == data
+
+def test_open_offers_compression():
+    assert unpack_msg_open_flags(pack_msg_open("example.com", 443, OPEN_FLAG_COMPRESS)) & OPEN_FLAG_COMPRESS
+    assert not unpack_msg_open_flags(pack_msg_open("example.com", 443)) & OPEN_FLAG_COMPRESS
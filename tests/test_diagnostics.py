@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from wsgateway.diagnostics import Diagnostics, describe_blocking
+from wsgateway.metrics import render_metrics
+
+def test_describe_blocking():
+    async def main():
+        described = asyncio.get_running_loop().create_future()
+
+        def inner():
+            return describe_blocking(sys._getframe())
+
+        def callback():
+            described.set_result(inner())
+
+        asyncio.get_running_loop().call_soon(callback)
+        # the stack ends at the callback the loop runs
+        assert await described == "test_describe_blocking.<locals>.main.<locals>.callback (test_diagnostics.py);test_describe_blocking.<locals>.main.<locals>.inner (test_diagnostics.py)"
+    asyncio.run(main())
+
+def test_slow_callbacks_and_lag(caplog):
+    def block_loop():
+        time.sleep(0.3)
+
+    async def main():
+        diagnostics = Diagnostics("test", lag_interval=0.01, lag_warn=0.1, slow_callback=0.05)
+        await diagnostics.start()
+        await asyncio.sleep(0.1)
+        assert diagnostics.slow_callbacks == 0 and diagnostics.lag.count > 0
+        block_loop()
+        await asyncio.sleep(0.1)
+        assert diagnostics.slow_callbacks == 1 and diagnostics.lag_warnings == 1
+        text = render_metrics(diagnostics.write_metrics).decode()
+        assert "wsgw_slow_callbacks_total 1" in text and 'wsgw_event_loop_lag_seconds_bucket{le="0.1"}' in text
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(main())
+    # the warning names the code which blocked the loop
+    assert "block_loop (test_diagnostics.py)" in caplog.text
+
+def test_no_watchdog_without_slow_callbacks():
+    async def main():
+        diagnostics = Diagnostics("test", lag_interval=0.01, slow_callback=0)
+        await diagnostics.start()
+        time.sleep(0.1)
+        await asyncio.sleep(0.05)
+        assert diagnostics.slow_callbacks == 0 and diagnostics.heartbeat == 0.0
+    asyncio.run(main())
+
+def test_profile_socket(tmp_path):
+    async def main():
+        diagnostics = Diagnostics("test", slow_callback=0, profile_dir=str(tmp_path), profile_socket=str(tmp_path / "profile"))
+        await diagnostics.start()
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / "profile"))
+        writer.write(b"0.05\n")
+        path = (await asyncio.wait_for(reader.readline(), 5)).decode().strip()
+        writer.close()
+        assert os.path.dirname(path) == str(tmp_path) and not diagnostics.profiling
+        with open(path, encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        # one line per stack with its sample count
+        assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+        reader, writer = await asyncio.open_unix_connection(str(tmp_path / "profile"))
+        writer.write(b"soon\n")
+        assert (await asyncio.wait_for(reader.readline(), 5)).startswith(b"error: ")
+        writer.close()
+    asyncio.run(main())
+
+def test_workers_keep_their_own_diagnostics():
+    diagnostics = Diagnostics("gateway", profile_socket="/tmp/wsgw-profile")
+    worker = diagnostics.for_worker(2)
+    assert worker.profile_socket == "/tmp/wsgw-profile.2" and worker.lag is not diagnostics.lag
+    assert Diagnostics("gateway").for_worker(2).profile_socket is None
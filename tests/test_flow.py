@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from wsgateway.flow import SendWindow, ReceiveWindow, StreamFlowPolicer, INITIAL_WINDOW_SIZE, DEFAULT_MAX_WINDOW_SIZE
+from wsgateway.messages import *
+from wsgateway.tools import gateway
+
+def test_send_window_starts_with_the_initial_window():
+    window = SendWindow()
+    window.consume(1000)
+    assert window.credit == INITIAL_WINDOW_SIZE - 1000 and window.limit(65536) == INITIAL_WINDOW_SIZE - 1000
+
+def test_send_window_counts_data_sent_before_the_first_grant():
+    window = SendWindow()
+    window.consume(1000)
+    assert window.grant(4096)
+    assert window.credit == 3096 and window.limit(65536) == 3096
+    assert not window.grant(1000)
+    assert window.credit == 4096
+
+def test_send_window_of_peers_without_flow_control():
+    window = SendWindow()
+    window.consume(INITIAL_WINDOW_SIZE)
+    window.data_received()
+    assert window.credit is None and window.limit(65536) == 65536
+    # data after a grant doesn't change the window
+    window = SendWindow()
+    window.grant(4096)
+    window.data_received()
+    assert window.credit == 4096
+
+def test_send_window_waits_for_credit():
+    async def main():
+        window = SendWindow()
+        window.grant(100)
+        window.consume(100)
+        waiter = asyncio.ensure_future(window.wait())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        window.grant(50)
+        await asyncio.wait_for(waiter, 1)
+        assert window.waiter is None
+    asyncio.run(main())
+
+def test_receive_window_grants_in_batches():
+    window = ReceiveWindow(1000)
+    assert window.consume(300) == 0
+    assert window.consume(300) == 600
+    assert window.consume(499) == 0
+    assert window.consume(1) == 500
+
+def test_policer_allows_unacknowledged_directions():
+    policer = StreamFlowPolicer(max_window=1000)
+    assert policer.check_client_message(pack_msg_open("localhost", 22, data=b"x" * 100))
+    assert policer.check_provider_message(pack_msg_window_update(500))
+    # the client never acknowledged the grant, its direction isn't policed
+    assert policer.check_client_message(pack_msg_data(b"x" * 5000))
+
+def test_policer_detects_exceeded_credit():
+    policer = StreamFlowPolicer(max_window=1000)
+    assert policer.check_client_message(pack_msg_open("localhost", 22, data=b"x" * 100))
+    assert policer.check_provider_message(pack_msg_window_update(500))
+    assert policer.check_client_message(pack_msg_data(b"x" * 100))
+    assert policer.check_client_message(pack_msg_window_ack())
+    # 300 bytes of the window are left after the open data and the first message
+    assert policer.check_client_message(pack_msg_data(b"x" * 300))
+    assert policer.check_provider_message(pack_msg_window_update(200))
+    assert policer.check_client_message(pack_msg_data(b"x" * 200))
+    assert not policer.check_client_message(pack_msg_data(b"x"))
+    assert policer.violated
+
+def test_policer_detects_data_beyond_the_initial_window():
+    policer = StreamFlowPolicer()
+    assert policer.check_client_message(pack_msg_data(b"x" * (INITIAL_WINDOW_SIZE + 1)))
+    assert policer.check_provider_message(pack_msg_window_update(INITIAL_WINDOW_SIZE * 2))
+    assert not policer.check_client_message(pack_msg_window_ack())
+
+def test_policer_detects_oversized_grants():
+    policer = StreamFlowPolicer(max_window=1000)
+    assert policer.check_client_message(pack_msg_window_update(1000))
+    assert not policer.check_client_message(pack_msg_window_update(1001))
+
+def test_policer_directions_are_independent():
+    policer = StreamFlowPolicer(max_window=1000)
+    assert policer.check_client_message(pack_msg_window_update(100))
+    assert policer.check_provider_message(pack_msg_window_ack())
+    assert policer.check_client_message(pack_msg_data(b"x" * 500))
+    assert policer.check_provider_message(pack_msg_data(b"x" * 100))
+    assert not policer.check_provider_message(pack_msg_data(b"x"))
+
+@pytest.mark.parametrize("window", [ 16384, INITIAL_WINDOW_SIZE, 262144 ])
+def test_compliant_sender_stays_within_the_queue_limit(window, monkeypatch):
+    monkeypatch.setattr(gateway, "FLOW_MAX_QUEUED", max(window, INITIAL_WINDOW_SIZE) * 2)
+    sender = SendWindow()
+    receiver = ReceiveWindow(window)
+    policer = StreamFlowPolicer(max_window=window)
+    # the messages held by the gateway on their way to the provider
+    queued = []
+
+    def send():
+        while sender.credit > 0:
+            msg = pack_msg_data(b"x" * sender.limit(3000))
+            sender.consume(unpack_msg_data_len(msg))
+            assert policer.check_client_message(msg)
+            frame = pack_msg_provider(1, msg)
+            assert not gateway.exceeds_queue_limit(sum(map(len, queued)), frame)
+            queued.append(frame)
+
+    def grant(increment: int):
+        assert policer.check_provider_message(pack_msg_window_update(increment))
+        if sender.grant(increment):
+            assert policer.check_client_message(pack_msg_window_ack())
+
+    # the provider is still connecting to the target
+    send()
+    grant(receiver.size)
+    for _ in range(200):
+        send()
+        # the target is slow, the provider writes one message at a time
+        _, msg = unpack_msg_provider(queued.pop(0))
+        increment = receiver.consume(unpack_msg_data_len(msg))
+        if increment:
+            grant(increment)
+    assert not policer.violated
+
+def test_queue_limit_defaults():
+    # the limits hold before the settings of the config are applied
+    assert not gateway.exceeds_queue_limit(0, pack_msg_provider(1, pack_msg_data(b"x" * 65536)))
+    assert gateway.FLOW_MAX_WINDOW == DEFAULT_MAX_WINDOW_SIZE
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from wsgateway.messages import *
+from wsgateway.tools import gateway
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Returns a function connecting `count` connections of the provider "p"."""
+    monkeypatch.setattr(gateway, "SCHEDULER_ENABLED", False)
+    monkeypatch.setattr(gateway, "provider_connection_map", {})
+    monkeypatch.setattr(gateway, "provider_stats", {})
+
+    def connect(count: int):
+        connected = [ gateway.ProviderConnection("p") for _ in range(count) ]
+        gateway.provider_connection_map["p"] = connected
+        return connected
+    return connect
+
+def place(client_id: int, provider_name: str = "p"):
+    client_queue = gateway.ClientQueue()
+    return gateway.place_stream(client_id, provider_name, client_queue), client_queue
+
+def test_streams_are_spread_over_the_connections(connections):
+    async def main():
+        first, second = connections(2)
+        placed = [ await place(client_id)[0] for client_id in range(1, 5) ]
+        assert placed == [ first, second, first, second ]
+        assert len(first.client_queues) == 2 and first.stats.streams_total == 4
+    asyncio.run(main())
+
+def test_placed_streams_stay_on_their_connection(connections):
+    async def main():
+        first, second = connections(2)
+        placement, client_queue = place(1)
+        assert await placement is first and client_queue.provider is first
+        await gateway.send_to_provider(pack_msg_provider(1, pack_msg_data(b"a")), 1, "p", client_queue)
+        await gateway.send_to_provider(pack_msg_provider(1, pack_msg_data(b"b")), 1, "p", client_queue)
+        assert first.queue.qsize() == 2 and second.queue.qsize() == 0
+        gateway.unpin_stream(1, client_queue)
+        assert not first.client_queues
+    asyncio.run(main())
+
+def test_least_bytes_placement(connections, monkeypatch):
+    async def main():
+        monkeypatch.setattr(gateway, "PLACEMENT", "least-bytes")
+        first, second = connections(2)
+        await first.put(pack_msg_provider(100, pack_msg_data(b"x" * 1000)))
+        assert [ await place(client_id)[0] for client_id in range(1, 4) ] == [ second ] * 3
+    asyncio.run(main())
+
+def test_detached_connections_get_streams_last(connections):
+    async def main():
+        first, second = connections(2)
+        first.gap_timer = asyncio.get_running_loop().call_later(3600, lambda: None)
+        assert [ await place(client_id)[0] for client_id in range(1, 4) ] == [ second ] * 3
+        connections(1)[0].gap_timer = first.gap_timer
+        # the only connection of a provider gets the stream, which waits for the provider to resume
+        assert await place(4)[0] is gateway.provider_connection_map["p"][0]
+        first.gap_timer.cancel()
+    asyncio.run(main())
+
+def test_unknown_provider(connections):
+    async def main():
+        placement, client_queue = place(1, "unknown")
+        assert await placement is None and client_queue.provider is None
+    asyncio.run(main())
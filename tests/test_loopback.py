@@ -0,0 +1,96 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from wsgateway.wire import PROTOCOL_V1, PROTOCOL_V2
+
+PASSWORD = "loopback"
+STARTUP_TIMEOUT = 20.0
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def write_config(path, text: str):
+    path.write_text(text)
+    return str(path)
+
+def start_tool(tool: str, config: str, log):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get("PYTHONPATH", "") ]))
+    return subprocess.Popen([ sys.executable, "-m", "wsgateway.tools." + tool, "--config", config ], stdout=log, stderr=subprocess.STDOUT, env=env)
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+async def round_trip(port: int, payload: bytes):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(payload)
+        await writer.drain()
+        return await asyncio.wait_for(reader.readexactly(len(payload)), 10)
+    finally:
+        writer.close()
+
+async def run_streams(client_port: int, payloads):
+    # the provider may not be connected yet when the client is
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            assert await round_trip(client_port, b"ping") == b"ping"
+            break
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+    return await asyncio.gather(*[ round_trip(client_port, payload) for payload in payloads ])
+
+def run_loopback(tmp_path, version: int, multiplex: bool, gateway_settings: str = ""):
+    """Sends payloads through a gateway, a provider and a client to an echo server, returns
+    the sent and the echoed payloads."""
+    gateway_port = free_port()
+    client_port = free_port()
+    payloads = [ os.urandom(size) for size in (1, 100, 16384, 300000) ] * 3
+
+    async def main():
+        server = await asyncio.start_server(echo, "127.0.0.1", 0)
+        echo_port = server.sockets[0].getsockname()[1]
+        gateway_config = write_config(tmp_path / "gateway.ini", "[gateway]\nport = {}\npassword = {}\nprotocol = {}\n{}".format(gateway_port, PASSWORD, version, gateway_settings))
+        provider_config = write_config(tmp_path / "provider.ini", "[provider]\nname = loopback\n[gateway]\nurl = ws://127.0.0.1:{}/\npassword = {}\nprotocol = {}\n".format(gateway_port, PASSWORD, version))
+        client_config = write_config(tmp_path / "client.ini", "[provider]\nname = loopback\nhostname = 127.0.0.1\nport = {}\n[client]\nport = {}\nmultiplex = {}\n[gateway]\nurl = ws://127.0.0.1:{}/\npassword = {}\nprotocol = {}\n".format(
+            echo_port, client_port, "yes" if multiplex else "no", gateway_port, PASSWORD, version))
+
+        with open(tmp_path / "tools.log", "wb") as log:
+            tools = [ start_tool("gateway", gateway_config, log) ]
+            await asyncio.sleep(0.5)
+            tools += [ start_tool("provider", provider_config, log), start_tool("client", client_config, log) ]
+            try:
+                return await run_streams(client_port, payloads)
+            finally:
+                for tool in tools:
+                    tool.terminate()
+                for tool in tools:
+                    tool.wait(10)
+                server.close()
+
+    return payloads, asyncio.run(main())
+
+@pytest.mark.parametrize("multiplex", [ False, True ], ids=[ "websocket per stream", "multiplexed" ])
+@pytest.mark.parametrize("version", [ PROTOCOL_V1, PROTOCOL_V2 ], ids=[ "v1", "v2" ])
+def test_round_trip(tmp_path, version: int, multiplex: bool):
+    payloads, echoed = run_loopback(tmp_path, version, multiplex)
+    assert echoed == payloads
+
+@pytest.mark.parametrize("multiplex", [ False, True ], ids=[ "websocket per stream", "multiplexed" ])
+def test_round_trip_over_workers(tmp_path, multiplex: bool):
+    # the provider is connected to one of the workers, streams accepted by the others cross over to it
+    payloads, echoed = run_loopback(tmp_path, PROTOCOL_V1, multiplex, "workers = 3\n")
+    assert echoed == payloads
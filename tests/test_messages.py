@@ -0,0 +1,27 @@
+import pytest
+
+from wsgateway.messages import *
+
+@pytest.mark.parametrize("connection_type", [ OPEN_TYPE_TCP, OPEN_TYPE_UDP, OPEN_TYPE_UNIX ])
+def test_open(connection_type):
+    msg = pack_msg_open("example.com", 443, OPEN_FLAG_COMPRESS, connection_type=connection_type)
+    assert unpack_msg_open(msg) == ("example.com", 443)
+    assert unpack_msg_open_flags(msg) == OPEN_FLAG_COMPRESS
+    assert unpack_msg_open_type(msg) == connection_type
+    assert unpack_msg_open_data(msg) == b"" and unpack_msg_open_data_len(msg) == 0
+
+def test_open_with_first_data():
+    msg = pack_msg_open("exämple.com", 80, data=b"GET / HTTP/1.1\r\n\r\n")
+    assert unpack_msg_open(msg) == ("exämple.com", 80)
+    assert unpack_msg_open_flags(msg) == OPEN_FLAG_DATA
+    assert unpack_msg_open_data(msg) == b"GET / HTTP/1.1\r\n\r\n"
+    assert unpack_msg_open_data_len(msg) == 18
+    # the data flag follows the data, whatever the caller passes
+    assert not unpack_msg_open_flags(pack_msg_open("example.com", 80, OPEN_FLAG_DATA)) & OPEN_FLAG_DATA
+
+def test_open_answers():
+    assert pack_msg_open_ack()[0] == MSG_TYPE_OPEN_ACK
+    msg = pack_msg_open_fail(OPEN_FAIL_UNREACHABLE, "example.com:80: unreachable")
+    assert msg[0] == MSG_TYPE_OPEN_FAIL
+    assert unpack_msg_open_fail(msg) == (OPEN_FAIL_UNREACHABLE, "example.com:80: unreachable")
+    assert unpack_msg_open_fail(pack_msg_open_fail(OPEN_FAIL_ERROR)) == (OPEN_FAIL_ERROR, "")
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from wsgateway.metrics import Histogram, MetricsWriter, TimedQueue, TrafficCounter, render_metrics, serve_metrics, CONTENT_TYPE
+from wsgateway.tools import gateway, provider
+from wsgateway.upstream import DNSCache, UpstreamPool
+
+def test_histogram():
+    histogram = Histogram((0.1, 1.0))
+    assert histogram.quantile(0.5) is None
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    # the bounds are inclusive like the le label
+    assert histogram.counts == [ 2, 1, 1 ]
+    assert histogram.count == 4 and histogram.sum == pytest.approx(2.65)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(1.0) == float("inf")
+
+def test_traffic_counter():
+    counter = TrafficCounter()
+    counter.add(10)
+    counter.add(5)
+    assert (counter.frames, counter.bytes) == (2, 15)
+
+def test_timed_queue():
+    async def main():
+        histogram = Histogram()
+        queue = TimedQueue(histogram)
+        queue.put_nowait("a")
+        queue.put_nowait("b")
+        assert queue.get_nowait() == "a" and histogram.count == 1
+        untimed = TimedQueue()
+        untimed.put_nowait("a")
+        assert await untimed.get() == "a" and untimed.put_times is None
+    asyncio.run(main())
+
+def collect(writer: MetricsWriter):
+    writer.metric("wsgw_streams", "gauge", "Open streams.")
+    writer.sample("wsgw_streams", 3)
+    writer.sample("wsgw_streams", 1, provider='a "quoted" \\ name')
+    histogram = Histogram((0.1, 1.0))
+    histogram.observe(0.5)
+    writer.metric("wsgw_wait_seconds", "histogram", "Wait.")
+    writer.histogram("wsgw_wait_seconds", histogram, queue="client")
+
+EXPECTED = b"""# HELP wsgw_streams Open streams.
+# TYPE wsgw_streams gauge
+wsgw_streams 3
+wsgw_streams{provider="a \\"quoted\\" \\\\ name"} 1
+# HELP wsgw_wait_seconds Wait.
+# TYPE wsgw_wait_seconds histogram
+wsgw_wait_seconds_bucket{queue="client",le="0.1"} 0
+wsgw_wait_seconds_bucket{queue="client",le="1.0"} 1
+wsgw_wait_seconds_bucket{queue="client",le="+Inf"} 1
+wsgw_wait_seconds_sum{queue="client"} 0.5
+wsgw_wait_seconds_count{queue="client"} 1
+"""
+
+def test_render_metrics():
+    assert render_metrics(collect) == EXPECTED
+
+def test_tool_metrics(monkeypatch):
+    async def main():
+        monkeypatch.setattr(gateway, "SCHEDULER_ENABLED", False)
+        monkeypatch.setattr(gateway, "provider_connection_map", {})
+        monkeypatch.setattr(gateway, "provider_stats", {})
+        monkeypatch.setattr(provider, "upstream_pool", UpstreamPool(DNSCache()))
+        connection = gateway.ProviderConnection("p")
+        gateway.provider_connection_map["p"] = [ connection ]
+        await connection.put(b"x" * 10)
+        text = render_metrics(gateway.collect_metrics).decode()
+        assert 'wsgw_provider_connections{provider="p"} 1' in text
+        assert "wsgw_streams" in render_metrics(provider.collect_metrics).decode()
+        # every sample belongs to a declared metric
+        declared = { line.split()[2] for line in text.splitlines() if line.startswith("# TYPE") }
+        for line in text.splitlines():
+            if not line.startswith("#"):
+                name = line.split("{")[0].split()[0]
+                assert name in declared or name.rsplit("_", 1)[0] in declared, line
+    asyncio.run(main())
+
+def test_serve_metrics():
+    async def request(port: int, path: str):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode())
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return response
+
+    async def main():
+        server = await serve_metrics(collect, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        response = await request(port, "/metrics")
+        head, body = response.split(b"\r\n\r\n", 1)
+        assert head.startswith(b"HTTP/1.1 200 OK") and CONTENT_TYPE.encode() in head
+        assert body == EXPECTED
+        assert (await request(port, "/other")).startswith(b"HTTP/1.1 404")
+        server.close()
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from wsgateway.peer import PeerLink, open_peer_link, peer_socket_path
+
+async def start_peer(path: str):
+    """Starts a server at `path`, returns it and a future resolved with the link it accepted."""
+    accepted = asyncio.get_running_loop().create_future()
+
+    async def handle(reader, writer):
+        accepted.set_result(PeerLink(reader, writer))
+
+    return await asyncio.start_unix_server(handle, path), accepted
+
+def test_frames_round_trip(tmp_path):
+    async def main():
+        path = peer_socket_path(str(tmp_path), 1)
+        server, accepted = await start_peer(path)
+        link = await open_peer_link(path)
+        peer = await asyncio.wait_for(accepted, 1)
+
+        await link.send(b"first")
+        await link.send([ b"gathered ", memoryview(b"frame") ])
+        await link.send(b"")
+        assert await peer.recv() == b"first"
+        assert await peer.recv() == b"gathered frame"
+        assert await peer.recv() == b""
+
+        await peer.send(b"answer")
+        assert await link.recv() == b"answer"
+
+        assert link.open
+        await link.close()
+        assert not link.open
+        with pytest.raises(asyncio.IncompleteReadError):
+            await peer.recv()
+        server.close()
+    asyncio.run(main())
+
+def test_connecting_waits_for_the_peer(tmp_path):
+    async def main():
+        path = peer_socket_path(str(tmp_path), 2)
+        connecting = asyncio.ensure_future(open_peer_link(path, retry_interval=0.01))
+        await asyncio.sleep(0.05)
+        assert not connecting.done()
+        server, _ = await start_peer(path)
+        link = await asyncio.wait_for(connecting, 1)
+        assert link.open
+        await link.close()
+        server.close()
+    asyncio.run(main())
+
+def test_connecting_gives_up(tmp_path):
+    async def main():
+        with pytest.raises(FileNotFoundError):
+            await open_peer_link(peer_socket_path(str(tmp_path), 3), retry_interval=0.001, retries=3)
+    asyncio.run(main())
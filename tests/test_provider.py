@@ -0,0 +1,84 @@
+import asyncio
+
+from wsgateway.messages import *
+from wsgateway.tcp import open_tcp_stream
+from wsgateway.tools import provider
+from wsgateway.upstream import DNSCache, UpstreamPool
+from wsgateway.utils import StreamRelay
+
+class SlowPool(object):
+    """Connects once `connect` is resolved."""
+    def __init__(self):
+        self.connect = asyncio.get_running_loop().create_future()
+
+    async def acquire(self, hostname: str, port: int, unix: bool):
+        await self.connect
+        return await open_tcp_stream(hostname, port)
+
+def queued_messages(connection: provider.GatewayConnection):
+    messages = []
+    while not connection.send_queue.empty():
+        messages.append(connection.send_queue.get_nowait())
+    return messages
+
+def test_stream_connecting_while_the_gateway_connection_closes(monkeypatch):
+    async def main():
+        closed_by_provider = asyncio.get_running_loop().create_future()
+
+        async def target(reader, writer):
+            closed_by_provider.set_result(await reader.read() == b"")
+            writer.close()
+
+        server = await asyncio.start_server(target, "127.0.0.1", 0)
+        pool = SlowPool()
+        monkeypatch.setattr(provider, "SCHEDULER_ENABLED", False)
+        monkeypatch.setattr(provider, "upstream_pool", pool)
+        connection = provider.GatewayConnection()
+        relay = StreamRelay(connection.send_queue, 1)
+        relay.on_close = connection.remove_stream
+        connection.recv_queues.add(1, relay)
+        opener = asyncio.ensure_future(provider.handle_client(connection, 1, pack_msg_open("127.0.0.1", server.sockets[0].getsockname()[1])))
+        await asyncio.sleep(0)
+
+        connection.close_streams()
+        pool.connect.set_result(None)
+        await asyncio.wait_for(opener, 1)
+        assert await asyncio.wait_for(closed_by_provider, 1)
+        assert relay.closing and not relay.started and 1 not in connection.recv_queues
+        # the stream is not answered on the dead connection
+        assert queued_messages(connection) == [ pack_msg_provider(1, pack_msg_close()) ]
+        server.close()
+    asyncio.run(main())
+
+def test_streams_to_unix_sockets(monkeypatch, tmp_path):
+    async def main():
+        received = asyncio.get_running_loop().create_future()
+
+        async def target(reader, writer):
+            received.set_result(await reader.read())
+            writer.close()
+
+        path = str(tmp_path / "target.sock")
+        server = await asyncio.start_unix_server(target, path)
+        monkeypatch.setattr(provider, "SCHEDULER_ENABLED", False)
+        monkeypatch.setattr(provider, "upstream_pool", UpstreamPool(DNSCache()))
+        monkeypatch.setattr(provider, "UNIX_PATHS", { path })
+        connection = provider.GatewayConnection()
+        for client_id, hostname in ((1, path), (2, str(tmp_path / "other.sock")), (3, str(tmp_path / ".." / tmp_path.name / "target.sock"))):
+            relay = StreamRelay(connection.send_queue, client_id)
+            relay.on_close = connection.remove_stream
+            connection.recv_queues.add(client_id, relay)
+            await provider.handle_client(connection, client_id, pack_msg_open(hostname, 0, data=b"hello" if client_id == 1 else b"", connection_type=OPEN_TYPE_UNIX))
+
+        messages = [ unpack_msg_provider(message) for message in queued_messages(connection) ]
+        assert (1, pack_msg_open_ack()) in messages and (3, pack_msg_open_ack()) in messages
+        # only the configured sockets can be reached
+        fail = next(message for client_id, message in messages if client_id == 2)
+        assert unpack_msg_open_fail(fail)[0] == OPEN_FAIL_REFUSED and 2 not in connection.recv_queues
+        assert (2, pack_msg_close()) in messages
+
+        connection.recv_queues.get(1).put_nowait(pack_msg_close())
+        assert await asyncio.wait_for(received, 1) == b"hello"
+        connection.close_streams()
+        server.close()
+    asyncio.run(main())
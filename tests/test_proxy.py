@@ -0,0 +1,110 @@
+import asyncio
+import struct
+
+import pytest
+
+from wsgateway.messages import OPEN_FAIL_ERROR, OPEN_FAIL_REFUSED, OPEN_FAIL_TIMEOUT
+from wsgateway.proxy import *
+from wsgateway.tcp import start_tcp_server
+
+def handshake(request: bytes, failure=None):
+    """Sends `request` to a server accepting a proxy request, returns the request or the
+    error it accepted and everything the server wrote."""
+    async def main():
+        accepted = asyncio.get_running_loop().create_future()
+
+        async def handle(stream):
+            try:
+                proxy_request = await accept_proxy_request(stream)
+                proxy_request.reply(stream, failure)
+                accepted.set_result(proxy_request)
+            except (ProxyError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                accepted.set_result(e)
+            stream.close()
+
+        server = await start_tcp_server(handle, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(request)
+        writer.write_eof()
+        answer = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        server.close()
+        return await accepted, answer
+    return asyncio.run(main())
+
+def socks_connect(address_type: int, address: bytes, port: int, command: int = SOCKS_CMD_CONNECT):
+    return bytes([ SOCKS_VERSION, 1, SOCKS_AUTH_NONE, SOCKS_VERSION, command, 0, address_type ]) + address + struct.pack("!H", port)
+
+def socks_reply(code: int):
+    return struct.pack("!BBBBIH", SOCKS_VERSION, code, 0, SOCKS_ATYP_IPV4, 0, 0)
+
+@pytest.mark.parametrize("address_type, address, hostname", [
+    (SOCKS_ATYP_IPV4, bytes([ 10, 0, 0, 1 ]), "10.0.0.1"),
+    (SOCKS_ATYP_IPV6, bytes(15) + b"\x01", "::1"),
+    (SOCKS_ATYP_DOMAIN, b"\x0bexample.com", "example.com"),
+])
+def test_socks5(address_type, address, hostname):
+    request, answer = handshake(socks_connect(address_type, address, 8080))
+    assert (request.protocol, request.hostname, request.port) == ("socks5", hostname, 8080)
+    assert answer == bytes([ SOCKS_VERSION, SOCKS_AUTH_NONE ]) + socks_reply(SOCKS_REPLY_SUCCEEDED)
+
+@pytest.mark.parametrize("failure, code", [
+    (OPEN_FAIL_REFUSED, SOCKS_REPLY_CONNECTION_REFUSED),
+    (OPEN_FAIL_TIMEOUT, SOCKS_REPLY_TTL_EXPIRED),
+    (OPEN_FAIL_ERROR, SOCKS_REPLY_FAILURE),
+])
+def test_socks5_failure_replies(failure, code):
+    _, answer = handshake(socks_connect(SOCKS_ATYP_IPV4, bytes(4), 22), failure)
+    assert answer.endswith(socks_reply(code))
+
+def test_socks5_without_acceptable_method():
+    error, answer = handshake(bytes([ SOCKS_VERSION, 1, 0x02 ]))
+    assert isinstance(error, ProxyError)
+    assert answer == bytes([ SOCKS_VERSION, SOCKS_AUTH_UNACCEPTABLE ])
+
+def test_socks5_unsupported_command():
+    error, answer = handshake(socks_connect(SOCKS_ATYP_IPV4, bytes(4), 22, command=0x02))
+    assert isinstance(error, ProxyError)
+    assert answer.endswith(socks_reply(SOCKS_REPLY_COMMAND_NOT_SUPPORTED))
+
+def test_socks5_unsupported_address_type():
+    error, answer = handshake(socks_connect(0x05, b"", 22))
+    assert isinstance(error, ProxyError)
+    assert answer.endswith(socks_reply(SOCKS_REPLY_ADDRESS_TYPE_NOT_SUPPORTED))
+
+def test_socks5_truncated_request():
+    error, _ = handshake(socks_connect(SOCKS_ATYP_DOMAIN, b"\x0bexample", 22)[:-4])
+    assert isinstance(error, asyncio.IncompleteReadError)
+
+@pytest.mark.parametrize("target, hostname, port", [
+    ("example.com:443", "example.com", 443),
+    ("10.0.0.1:22", "10.0.0.1", 22),
+    ("[::1]:8080", "::1", 8080),
+])
+def test_http_connect(target, hostname, port):
+    request, answer = handshake("CONNECT {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(target, target).encode())
+    assert (request.protocol, request.hostname, request.port) == ("http", hostname, port)
+    assert answer == HTTP_REPLY_SUCCEEDED
+
+@pytest.mark.parametrize("failure, reply", [
+    (OPEN_FAIL_TIMEOUT, HTTP_REPLIES[OPEN_FAIL_TIMEOUT]),
+    (OPEN_FAIL_REFUSED, HTTP_REPLY_FAILURE),
+])
+def test_http_connect_failure_replies(failure, reply):
+    _, answer = handshake(b"CONNECT example.com:443 HTTP/1.1\r\n\r\n", failure)
+    assert answer == reply
+
+def test_http_method_not_allowed():
+    error, answer = handshake(b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    assert isinstance(error, ProxyError)
+    assert answer.startswith(b"HTTP/1.1 405")
+
+@pytest.mark.parametrize("target", [ "example.com", "example.com:http", "example.com:0", "example.com:65536", ":443" ])
+def test_http_invalid_target(target):
+    error, answer = handshake("CONNECT {} HTTP/1.1\r\n\r\n".format(target).encode())
+    assert isinstance(error, ProxyError)
+    assert answer.startswith(b"HTTP/1.1 400")
+
+def test_http_header_too_large():
+    error, _ = handshake(b"CONNECT example.com:443 HTTP/1.1\r\n" + b"X: " + b"x" * HTTP_MAX_HEADER_SIZE + b"\r\n\r\n")
+    assert isinstance(error, asyncio.LimitOverrunError)
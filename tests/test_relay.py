@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from wsgateway.relay import gathered, pump, run_relay
+
+def source_of(messages):
+    messages = list(messages)
+
+    async def source():
+        return messages.pop(0) if messages else None
+    return source
+
+def test_pump_stops_at_the_end_of_the_source():
+    async def main():
+        received = []
+
+        async def sink(message):
+            received.append(message)
+
+        await pump(source_of([ 1, 2, 3 ]), sink)
+        assert received == [ 1, 2, 3 ]
+    asyncio.run(main())
+
+def test_pump_stops_when_the_sink_returns_false():
+    async def main():
+        received = []
+
+        async def sink(message):
+            received.append(message)
+            return message != 2
+
+        source = source_of([ 1, 2, 3 ])
+        await pump(source, sink)
+        assert received == [ 1, 2 ]
+        assert await source() == 3
+    asyncio.run(main())
+
+def test_gathered_takes_what_arrived_together():
+    async def main():
+        queue = asyncio.Queue()
+        for message in range(5):
+            queue.put_nowait(message)
+        source = gathered(queue, max_messages=3)
+        assert await source() == [ 0, 1, 2 ]
+        assert await source() == [ 3, 4 ]
+        waiting = asyncio.ensure_future(source())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        queue.put_nowait(5)
+        assert await waiting == [ 5 ]
+    asyncio.run(main())
+
+def test_relay_cancels_the_other_pumps():
+    async def main():
+        other_cancelled = asyncio.get_running_loop().create_future()
+
+        async def forever():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                other_cancelled.set_result(True)
+                raise
+
+        async def sink(message):
+            pass
+
+        await asyncio.wait_for(run_relay(pump(source_of([ 1 ]), sink), forever()), 1)
+        assert other_cancelled.done()
+    asyncio.run(main())
+
+def test_relay_raises_the_error_of_the_first_pump():
+    async def main():
+        async def failing():
+            raise ConnectionResetError("reset")
+
+        with pytest.raises(ConnectionResetError):
+            await asyncio.wait_for(run_relay(failing(), asyncio.sleep(3600)), 1)
+    asyncio.run(main())
+
+def test_cancelling_the_relay_cancels_its_pumps():
+    async def main():
+        tasks = []
+
+        async def forever():
+            tasks.append(asyncio.current_task())
+            await asyncio.sleep(3600)
+
+        relay = asyncio.ensure_future(run_relay(forever(), forever()))
+        await asyncio.sleep(0.01)
+        relay.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await relay
+        assert len(tasks) == 2 and all(task.cancelled() for task in tasks)
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+import pytest
+
+from wsgateway.routing import RoutingTable
+
+def test_allocate_in_order():
+    table = RoutingTable()
+    assert [ table.allocate(name) for name in "abc" ] == [ 1, 2, 3 ]
+    assert len(table) == 3
+    assert table.get(2) == "b" and 2 in table
+    assert table.get(4) is None and 4 not in table
+
+def test_freed_ids_are_reused_after_a_round():
+    table = RoutingTable(max_id=4)
+    for name in "abcd":
+        table.allocate(name)
+    assert table.remove(2) == "b"
+    assert table.remove(2) is None
+    # the round wraps around to the only free id
+    assert table.allocate("e") == 2
+
+    table.remove(1)
+    table.remove(3)
+    assert table.allocate("f") == 3
+    assert table.allocate("g") == 1
+
+def test_allocate_skips_added_ids():
+    table = RoutingTable()
+    table.add(1, "added")
+    table.add(3, "added")
+    assert table.allocate("a") == 2
+    assert table.allocate("b") == 4
+
+def test_full_table():
+    table = RoutingTable(max_id=2)
+    table.allocate("a")
+    table.allocate("b")
+    with pytest.raises(OverflowError):
+        table.allocate("c")
+    table.clear()
+    assert len(table) == 0 and list(table.values()) == []
+    # ids never include the control stream
+    assert table.allocate("d") in (1, 2)
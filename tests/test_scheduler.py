@@ -0,0 +1,103 @@
+import pytest
+
+from wsgateway.messages import *
+from wsgateway.scheduler import StreamScheduler, TokenBucket
+
+def data(stream_id: int, size: int):
+    return pack_msg_provider(stream_id, pack_msg_data(b"x" * size))
+
+def drain(scheduler: StreamScheduler):
+    frames = []
+    while scheduler.delay() == 0:
+        frames.append(scheduler.pop()[0])
+    return frames
+
+def stream_ids(frames):
+    return [ unpack_msg_provider(frame)[0] for frame in frames ]
+
+def test_token_bucket():
+    bucket = TokenBucket(1000, min_burst=500)
+    now = bucket.updated
+    assert bucket.burst == 500
+    assert bucket.delay(now) == 0
+    # a message larger than the tokens left is sent and leaves the bucket in debt
+    bucket.take(700)
+    assert bucket.delay(now) == pytest.approx(0.2)
+    assert bucket.delay(now + 0.1) == pytest.approx(0.1)
+    assert bucket.delay(now + 0.3) == 0
+    # tokens don't grow above the burst
+    assert bucket.delay(now + 10) == 0 and bucket.tokens == bucket.burst
+
+def test_empty_scheduler():
+    scheduler = StreamScheduler()
+    assert scheduler.delay() is None and len(scheduler) == 0
+
+def test_fifo_within_a_stream():
+    scheduler = StreamScheduler(quantum=100)
+    frames = [ data(1, size) for size in (10, 20, 30, 40) ]
+    for frame in frames:
+        scheduler.push(frame)
+    assert list(scheduler) == frames
+    assert drain(scheduler) == frames
+    assert not scheduler.lanes and not scheduler.active
+
+def test_small_messages_are_not_delayed_by_large_ones():
+    scheduler = StreamScheduler(quantum=1000)
+    for _ in range(5):
+        scheduler.push(data(1, 4000))
+    for _ in range(5):
+        scheduler.push(data(2, 10))
+    # stream 2 takes the next turn as it had nothing queued, stream 1 needs several rounds per message
+    order = stream_ids(drain(scheduler))
+    assert order.index(1) > order.index(2)
+    assert order[-1] == 1
+
+def test_streams_share_the_link():
+    scheduler = StreamScheduler(quantum=100)
+    for stream_id in (1, 2, 3):
+        for _ in range(3):
+            scheduler.push(data(stream_id, 91))
+    # every message fills a quantum, the streams take turns
+    assert stream_ids(drain(scheduler)) == [ 3, 2, 1 ] * 3
+
+def test_priority_messages_skip_the_round():
+    scheduler = StreamScheduler(quantum=100)
+    for _ in range(3):
+        scheduler.push(data(1, 50))
+    window_update = pack_msg_provider(1, pack_msg_window_update(1024))
+    control = pack_msg_provider(CONTROL_STREAM_ID, pack_msg_hello(0))
+    scheduler.push(window_update)
+    scheduler.push(control)
+    frames = drain(scheduler)
+    assert frames[:2] == [ window_update, control ]
+    assert len(frames) == 5
+
+def test_push_front():
+    scheduler = StreamScheduler(quantum=100)
+    first = data(1, 10)
+    scheduler.push(data(1, 20))
+    scheduler.push(first, front=True)
+    assert drain(scheduler)[0] is first
+
+def test_stream_rate():
+    scheduler = StreamScheduler(quantum=100, stream_rate=1000)
+    for _ in range(3):
+        scheduler.push(data(1, 80))
+    scheduler.push(data(2, 10))
+    frames = drain(scheduler)
+    # the burst of stream 1 is its quantum, the rest waits for tokens
+    assert stream_ids(frames) == [ 2, 1, 1 ]
+    assert 0 < scheduler.delay() <= 0.1
+    assert len(scheduler) == 1
+
+def test_link_bucket():
+    bucket = TokenBucket(1000, min_burst=100)
+    scheduler = StreamScheduler(quantum=1000, link_bucket=bucket)
+    for stream_id in (1, 2):
+        scheduler.push(data(stream_id, 150))
+    control = pack_msg_provider(CONTROL_STREAM_ID, pack_msg_hello(0))
+    scheduler.push(control)
+    frames = drain(scheduler)
+    # the control message is counted but not held back
+    assert frames[0] is control and len(frames) == 2
+    assert scheduler.delay() > 0
@@ -0,0 +1,62 @@
+from wsgateway.messages import *
+from wsgateway.session import LinkSession, ACK_INTERVAL_BYTES, ACK_INTERVAL_MESSAGES, is_session_message
+
+def frames(count: int, size: int = 10):
+    return [ pack_msg_provider(stream_id, pack_msg_data(b"x" * size)) for stream_id in range(1, count + 1) ]
+
+def test_session_messages():
+    assert is_session_message(pack_msg_provider(1, pack_msg_close()))
+    assert is_session_message(pack_msg_provider_gathered(1, pack_msg_data(b"x" * 65536)))
+    assert is_session_message(pack_msg_batch([ pack_msg_provider(1, pack_msg_close()) ]))
+    assert not is_session_message(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_session_ack(3)))
+
+def test_replay_after_reconnect():
+    session = LinkSession()
+    sent = frames(5)
+    for frame in sent:
+        session.sent(frame)
+    # the peer received the first two messages
+    assert session.replay_after(2) == sent[2:]
+    assert session.replay_after(5) == []
+    # messages acknowledged by replaying are gone
+    assert session.replay_after(1) is None
+
+def test_acknowledged_messages_are_dropped():
+    session = LinkSession()
+    sent = frames(4)
+    for frame in sent:
+        session.sent(frame)
+    session.acknowledged(3)
+    assert list(session.replay) == sent[3:]
+    assert session.replay_bytes == len(sent[3])
+    # acknowledging again changes nothing
+    session.acknowledged(2)
+    assert list(session.replay) == sent[3:]
+
+def test_replay_buffer_is_limited():
+    sent = frames(10, 90)
+    session = LinkSession(max_replay_bytes=len(sent[0]) * 3)
+    for frame in sent:
+        session.sent(frame)
+    assert list(session.replay) == sent[7:]
+    assert session.replay_bytes == sum(len(frame) for frame in sent[7:])
+    assert session.replay_after(7) == sent[7:]
+    # the peer missed messages which were dropped
+    assert session.replay_after(6) is None
+    # the peer can't have received more than was sent
+    assert session.replay_after(11) is None
+
+def test_replay_disabled():
+    session = LinkSession(max_replay_bytes=0)
+    for frame in frames(3):
+        session.sent(frame)
+    assert session.sent_count == 3 and not session.replay
+    assert session.replay_after(3) == []
+    assert session.replay_after(2) is None
+
+def test_acks_are_due():
+    session = LinkSession()
+    due = [ session.received(10) for _ in range(ACK_INTERVAL_MESSAGES * 2) ]
+    assert due.count(True) == 2 and due[ACK_INTERVAL_MESSAGES - 1]
+    assert session.received(ACK_INTERVAL_BYTES)
+    assert session.received_count == ACK_INTERVAL_MESSAGES * 2 + 1
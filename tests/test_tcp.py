@@ -0,0 +1,203 @@
+import asyncio
+
+import pytest
+
+from wsgateway import tcp
+from wsgateway.tcp import TCPStream, open_unix_stream, remove_stale_socket, start_tcp_server, start_unix_server, unix_address_path
+
+async def connected_stream(**kwargs):
+    """Returns a `TCPStream` accepted by a server and the writer of the connecting end."""
+    accepted = asyncio.get_running_loop().create_future()
+
+    async def handle(stream):
+        accepted.set_result(stream)
+
+    server = await start_tcp_server(handle, "127.0.0.1", 0, **kwargs)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+    stream = await asyncio.wait_for(accepted, 1)
+    server.close()
+    return stream, reader, writer
+
+async def wait_pending(stream: TCPStream, size: int):
+    while len(stream.pending) < size and not stream.eof:
+        await stream.wait_readable()
+        await asyncio.sleep(0.001)
+
+def test_reads_coalesce_what_arrived():
+    async def main():
+        stream, _, writer = await connected_stream()
+        for chunk in (b"a", b"bc", b"def"):
+            writer.write(chunk)
+            await writer.drain()
+        await wait_pending(stream, 6)
+        assert await stream.read() == b"abcdef"
+        writer.close()
+        assert await stream.read() is None
+        assert stream.read_nowait() is None
+    asyncio.run(main())
+
+def test_read_respects_max_size():
+    async def main():
+        stream, _, writer = await connected_stream(max_read_size=4096)
+        writer.write(b"x" * 10000)
+        await wait_pending(stream, 10000)
+        assert len(await stream.read()) == 4096
+        assert len(await stream.read(1000)) == 1000
+        assert stream.read_nowait(100000) == b"x" * 4904
+        assert stream.read_nowait() == b""
+        writer.close()
+    asyncio.run(main())
+
+def test_read_exactly():
+    async def main():
+        stream, _, writer = await connected_stream()
+        writer.write(b"\x05\x01")
+        assert await stream.read_exactly(1) == b"\x05"
+        reading = asyncio.ensure_future(stream.read_exactly(4))
+        await asyncio.sleep(0.01)
+        assert not reading.done()
+        writer.write(b"ab")
+        await writer.drain()
+        writer.write_eof()
+        with pytest.raises(asyncio.IncompleteReadError):
+            await asyncio.wait_for(reading, 1)
+        writer.close()
+    asyncio.run(main())
+
+def test_read_size_grows_and_shrinks():
+    async def main():
+        stream, _, writer = await connected_stream(max_read_size=65536)
+        assert stream.read_size == tcp.DEFAULT_MIN_READ_SIZE
+        stream.get_buffer(-1)
+        stream.buffer_updated(stream.read_size)
+        assert stream.read_size == tcp.DEFAULT_MIN_READ_SIZE * 2
+        stream.get_buffer(-1)
+        stream.buffer_updated(10)
+        assert stream.read_size == tcp.DEFAULT_MIN_READ_SIZE
+        # an idle stream holds no read buffer
+        assert stream.read_buffer is None
+        writer.close()
+    asyncio.run(main())
+
+def test_read_buffers_are_reused():
+    async def main():
+        stream, _, writer = await connected_stream()
+        buffer = stream.get_buffer(-1)
+        stream.buffer_updated(1)
+        assert stream.get_buffer(-1) is buffer
+        stream.buffer_updated(1)
+        assert len(stream.read_nowait()) == 2
+        writer.close()
+    asyncio.run(main())
+
+def test_reading_pauses_above_the_high_water_mark():
+    async def main():
+        stream, _, writer = await connected_stream(max_read_size=4096, high_water=8192)
+        writer.write(b"x" * 65536)
+        await wait_pending(stream, 8193)
+        await asyncio.sleep(0.05)
+        assert stream.reading_paused
+        # reading stops right above the high-water mark
+        assert len(stream.pending) <= 8192 + 4096
+        received = 0
+        while received < 65536:
+            received += len(await stream.read())
+        assert not stream.reading_paused
+        writer.close()
+    asyncio.run(main())
+
+def test_on_readable():
+    async def main():
+        stream, _, writer = await connected_stream()
+        calls = []
+        stream.on_readable = lambda: calls.append(len(stream.pending))
+        writer.write(b"abc")
+        await wait_pending(stream, 3)
+        writer.close()
+        while not stream.eof:
+            await asyncio.sleep(0.001)
+        assert calls[0] == 3 and len(calls) >= 2
+    asyncio.run(main())
+
+def test_write_and_close():
+    async def main():
+        stream, reader, writer = await connected_stream()
+        stream.write(b"abcde")
+        await stream.drain()
+        stream.close()
+        await asyncio.wait_for(stream.wait_closed(), 1)
+        assert stream.is_closing()
+        assert await reader.read() == b"abcde"
+        writer.close()
+    asyncio.run(main())
+
+def test_writelines_gathers_the_chunks():
+    async def main():
+        stream, reader, writer = await connected_stream()
+        stream.writelines([ b"ab", memoryview(b"xcdx")[1:3], bytearray(b"ef") ])
+        assert not stream.needs_drain()
+        stream.close()
+        assert await asyncio.wait_for(reader.read(), 1) == b"abcdef"
+        writer.close()
+    asyncio.run(main())
+
+def test_drain_is_needed_above_the_write_high_water_mark():
+    async def main():
+        stream, reader, writer = await connected_stream(write_high_water=65536)
+        stream.write(b"x" * 1000)
+        assert not stream.needs_drain()
+        # the peer doesn't read, the socket buffers fill up
+        chunk = b"x" * 1048576
+        while not stream.needs_drain():
+            stream.writelines([ chunk ] * 4)
+            await asyncio.sleep(0)
+        draining = asyncio.ensure_future(stream.drain())
+        await asyncio.sleep(0.01)
+        assert not draining.done()
+        while not draining.done():
+            await reader.read(1048576)
+        assert not stream.needs_drain()
+        writer.close()
+        while not stream.lost:
+            stream.write(b"x")
+            await asyncio.sleep(0.01)
+        assert stream.needs_drain()
+        with pytest.raises(ConnectionResetError):
+            await stream.drain()
+    asyncio.run(main())
+
+def test_unix_address_path():
+    assert unix_address_path("unix:/run/wsgw.sock") == "/run/wsgw.sock"
+    assert unix_address_path("127.0.0.1") is None
+    assert unix_address_path("8080") is None
+
+def test_unix_streams(tmp_path):
+    async def main():
+        path = str(tmp_path / "wsgw.sock")
+        accepted = asyncio.get_running_loop().create_future()
+
+        async def handle(stream):
+            accepted.set_result(stream)
+
+        # a socket left behind by an earlier process is replaced
+        left_behind = await start_unix_server(handle, path)
+        left_behind.close()
+        await left_behind.wait_closed()
+        server = await start_unix_server(handle, path)
+        stream = await open_unix_stream(path, max_read_size=4096)
+        assert stream.max_read_size == 4096
+        peer = await asyncio.wait_for(accepted, 1)
+        stream.write(b"abc")
+        await wait_pending(peer, 3)
+        assert await peer.read() == b"abc"
+        stream.close()
+        assert await peer.read() is None
+        server.close()
+    asyncio.run(main())
+
+def test_only_sockets_are_removed(tmp_path):
+    path = tmp_path / "wsgw.sock"
+    remove_stale_socket(str(path))
+    path.write_text("not a socket")
+    remove_stale_socket(str(path))
+    assert path.exists()
@@ -0,0 +1,101 @@
+import asyncio
+
+from wsgateway import udp
+from wsgateway.batch import FrameQueue
+from wsgateway.messages import *
+from wsgateway.tools import provider
+from wsgateway.udp import DatagramFlow, expire_flows, MAX_PENDING_DATAGRAMS
+from wsgateway.upstream import DNSCache, UpstreamPool
+
+def queued_messages(queue: FrameQueue):
+    messages = []
+    while not queue.empty():
+        messages.append(unpack_msg_provider(queue.get_nowait()))
+    return messages
+
+def test_datagrams_wait_for_the_socket():
+    async def main():
+        flow = DatagramFlow(FrameQueue(), 3)
+        for i in range(MAX_PENDING_DATAGRAMS + 2):
+            flow.put_nowait(pack_msg_data(bytes([ i ])))
+        assert len(flow.pending) == MAX_PENDING_DATAGRAMS and flow.dropped == 2
+        sent = []
+        flow.attach(sent.append)
+        assert sent == [ bytes([ i ]) for i in range(MAX_PENDING_DATAGRAMS) ] and flow.pending is None
+        # once attached datagrams are sent right away
+        flow.put_nowait(pack_msg_data(b"next"))
+        assert sent[-1] == b"next"
+    asyncio.run(main())
+
+def test_datagrams_to_the_peer(monkeypatch):
+    async def main():
+        monkeypatch.setattr(udp, "MAX_QUEUED_BYTES", 100)
+        queue = FrameQueue()
+        flow = DatagramFlow(queue, 3)
+        flow.datagram_received(b"x" * 100)
+        flow.datagram_received(b"dropped while the queue is full")
+        assert flow.dropped == 1
+        assert [ (stream_id, bytes(unpack_msg_data(msg))) for stream_id, msg in queued_messages(queue) ] == [ (3, b"x" * 100) ]
+    asyncio.run(main())
+
+def test_close():
+    async def main():
+        queue = FrameQueue()
+        closed = []
+        flow = DatagramFlow(queue, 3)
+        flow.on_close = closed.append
+        flow.put_nowait(pack_msg_open_fail(OPEN_FAIL_UNREACHABLE, "unreachable"))
+        assert not flow.closed
+        flow.put_nowait(pack_msg_close())
+        assert flow.closed and closed == [ flow ]
+        # the peer closed the flow, it isn't told
+        assert queue.empty()
+        flow.put_nowait(pack_msg_data(b"late"))
+        flow.datagram_received(b"late")
+        assert flow.pending is None and queue.empty()
+
+        flow = DatagramFlow(queue, 4)
+        flow.close()
+        flow.close()
+        assert [ (stream_id, bytes(msg)) for stream_id, msg in queued_messages(queue) ] == [ (4, pack_msg_close()) ]
+    asyncio.run(main())
+
+def test_idle_flows_expire():
+    async def main():
+        queue = FrameQueue()
+        idle, active = DatagramFlow(queue, 1), DatagramFlow(queue, 2)
+        idle.last_active -= 1.0
+        expiry = asyncio.ensure_future(expire_flows(lambda: [ idle, active ], 0.5))
+        await asyncio.sleep(0.3)
+        expiry.cancel()
+        assert idle.closed and not active.closed
+    asyncio.run(main())
+
+def test_provider_relays_datagrams(monkeypatch):
+    async def main():
+        class Echo(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                self.transport.sendto(data.upper(), addr)
+
+        loop = asyncio.get_running_loop()
+        target, _ = await loop.create_datagram_endpoint(Echo, local_addr=("127.0.0.1", 0))
+        monkeypatch.setattr(provider, "SCHEDULER_ENABLED", False)
+        monkeypatch.setattr(provider, "upstream_pool", UpstreamPool(DNSCache()))
+        monkeypatch.setattr(provider, "udp_flows", set())
+        connection = provider.GatewayConnection()
+        flow = DatagramFlow(connection.send_queue, 5)
+        connection.recv_queues.add(5, flow)
+        provider.udp_flows.add(flow)
+        # sent before the socket is open
+        flow.put_nowait(pack_msg_data(b"ping"))
+        await provider.handle_udp_client(connection, flow, pack_msg_open("127.0.0.1", target.get_extra_info("sockname")[1], connection_type=OPEN_TYPE_UDP))
+        assert (await connection.send_queue.get()) == pack_msg_provider(5, pack_msg_open_ack())
+        assert unpack_msg_data(unpack_msg_provider(await asyncio.wait_for(connection.send_queue.get(), 1))[1]) == b"PING"
+
+        flow.put_nowait(pack_msg_close())
+        assert not provider.udp_flows and 5 not in connection.recv_queues
+        target.close()
+    asyncio.run(main())
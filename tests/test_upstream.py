@@ -0,0 +1,138 @@
+import asyncio
+import socket
+
+import pytest
+
+from wsgateway.upstream import DNSCache, UpstreamPool, connect_resolved
+
+def counting_resolver(loop: asyncio.AbstractEventLoop, delay: float = 0.0, error: Exception = None):
+    """Replaces the `getaddrinfo` of `loop`, returns the list of resolved hostnames."""
+    lookups = []
+
+    async def getaddrinfo(host, port, **kwargs):
+        lookups.append(host)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return [ (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port)) ]
+
+    loop.getaddrinfo = getaddrinfo
+    return lookups
+
+def test_dns_cache():
+    async def main():
+        lookups = counting_resolver(asyncio.get_running_loop())
+        dns = DNSCache(ttl=60)
+        first = await dns.resolve("example.com", 80)
+        assert await dns.resolve("example.com", 80) == first
+        await dns.resolve("example.com", 443)
+        assert lookups == [ "example.com" ] * 2 and (dns.hits, dns.misses) == (1, 2)
+        # expired entries are resolved again
+        dns.entries[("example.com", 80)] = (0.0, first)
+        await dns.resolve("example.com", 80)
+        assert len(lookups) == 3
+        dns.expire()
+        assert len(dns.entries) == 2
+    asyncio.run(main())
+
+def test_concurrent_lookups_are_shared():
+    async def main():
+        lookups = counting_resolver(asyncio.get_running_loop(), delay=0.01)
+        dns = DNSCache(ttl=0)
+        results = await asyncio.gather(*[ dns.resolve("example.com", 80) for _ in range(5) ])
+        assert lookups == [ "example.com" ] and all(result == results[0] for result in results)
+        # without a ttl nothing is kept
+        assert not dns.entries and not dns.pending
+    asyncio.run(main())
+
+def test_failed_lookups_are_not_cached():
+    async def main():
+        lookups = counting_resolver(asyncio.get_running_loop(), error=socket.gaierror("unknown"))
+        dns = DNSCache()
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                await dns.resolve("unknown.invalid", 80)
+        assert len(lookups) == 2 and not dns.entries
+    asyncio.run(main())
+
+async def start_target():
+    """Starts a server, returns it, its port and the list of accepted connections."""
+    accepted = []
+
+    async def handle(reader, writer):
+        accepted.append(writer)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], accepted
+
+def test_connect_resolved_tries_every_address():
+    async def main():
+        server, port, _ = await start_target()
+        with socket.socket() as closed:
+            closed.bind(("127.0.0.1", 0))
+            closed_port = closed.getsockname()[1]
+            addresses = [ (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", closed_port)), (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port)) ]
+            stream = await connect_resolved(addresses)
+            assert stream.transport.get_extra_info("peername")[1] == port
+            stream.close()
+            with pytest.raises(ConnectionRefusedError):
+                await connect_resolved(addresses[:1])
+        server.close()
+    asyncio.run(main())
+
+def test_pool_keeps_connections_ready():
+    async def main():
+        server, port, _ = await start_target()
+        pool = UpstreamPool(DNSCache(), size=2)
+        first = await pool.acquire("127.0.0.1", port)
+        assert (pool.hits, pool.misses) == (0, 1)
+        while pool.idle_connections() < 2:
+            await asyncio.sleep(0.01)
+        second = await pool.acquire("127.0.0.1", port)
+        assert second is not first and (pool.hits, pool.misses) == (1, 1)
+        pool.close()
+        await asyncio.sleep(0)
+        assert pool.idle_connections() == 0 and pool.sweeper.cancelled()
+        first.close()
+        second.close()
+        server.close()
+    asyncio.run(main())
+
+def test_pool_skips_connections_closed_by_the_target():
+    async def main():
+        server, port, accepted = await start_target()
+        pool = UpstreamPool(DNSCache(), size=1)
+        (await pool.acquire("127.0.0.1", port)).close()
+        while pool.idle_connections() < 1 or len(accepted) < 2:
+            await asyncio.sleep(0.01)
+        idle = pool.targets[("127.0.0.1", port, False)].streams[0]
+        accepted[1].close()
+        while not idle.eof:
+            await asyncio.sleep(0.01)
+        stream = await pool.acquire("127.0.0.1", port)
+        assert stream is not idle and idle.is_closing() and pool.misses == 2
+        stream.close()
+        pool.close()
+        server.close()
+    asyncio.run(main())
+
+def test_idle_targets_are_dropped():
+    async def main():
+        server, port, _ = await start_target()
+        pool = UpstreamPool(DNSCache(), size=1, idle_timeout=0.05)
+        (await pool.acquire("127.0.0.1", port)).close()
+        await asyncio.wait_for(pool.sweeper, 1)
+        assert not pool.targets
+        server.close()
+    asyncio.run(main())
+
+def test_pool_without_size_connects_on_demand():
+    async def main():
+        server, port, accepted = await start_target()
+        pool = UpstreamPool(DNSCache())
+        stream = await pool.acquire("127.0.0.1", port)
+        await asyncio.sleep(0.01)
+        assert len(accepted) == 1 and not pool.targets
+        stream.close()
+        server.close()
+    asyncio.run(main())
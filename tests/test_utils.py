@@ -0,0 +1,189 @@
+import asyncio
+
+from wsgateway.batch import FrameQueue
+from wsgateway.compression import StreamCompressor
+from wsgateway.messages import *
+from wsgateway.tcp import TCPStream, start_tcp_server
+from wsgateway.utils import StreamRelay, TCPStreamEndpoint
+
+async def connected_endpoint(window_size: int = 8):
+    """Returns an endpoint for a client connected to a server, the client's reader and writer
+    and the list of messages sent by the endpoint."""
+    accepted = asyncio.get_running_loop().create_future()
+
+    async def handle(stream):
+        accepted.set_result(stream)
+
+    server = await start_tcp_server(handle, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+    stream = await asyncio.wait_for(accepted, 1)
+    server.close()
+    sent = []
+
+    async def send_message(message: bytes):
+        sent.append(message)
+
+    return TCPStreamEndpoint(stream, send_message, window_size), reader, writer, sent
+
+def counting_writelines(monkeypatch):
+    """Records the chunks of every `TCPStream.writelines` call."""
+    calls = []
+    writelines = TCPStream.writelines
+
+    def counting(stream, chunks):
+        calls.append([ bytes(chunk) for chunk in chunks ])
+        writelines(stream, chunks)
+
+    monkeypatch.setattr(TCPStream, "writelines", counting)
+    return calls
+
+def test_messages_are_written_at_once(monkeypatch):
+    async def main():
+        calls = counting_writelines(monkeypatch)
+        endpoint, reader, writer, sent = await connected_endpoint()
+        data = b"compressed"
+        messages = [ pack_msg_data(b"ab"), pack_msg_data_compressed(len(data), StreamCompressor().compress(data)), pack_msg_data(b"cd") ]
+        assert await endpoint.write_messages(messages) is None
+        assert calls == [ [ b"ab", data, b"cd" ] ]
+        # the batch is granted back with a single update
+        assert sent == [ pack_msg_window_update(14) ]
+        assert await reader.readexactly(14) == b"abcompressedcd"
+        writer.close()
+    asyncio.run(main())
+
+def test_control_messages_keep_their_order(monkeypatch):
+    async def main():
+        calls = counting_writelines(monkeypatch)
+        endpoint, reader, writer, sent = await connected_endpoint()
+        messages = [ pack_msg_data(b"ab"), pack_msg_window_update(100), pack_msg_data(b"cd"), pack_msg_close(), pack_msg_data(b"ef") ]
+        assert await endpoint.write_messages(messages) is False
+        assert calls == [ [ b"ab" ], [ b"cd" ] ]
+        # the data after CLOSE is dropped
+        assert await asyncio.wait_for(reader.read(), 1) == b"abcd"
+        assert endpoint.closed_remotely and endpoint.send_window.credit == 100
+        # the data is granted back as usual once half the window was written
+        assert sent == [ pack_msg_window_ack(), pack_msg_window_update(4) ]
+        writer.close()
+    asyncio.run(main())
+
+def test_grants_wait_for_half_the_window():
+    async def main():
+        endpoint, reader, writer, sent = await connected_endpoint(window_size=16)
+        await endpoint.write_messages([ pack_msg_data(b"abc") ])
+        assert sent == []
+        await endpoint.write_messages([ pack_msg_data(b"defgh"), pack_msg_data(b"i") ])
+        assert sent == [ pack_msg_window_update(9) ]
+        writer.close()
+    asyncio.run(main())
+
+def queued_messages(queue: FrameQueue):
+    messages = []
+    while not queue.empty():
+        stream_id, message = unpack_msg_provider(queue.get_nowait())
+        messages.append((stream_id, bytes(message)))
+    return messages
+
+async def attach_endpoint(relay: StreamRelay):
+    """Attaches the endpoint of a connected socket to `relay`, returns the reader and writer of its peer."""
+    endpoint, reader, writer, _ = await connected_endpoint()
+    endpoint.send_message = relay.send_message
+    relay.attach(endpoint)
+    return reader, writer
+
+def test_idle_relays_have_no_tasks():
+    async def main():
+        queue = FrameQueue()
+        relay = StreamRelay(queue, 1)
+        reader, writer = await attach_endpoint(relay)
+        relay.start()
+        assert relay.writer is None and relay.reader is None and relay.pending is None
+        writer.write(b"abc")
+        while queue.empty():
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0)
+        assert queued_messages(queue) == [ (1, pack_msg_data(b"abc")) ]
+        assert relay.reader is None
+
+        relay.put_nowait(pack_msg_data(b"def"))
+        assert relay.writer is not None
+        assert await reader.readexactly(3) == b"def"
+        await asyncio.sleep(0)
+        assert relay.writer is None and relay.pending is None and relay.queued_bytes == 0
+        writer.close()
+    asyncio.run(main())
+
+def test_messages_wait_for_the_start():
+    async def main():
+        queue = FrameQueue()
+        relay = StreamRelay(queue, 1)
+        relay.put_nowait(pack_msg_data(b"ab"))
+        relay.put_nowait(pack_msg_data(b"cd"))
+        assert relay.qsize() == 2 and relay.queued_bytes == 2 * len(pack_msg_data(b"ab"))
+        reader, writer = await attach_endpoint(relay)
+        await asyncio.sleep(0.01)
+        assert relay.writer is None and relay.qsize() == 2
+        relay.start()
+        assert await asyncio.wait_for(reader.readexactly(4), 1) == b"abcd"
+        writer.close()
+    asyncio.run(main())
+
+def test_finish():
+    async def main():
+        queue = FrameQueue()
+        closed = []
+        relay = StreamRelay(queue, 1)
+        reader, writer = await attach_endpoint(relay)
+        relay.on_close = closed.append
+        relay.start()
+        relay.put_nowait(pack_msg_data(b"ab"))
+        relay.finish()
+        relay.finish()
+        assert relay.closing
+        assert await asyncio.wait_for(reader.read(), 1) == b""
+        await asyncio.sleep(0)
+        assert closed == [ relay ] and queued_messages(queue) == [ (1, pack_msg_close()) ]
+        # nothing is taken once the stream is closing
+        relay.put_nowait(pack_msg_data(b"late"))
+        assert relay.pending is None and relay.queued_bytes == 0
+        writer.close()
+    asyncio.run(main())
+
+def test_finish_on_eof_and_on_close():
+    async def main():
+        queue = FrameQueue()
+        closed = []
+        relay = StreamRelay(queue, 1)
+        reader, writer = await attach_endpoint(relay)
+        relay.on_close = closed.append
+        relay.start()
+        writer.write(b"bye")
+        writer.close()
+        while not closed:
+            await asyncio.sleep(0.001)
+        assert queued_messages(queue) == [ (1, pack_msg_data(b"bye")), (1, pack_msg_close()) ]
+
+        # the gateway closed the stream, it isn't told
+        relay = StreamRelay(queue, 2)
+        reader, writer = await attach_endpoint(relay)
+        relay.on_close = closed.append
+        relay.start()
+        relay.put_nowait(pack_msg_close())
+        assert await asyncio.wait_for(reader.read(), 1) == b""
+        while len(closed) < 2:
+            await asyncio.sleep(0.001)
+        assert relay.closing and queue.empty()
+        writer.close()
+    asyncio.run(main())
+
+def test_finish_before_the_socket_is_open():
+    async def main():
+        queue = FrameQueue()
+        closed = []
+        relay = StreamRelay(queue, 1)
+        relay.on_close = closed.append
+        relay.put_nowait(pack_msg_data(b"ab"))
+        relay.finish()
+        await asyncio.sleep(0)
+        assert closed == [ relay ] and queued_messages(queue) == [ (1, pack_msg_close()) ]
+        assert not relay.started and relay.pending is None
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from wsgateway.messages import *
+from wsgateway.session import is_session_message
+from wsgateway.wire import *
+
+STREAM_IDS = [ 1, 127, 128, 300, 0xFFFFFFFF ]
+
+MESSAGES = [
+    pack_msg_data(b"a"),
+    pack_msg_data(os.urandom(1024)),
+    # the largest data which is shortened and the smallest which is left as it is
+    pack_msg_data(os.urandom(GATHER_MIN_SIZE - 6)),
+    pack_msg_data(os.urandom(GATHER_MIN_SIZE - 5)),
+    pack_msg_data(os.urandom(65536)),
+    pack_msg_data_compressed(100000, os.urandom(100)),
+    pack_msg_data_compressed(0xFFFFFFFF, os.urandom(GATHER_MIN_SIZE - 6)),
+    pack_msg_data_compressed(0xFFFFFFFF, os.urandom(GATHER_MIN_SIZE)),
+    pack_msg_window_update(65536),
+    pack_msg_window_update(0xFFFFFFFF),
+    pack_msg_window_ack(),
+    pack_msg_open("example.com", 22, OPEN_FLAG_COMPRESS),
+    pack_msg_open("example.com", 443, data=os.urandom(70000)),
+    pack_msg_open_ack(),
+    pack_msg_open_fail(OPEN_FAIL_REFUSED, "refused"),
+    pack_msg_close(),
+]
+
+def joined(frame):
+    return b"".join(bytes(part) for part in frame) if isinstance(frame, list) else bytes(frame)
+
+@pytest.mark.parametrize("value", [ 0, 1, 127, 128, 16383, 16384, 0xFFFFFFFF, 2 ** 63 - 1 ])
+def test_varint_round_trip(value):
+    packed = b"x" + pack_varint(value)
+    assert unpack_varint(packed, 1) == (value, len(packed))
+
+def test_varint_too_long():
+    with pytest.raises(ValueError):
+        unpack_varint(b"\xff" * 11, 0)
+
+@pytest.mark.parametrize("stream_id", STREAM_IDS)
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda msg: "type {} len {}".format(msg[0], len(msg)))
+def test_provider_message_round_trip(stream_id, msg):
+    for frame in (pack_msg_provider(stream_id, msg), pack_msg_provider_gathered(stream_id, msg)):
+        message = joined(pack_msg_v2_provider(frame))
+        unpacked = unpack_msg_v2_provider(message)
+        assert unpack_msg_provider(unpacked)[0] == stream_id
+        assert bytes(unpack_msg_provider(unpacked)[1]) == msg
+        assert frame_len(unpacked) == len(pack_msg_provider(stream_id, msg))
+
+@pytest.mark.parametrize("msg", MESSAGES, ids=lambda msg: "type {} len {}".format(msg[0], len(msg)))
+def test_stream_message_round_trip(msg):
+    message = joined(pack_msg_v2(None, msg))
+    assert bytes(unpack_msg_v2(message, 0, len(message))) == msg
+
+def test_messages_are_shorter():
+    assert len(joined(pack_msg_v2_provider(pack_msg_provider(1, pack_msg_data(b"a"))))) == 3
+    assert len(joined(pack_msg_v2_provider(pack_msg_provider(1, pack_msg_window_update(65536))))) == 5
+    for msg in MESSAGES:
+        assert len(joined(pack_msg_v2_provider(pack_msg_provider(300, msg)))) < len(pack_msg_provider(300, msg))
+
+def test_large_data_is_not_copied():
+    msg = pack_msg_data(os.urandom(65536))
+    frame = pack_msg_v2_provider(pack_msg_provider_gathered(5, msg))
+    assert isinstance(frame, list) and frame[1] is msg
+
+    message = joined(frame)
+    stream_id, inner = unpack_msg_v2_provider(message)
+    assert stream_id == 5
+    assert isinstance(inner, memoryview) and inner.obj is message
+
+    # links without stream ids send and receive it as it is
+    assert pack_msg_v2(None, msg) is msg
+    assert unpack_msg_v2(msg, 0, len(msg)) is msg
+
+def test_batch_round_trip():
+    frames = [ pack_msg_provider_gathered(stream_id, msg) for stream_id, msg in zip(range(1, len(MESSAGES) + 1), MESSAGES) ]
+    batch = pack_msg_batch(frames)
+    message = joined(pack_msg_v2_provider(batch))
+
+    stream_id, inner = unpack_msg_v2_provider(message)
+    assert stream_id == CONTROL_STREAM_ID and inner[0] == MSG_TYPE_BATCH
+    assert [ (client_id, bytes(msg)) for client_id, msg in iter_msg_batch(inner) ] == list(zip(range(1, len(MESSAGES) + 1), MESSAGES))
+    assert is_session_message((stream_id, inner))
+
+def test_control_messages_are_not_session_messages():
+    message = joined(pack_msg_v2_provider(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_hello(FEATURE_BATCH))))
+    unpacked = unpack_msg_v2_provider(message)
+    assert unpacked == (CONTROL_STREAM_ID, pack_msg_hello(FEATURE_BATCH))
+    assert not is_session_message(unpacked)
+    assert is_session_message(unpack_msg_v2_provider(joined(pack_msg_v2_provider(pack_msg_provider(7, pack_msg_close())))))
+
+def test_negotiation():
+    assert subprotocols(PROTOCOL_V1) is None
+    assert subprotocols(PROTOCOL_V2) == [ SUBPROTOCOLS[PROTOCOL_V2] ]
+    assert negotiated_version(None) == PROTOCOL_V1
+    assert negotiated_version(SUBPROTOCOLS[PROTOCOL_V2]) == PROTOCOL_V2
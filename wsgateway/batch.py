@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Union
+
+from wsgateway.messages import pack_msg_batch, frame_len, frame_stream_id
+from wsgateway.metrics import Histogram
+from wsgateway.scheduler import Entry, StreamScheduler
+
+DEFAULT_BATCH_MAX_SIZE = 65536
+DEFAULT_BATCH_DELAY_US = 100
+
+class FrameFifo(object):
+    """Queued messages in the order they were queued, with the interface of a `StreamScheduler`."""
+    __slots__ = ("entries",)
+    entries: Deque[Entry]
+
+    def __init__(self):
+        self.entries = deque()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (frame for frame, _ in self.entries)
+
+    def push(self, frame: Union[bytes, List[bytes]], put_time: float = 0.0, front: bool = False):
+        if front:
+            self.entries.appendleft((frame, put_time))
+        else:
+            self.entries.append((frame, put_time))
+
+    def delay(self):
+        return 0.0 if self.entries else None
+
+    def pop(self) -> Entry:
+        return self.entries.popleft()
+
+class FrameQueue(object):
+    """Send queue of provider messages, which can hand out the queued messages of several
+    streams as a single batch message. It has a single consumer, putting never waits.
+
+    `get_batch` takes the next message and the messages queued along with it. If others
+    are queued, it lets the event loop run as long as every iteration queues more messages,
+    for at most `delay_us` microseconds or until `max_size` bytes are queued. A message
+    queued alone is sent right away.
+
+    With a `scheduler` the messages are handed out in the order it chooses instead of FIFO,
+    `get` waits while its rate limits hold all queued messages back. How long messages
+    waited is recorded in `wait_histogram`. The queued bytes are counted in total and per
+    stream, streams without queued messages have no entry in `stream_bytes`."""
+    wait_histogram: Union[Histogram, None]
+    frames: Union[StreamScheduler, FrameFifo]
+    queued_bytes: int
+    stream_bytes: Dict[int, int]
+    scheduler: Union[StreamScheduler, None]
+    ready_waiter: Union[asyncio.Future, None]
+
+    def __init__(self, wait_histogram: Union[Histogram, None] = None, scheduler: Union[StreamScheduler, None] = None):
+        self.wait_histogram = wait_histogram
+        self.frames = scheduler if scheduler is not None else FrameFifo()
+        self.queued_bytes = 0
+        self.stream_bytes = {}
+        self.scheduler = scheduler
+        self.ready_waiter = None
+
+    def qsize(self):
+        return len(self.frames)
+
+    def stream_queued(self, stream_id: int):
+        """Bytes queued for the stream `stream_id`."""
+        return self.stream_bytes.get(stream_id, 0)
+
+    def count_bytes(self, frame: Union[bytes, List[bytes]], size: int):
+        self.queued_bytes += size
+        stream_id = frame_stream_id(frame)
+        queued = self.stream_bytes.get(stream_id, 0) + size
+        if queued:
+            self.stream_bytes[stream_id] = queued
+        else:
+            del self.stream_bytes[stream_id]
+
+    def empty(self):
+        return not self.frames
+
+    def put_nowait(self, frame: Union[bytes, List[bytes]]):
+        self.frames.push(frame, time.monotonic() if self.wait_histogram else 0.0)
+        self.count_bytes(frame, frame_len(frame))
+        self._wake_ready()
+
+    async def put(self, frame: Union[bytes, List[bytes]]):
+        self.put_nowait(frame)
+
+    def put_back(self, frame: Union[bytes, List[bytes]]):
+        """Puts a message taken from the queue back in front of the others."""
+        self.frames.push(frame, time.monotonic() if self.wait_histogram else 0.0, front=True)
+        self.count_bytes(frame, frame_len(frame))
+        self._wake_ready()
+
+    def ready(self):
+        """True if a message can be taken right away."""
+        return self.frames.delay() == 0
+
+    def get_nowait(self):
+        if not self.ready():
+            raise asyncio.QueueEmpty()
+        frame, put_time = self.frames.pop()
+        if self.wait_histogram:
+            self.wait_histogram.observe(time.monotonic() - put_time)
+        self.count_bytes(frame, -frame_len(frame))
+        return frame
+
+    async def get(self):
+        await self.wait_ready()
+        return self.get_nowait()
+
+    async def wait_ready(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self.frames.delay()
+            if delay == 0:
+                return
+            self.ready_waiter = loop.create_future()
+            # a message queued in the meantime may be sent before the rate limits allow the others
+            timer = loop.call_later(delay, self._wake_ready) if delay else None
+            try:
+                await self.ready_waiter
+            finally:
+                if timer:
+                    timer.cancel()
+                self.ready_waiter = None
+
+    def _wake_ready(self):
+        if self.ready_waiter and not self.ready_waiter.done():
+            self.ready_waiter.set_result(None)
+
+    async def get_batch(self, max_size: int = DEFAULT_BATCH_MAX_SIZE, delay_us: int = DEFAULT_BATCH_DELAY_US):
+        frame = await self.get()
+        size = frame_len(frame)
+        if size >= max_size:
+            return frame
+
+        # a message queued alone is sent right away, others are queued along with it in a burst
+        if delay_us > 0 and self.queued_bytes:
+            try:
+                await self.gather_more(max_size - size, delay_us)
+            except asyncio.CancelledError:
+                # a resumed session sends the message over the next websocket
+                self.put_back(frame)
+                raise
+
+        if not self.ready():
+            return frame
+
+        frames = [ frame ]
+        while size < max_size and self.ready():
+            frame = self.get_nowait()
+            size += frame_len(frame)
+            frames.append(frame)
+        return pack_msg_batch(frames)
+
+    async def gather_more(self, max_bytes: int, delay_us: int):
+        # every iteration of the event loop lets streams which are ready queue their messages,
+        # the batch grows as long as each iteration adds some
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay_us / 1000000
+        queued_bytes = self.queued_bytes
+        await asyncio.sleep(0)
+        while queued_bytes < self.queued_bytes < max_bytes and loop.time() < deadline:
+            queued_bytes = self.queued_bytes
+            await asyncio.sleep(0)
@@ -0,0 +1,101 @@
+import mmap
+import struct
+import time
+from typing import Iterator, Union
+
+# A capture file is a sequence of segments, one for every time a gateway process opened it.
+# A segment starts with CAPTURE_MAGIC and a header with the wall clock time it was started
+# and its flags, followed by a record for every relayed message: the microseconds since the
+# start of the segment, the stream id, the direction, the message type and the size of the
+# inner message. With CAPTURE_FLAG_PAYLOAD the inner message follows its record.
+CAPTURE_MAGIC = b"WSGWCAP1"
+CAPTURE_HEADER = struct.Struct("!dB")
+CAPTURE_RECORD = struct.Struct("!QIBBI")
+CAPTURE_FLAG_PAYLOAD = 0x01
+
+CAPTURE_TO_PROVIDER = 0
+CAPTURE_TO_CLIENT = 1
+CAPTURE_DIRECTIONS = { CAPTURE_TO_PROVIDER: "client->provider", CAPTURE_TO_CLIENT: "provider->client" }
+
+# records are buffered by the file and flushed at least this often
+CAPTURE_BUFFER_SIZE = 262144
+CAPTURE_FLUSH_INTERVAL = 1.0
+
+class CaptureRecord(object):
+    """A relayed message. Stream ids are only unique within a `segment`."""
+    __slots__ = ("time", "segment", "stream_id", "direction", "msg_type", "size", "payload")
+    time: float
+    segment: int
+    stream_id: int
+    direction: int
+    msg_type: int
+    size: int
+    payload: Union[memoryview, None]
+
+    def __init__(self, time: float, segment: int, stream_id: int, direction: int, msg_type: int, size: int, payload: Union[memoryview, None]):
+        self.time = time
+        self.segment = segment
+        self.stream_id = stream_id
+        self.direction = direction
+        self.msg_type = msg_type
+        self.size = size
+        self.payload = payload
+
+class CaptureWriter(object):
+    """Appends the messages relayed by the gateway to a capture file."""
+    __slots__ = ("file", "payload", "started")
+    file: object
+    payload: bool
+    started: float
+
+    def __init__(self, path: str, payload: bool = False):
+        self.file = open(path, "ab", buffering=CAPTURE_BUFFER_SIZE)
+        self.payload = payload
+        self.started = time.monotonic()
+        self.file.write(CAPTURE_MAGIC + CAPTURE_HEADER.pack(time.time(), CAPTURE_FLAG_PAYLOAD if payload else 0))
+
+    def frame(self, direction: int, stream_id: int, msg: bytes):
+        self.file.write(CAPTURE_RECORD.pack(int((time.monotonic() - self.started) * 1000000), stream_id, direction, msg[0], len(msg)))
+        if self.payload:
+            self.file.write(msg)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_capture(data: Union[bytes, mmap.mmap]) -> Iterator[CaptureRecord]:
+    """Yields the records of a capture, the times of later segments continue after the
+    earlier ones. Payloads are views of `data`, which are not copied."""
+    view = memoryview(data)
+    offset = 0
+    payload = False
+    segment = -1
+    segment_start = 0.0
+    last_time = 0.0
+    while offset + CAPTURE_RECORD.size <= len(data):
+        if view[offset:offset + len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+            _, flags = CAPTURE_HEADER.unpack_from(data, offset + len(CAPTURE_MAGIC))
+            offset += len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+            payload = bool(flags & CAPTURE_FLAG_PAYLOAD)
+            segment += 1
+            segment_start = last_time
+            continue
+
+        time_us, stream_id, direction, msg_type, size = CAPTURE_RECORD.unpack_from(data, offset)
+        offset += CAPTURE_RECORD.size
+        record_payload = None
+        if payload:
+            if offset + size > len(data):
+                # the gateway was stopped while writing the record
+                return
+            record_payload = view[offset:offset + size]
+            offset += size
+        last_time = segment_start + time_us / 1000000
+        yield CaptureRecord(last_time, segment, stream_id, direction, msg_type, size, record_payload)
+
+def open_capture(path: str):
+    """Memory maps a capture file."""
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
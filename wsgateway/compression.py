@@ -0,0 +1,95 @@
+import time
+import zlib
+from typing import Union
+
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# a stream is sent uncompressed from the moment its first PROBE_SIZE bytes compressed to
+# more than BYPASS_RATIO of their size, which is the case for tls or compressed payloads
+PROBE_SIZE = 65536
+BYPASS_RATIO = 0.9
+
+class CompressionStats(object):
+    """Compression counters of the process. The seconds are cpu time spent in zlib."""
+    raw_bytes: int
+    compressed_bytes: int
+    compress_seconds: float
+    decompress_seconds: float
+    streams: int
+    bypassed_streams: int
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+        self.streams = 0
+        self.bypassed_streams = 0
+
+    @property
+    def ratio(self):
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def summary(self):
+        return "compressed {} of {} bytes (ratio {:.2f}), {} of {} streams bypassed, cpu: {:.3f}s compressing, {:.3f}s decompressing".format(
+            self.compressed_bytes, self.raw_bytes, self.ratio, self.bypassed_streams, self.streams, self.compress_seconds, self.decompress_seconds)
+
+compression_stats = CompressionStats()
+
+class StreamCompressor(object):
+    """Compresses the data of one direction of a stream with a single deflate context, so
+    later frames profit from the data of earlier ones. Every frame is flushed, the peer
+    can decompress it as soon as it arrives."""
+    compressor: Union["zlib._Compress", None]
+    raw_bytes: int
+    compressed_bytes: int
+
+    def __init__(self, level: int = DEFAULT_COMPRESSION_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        compression_stats.streams += 1
+
+    @property
+    def active(self):
+        return self.compressor is not None
+
+    def compress(self, data: bytes):
+        """Returns the compressed frame. Returns None once the stream is bypassed, the data
+        has to be sent uncompressed then."""
+        if not self.compressor:
+            return None
+
+        started = time.process_time()
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compression_stats.compress_seconds += time.process_time() - started
+
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        compression_stats.raw_bytes += len(data)
+        compression_stats.compressed_bytes += len(compressed)
+
+        # the frame is sent compressed anyway, the peer's context has to see it
+        if self.raw_bytes >= PROBE_SIZE and self.compressed_bytes > self.raw_bytes * BYPASS_RATIO:
+            self.compressor = None
+            compression_stats.bypassed_streams += 1
+        return compressed
+
+class StreamDecompressor(object):
+    decompressor: "zlib._Decompress"
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, payload: bytes, raw_len: int):
+        """Raises ValueError if the payload doesn't decompress to exactly `raw_len` bytes."""
+        if raw_len <= 0:
+            # a max_length of 0 would not limit the output
+            raise ValueError("compressed data frame without data")
+        started = time.process_time()
+        data = self.decompressor.decompress(payload, raw_len)
+        compression_stats.decompress_seconds += time.process_time() - started
+
+        if len(data) != raw_len or self.decompressor.unconsumed_tail:
+            raise ValueError("compressed data frame does not match its length")
+        return data
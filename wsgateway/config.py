@@ -1,16 +1,28 @@
 import configparser
 import argparse
 import logging
-from typing import Union
+from typing import Callable, Union
 import os
+from wsgateway.tcp import DEFAULT_MAX_READ_SIZE, DEFAULT_HIGH_WATER, DEFAULT_WRITE_HIGH_WATER, unix_address_path
+from wsgateway.flow import DEFAULT_WINDOW_SIZE, DEFAULT_MAX_WINDOW_SIZE, DEFAULT_MAX_QUEUED, INITIAL_WINDOW_SIZE
+from wsgateway.batch import DEFAULT_BATCH_MAX_SIZE, DEFAULT_BATCH_DELAY_US
+from wsgateway.compression import DEFAULT_COMPRESSION_LEVEL
+from wsgateway.upstream import DEFAULT_DNS_TTL, DEFAULT_POOL_SIZE, DEFAULT_POOL_IDLE
+from wsgateway.udp import DEFAULT_UDP_IDLE_TIMEOUT
+from wsgateway.wire import DEFAULT_PROTOCOL_VERSION, PROTOCOL_V1, PROTOCOL_V2
+from wsgateway.session import DEFAULT_RESUME_TIMEOUT, DEFAULT_REPLAY_BUFFER
+from wsgateway.scheduler import DEFAULT_QUANTUM
+from wsgateway.diagnostics import DEFAULT_LAG_INTERVAL, DEFAULT_LAG_WARN, DEFAULT_SLOW_CALLBACK, DEFAULT_PROFILE_SECONDS, DEFAULT_PROFILE_INTERVAL
 
 class WSGWConfigParser(object):
     failed: bool
     config: configparser.ConfigParser
+    args: argparse.Namespace
 
-    def __init__(self, config: configparser.ConfigParser):
+    def __init__(self, config: configparser.ConfigParser, args: Union[argparse.Namespace, None] = None):
         self.failed = False
         self.config = config
+        self.args = args or argparse.Namespace()
         self.parse_log()
 
     def parse_provider_name(self):
@@ -21,20 +33,52 @@ class WSGWConfigParser(object):
             else:
                 self.print_error("provider.name")
 
-    def parse_remote_provider(self):
+    def parse_provider_connections(self):
+        self.provider_connections = 1
+        self.provider_workers = 1
         if self.config.has_section("provider"):
-            provider_port = self.config["provider"].getint("port", fallback=None)
-            if provider_port:
-                self.provider_port = provider_port
+            provider_connections = self.config["provider"].getint("connections", fallback=1)
+            if provider_connections and provider_connections > 0:
+                self.provider_connections = provider_connections
             else:
-                self.print_error("provider.port")
+                self.print_error("provider.connections", msg="Must be at least 1.")
+
+            provider_workers = self.config["provider"].getint("workers", fallback=1)
+            if provider_workers and provider_workers > 0:
+                self.provider_workers = provider_workers
+            else:
+                self.print_error("provider.workers", msg="Must be at least 1.")
 
+    def parse_provider_unix_paths(self):
+        self.provider_unix_paths = set()
+        if self.config.has_section("provider"):
+            provider_unix_paths = self.config["provider"].get("unix_paths", fallback="")
+            for path in provider_unix_paths.split(","):
+                path = path.strip()
+                if not path:
+                    continue
+                if os.path.isabs(path):
+                    self.provider_unix_paths.add(os.path.normpath(path))
+                else:
+                    self.print_error("provider.unix_paths", msg="\"{}\" is not an absolute path.".format(path))
+
+    def parse_remote_provider(self):
+        if self.config.has_section("provider"):
             provider_hostname = self.config["provider"].get("hostname", fallback=None)
             if provider_hostname and isinstance(provider_hostname, str):
                 self.provider_hostname = provider_hostname
             else:
                 self.print_error("provider.hostname")
 
+            # unix sockets have no port
+            provider_port = self.config["provider"].getint("port", fallback=None)
+            if provider_port:
+                self.provider_port = provider_port
+            elif provider_hostname and unix_address_path(provider_hostname):
+                self.provider_port = 0
+            else:
+                self.print_error("provider.port")
+
 
     def parse_gateway_url(self):
         if self.config.has_section("gateway"):
@@ -45,12 +89,34 @@ class WSGWConfigParser(object):
                 self.print_error("gateway.url", msg="Url must start with \"ws\".")
 
     def parse_gateway_port(self):
+        self.gateway_unix_path = None
+        if self.config.has_section("gateway"):
+            gateway_port = self.config["gateway"].get("port", fallback="")
+            self.gateway_unix_path = unix_address_path(gateway_port)
+            if self.gateway_unix_path:
+                self.gateway_port = None
+            elif gateway_port.isdigit() and int(gateway_port) > 0:
+                self.gateway_port = int(gateway_port)
+            else:
+                self.print_error("gateway.port", msg="Must be a port or a unix: address.")
+
+    def parse_gateway_workers(self):
+        self.gateway_workers = 1
         if self.config.has_section("gateway"):
-            gateway_port = self.config["gateway"].getint("port", fallback=None)
-            if gateway_port:
-                self.gateway_port = gateway_port
+            self.gateway_workers = self.config["gateway"].getint("workers", fallback=1)
+        if getattr(self.args, "workers", None):
+            self.gateway_workers = self.args.workers
+        if not self.gateway_workers or self.gateway_workers < 1:
+            self.print_error("gateway.workers", msg="Must be at least 1.")
+
+    def parse_gateway_placement(self):
+        self.gateway_placement = "least-streams"
+        if self.config.has_section("gateway"):
+            gateway_placement = self.config["gateway"].get("placement", fallback="least-streams")
+            if gateway_placement in [ "least-streams", "least-bytes" ]:
+                self.gateway_placement = gateway_placement
             else:
-                self.print_error("gateway.port")
+                self.print_error("gateway.placement", msg="Must be \"least-streams\" or \"least-bytes\".")
 
     def parse_gateway_password(self):
         if self.config.has_section("gateway"):
@@ -60,17 +126,332 @@ class WSGWConfigParser(object):
             else:
                 self.print_error("gateway.password")
 
+    def parse_gateway_protocol(self):
+        self.gateway_protocol = DEFAULT_PROTOCOL_VERSION
+        if self.config.has_section("gateway"):
+            gateway_protocol = self.config["gateway"].getint("protocol", fallback=DEFAULT_PROTOCOL_VERSION)
+            if gateway_protocol in (PROTOCOL_V1, PROTOCOL_V2):
+                self.gateway_protocol = gateway_protocol
+            else:
+                self.print_error("gateway.protocol", msg="Must be 1 or 2.")
+
     def parse_client_port(self):
+        self.client_unix_path = None
         if self.config.has_section("client"):
-            client_port = self.config["client"].getint("port", fallback=None)
-            if client_port:
-                self.client_port = client_port
+            client_port = self.config["client"].get("port", fallback="")
+            self.client_unix_path = unix_address_path(client_port)
+            if self.client_unix_path:
+                self.client_port = None
+            elif client_port.isdigit() and int(client_port) > 0:
+                self.client_port = int(client_port)
+            else:
+                self.print_error("client.port", msg="Must be a port or a unix: address.")
+
+    def parse_client_multiplex(self):
+        self.client_multiplex = False
+        self.client_connections = 1
+        if self.config.has_section("client"):
+            client_multiplex = self.config["client"].get("multiplex", fallback="no").lower()
+            if client_multiplex in configparser.ConfigParser.BOOLEAN_STATES:
+                self.client_multiplex = configparser.ConfigParser.BOOLEAN_STATES[client_multiplex]
+            else:
+                self.print_error("client.multiplex", msg="Must be a boolean (yes/no).")
+
+            client_connections = self.config["client"].getint("connections", fallback=1)
+            if client_connections and client_connections > 0:
+                self.client_connections = client_connections
+            else:
+                self.print_error("client.connections", msg="Must be at least 1.")
+
+    def parse_client_pool(self):
+        self.client_pool_size = 0
+        self.client_fast_open = True
+        if self.config.has_section("client"):
+            client_pool_size = self.config["client"].getint("pool_size", fallback=0)
+            if client_pool_size is not None and client_pool_size >= 0:
+                self.client_pool_size = client_pool_size
+            else:
+                self.print_error("client.pool_size", msg="Must not be negative.")
+
+            client_fast_open = self.config["client"].get("fast_open", fallback="yes").lower()
+            if client_fast_open in configparser.ConfigParser.BOOLEAN_STATES:
+                self.client_fast_open = configparser.ConfigParser.BOOLEAN_STATES[client_fast_open]
+            else:
+                self.print_error("client.fast_open", msg="Must be a boolean (yes/no).")
+
+    def parse_client_protocol(self):
+        self.client_protocol = "tcp"
+        if self.config.has_section("client"):
+            client_protocol = self.config["client"].get("protocol", fallback="tcp").lower()
+            if client_protocol in ("tcp", "udp", "socks"):
+                self.client_protocol = client_protocol
+            else:
+                self.print_error("client.protocol", msg="Must be tcp, udp or socks.")
+
+    def parse_udp(self):
+        self.udp_idle_timeout = DEFAULT_UDP_IDLE_TIMEOUT
+        if self.config.has_section("udp"):
+            udp_idle_timeout = self.config["udp"].getfloat("idle_timeout", fallback=DEFAULT_UDP_IDLE_TIMEOUT)
+            if udp_idle_timeout and udp_idle_timeout > 0:
+                self.udp_idle_timeout = udp_idle_timeout
+            else:
+                self.print_error("udp.idle_timeout")
+
+    def parse_session(self):
+        self.session_resume = True
+        self.session_resume_timeout = DEFAULT_RESUME_TIMEOUT
+        self.session_replay_buffer = DEFAULT_REPLAY_BUFFER
+        if self.config.has_section("session"):
+            session_resume = self.config["session"].get("resume", fallback="yes").lower()
+            if session_resume in configparser.ConfigParser.BOOLEAN_STATES:
+                self.session_resume = configparser.ConfigParser.BOOLEAN_STATES[session_resume]
+            else:
+                self.print_error("session.resume", msg="Must be a boolean (yes/no).")
+
+            session_resume_timeout = self.config["session"].getfloat("resume_timeout", fallback=DEFAULT_RESUME_TIMEOUT)
+            if session_resume_timeout and session_resume_timeout > 0:
+                self.session_resume_timeout = session_resume_timeout
+            else:
+                self.print_error("session.resume_timeout")
+
+            session_replay_buffer = self.config["session"].getint("replay_buffer", fallback=DEFAULT_REPLAY_BUFFER)
+            if session_replay_buffer and session_replay_buffer > 0:
+                self.session_replay_buffer = session_replay_buffer
+            else:
+                self.print_error("session.replay_buffer")
+
+    def parse_batch(self):
+        self.batch_enabled = False
+        self.batch_max_size = DEFAULT_BATCH_MAX_SIZE
+        self.batch_delay_us = DEFAULT_BATCH_DELAY_US
+        if self.config.has_section("batch"):
+            batch_enabled = self.config["batch"].get("enabled", fallback="no").lower()
+            if batch_enabled in configparser.ConfigParser.BOOLEAN_STATES:
+                self.batch_enabled = configparser.ConfigParser.BOOLEAN_STATES[batch_enabled]
+            else:
+                self.print_error("batch.enabled", msg="Must be a boolean (yes/no).")
+
+            batch_max_size = self.config["batch"].getint("max_size", fallback=DEFAULT_BATCH_MAX_SIZE)
+            if batch_max_size and batch_max_size > 0:
+                self.batch_max_size = batch_max_size
+            else:
+                self.print_error("batch.max_size")
+
+            batch_delay_us = self.config["batch"].getint("delay_us", fallback=DEFAULT_BATCH_DELAY_US)
+            if batch_delay_us is not None and batch_delay_us >= 0:
+                self.batch_delay_us = batch_delay_us
+            else:
+                self.print_error("batch.delay_us", msg="Must not be negative.")
+
+    def parse_scheduler(self):
+        self.scheduler_enabled = True
+        self.scheduler_quantum = DEFAULT_QUANTUM
+        self.scheduler_stream_rate = 0
+        self.scheduler_provider_rate = 0
+        if self.config.has_section("scheduler"):
+            scheduler_enabled = self.config["scheduler"].get("enabled", fallback="yes").lower()
+            if scheduler_enabled in configparser.ConfigParser.BOOLEAN_STATES:
+                self.scheduler_enabled = configparser.ConfigParser.BOOLEAN_STATES[scheduler_enabled]
             else:
-                self.print_error("client.port")
+                self.print_error("scheduler.enabled", msg="Must be a boolean (yes/no).")
+
+            scheduler_quantum = self.config["scheduler"].getint("quantum", fallback=DEFAULT_QUANTUM)
+            if scheduler_quantum and scheduler_quantum > 0:
+                self.scheduler_quantum = scheduler_quantum
+            else:
+                self.print_error("scheduler.quantum")
+
+            scheduler_stream_rate = self.config["scheduler"].getint("stream_rate", fallback=0)
+            if scheduler_stream_rate is not None and scheduler_stream_rate >= 0:
+                self.scheduler_stream_rate = scheduler_stream_rate
+            else:
+                self.print_error("scheduler.stream_rate", msg="Must not be negative.")
+
+            scheduler_provider_rate = self.config["scheduler"].getint("provider_rate", fallback=0)
+            if scheduler_provider_rate is not None and scheduler_provider_rate >= 0:
+                self.scheduler_provider_rate = scheduler_provider_rate
+            else:
+                self.print_error("scheduler.provider_rate", msg="Must not be negative.")
+
+    def parse_capture(self):
+        self.capture_path = None
+        self.capture_payload = False
+        if self.config.has_section("capture"):
+            self.capture_path = self.config["capture"].get("path", fallback=None)
+
+            capture_payload = self.config["capture"].get("payload", fallback="no").lower()
+            if capture_payload in configparser.ConfigParser.BOOLEAN_STATES:
+                self.capture_payload = configparser.ConfigParser.BOOLEAN_STATES[capture_payload]
+            else:
+                self.print_error("capture.payload", msg="Must be a boolean (yes/no).")
+
+    def parse_compression(self):
+        self.compression_enabled = False
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        if self.config.has_section("compression"):
+            compression_enabled = self.config["compression"].get("enabled", fallback="no").lower()
+            if compression_enabled in configparser.ConfigParser.BOOLEAN_STATES:
+                self.compression_enabled = configparser.ConfigParser.BOOLEAN_STATES[compression_enabled]
+            else:
+                self.print_error("compression.enabled", msg="Must be a boolean (yes/no).")
+
+            compression_level = self.config["compression"].getint("level", fallback=DEFAULT_COMPRESSION_LEVEL)
+            if compression_level is not None and 1 <= compression_level <= 9:
+                self.compression_level = compression_level
+            else:
+                self.print_error("compression.level", msg="Must be between 1 and 9.")
+
+    def parse_metrics(self):
+        self.metrics_path = None
+        self.metrics_port = None
+        self.metrics_per_stream = False
+        if self.config.has_section("metrics"):
+            metrics_path = self.config["metrics"].get("path", fallback=None)
+            if metrics_path is None or metrics_path.startswith("/"):
+                self.metrics_path = metrics_path
+            else:
+                self.print_error("metrics.path", msg="Must start with /.")
+
+            metrics_port = self.config["metrics"].getint("port", fallback=None)
+            if metrics_port is None or 0 < metrics_port < 65536:
+                self.metrics_port = metrics_port
+            else:
+                self.print_error("metrics.port")
+
+            metrics_per_stream = self.config["metrics"].get("per_stream", fallback="no").lower()
+            if metrics_per_stream in configparser.ConfigParser.BOOLEAN_STATES:
+                self.metrics_per_stream = configparser.ConfigParser.BOOLEAN_STATES[metrics_per_stream]
+            else:
+                self.print_error("metrics.per_stream", msg="Must be a boolean (yes/no).")
+
+    def parse_diagnostics(self):
+        self.diagnostics_enabled = False
+        self.diagnostics_lag_interval = DEFAULT_LAG_INTERVAL
+        self.diagnostics_lag_warn = DEFAULT_LAG_WARN
+        self.diagnostics_slow_callback = DEFAULT_SLOW_CALLBACK
+        self.diagnostics_profile_seconds = DEFAULT_PROFILE_SECONDS
+        self.diagnostics_profile_interval = DEFAULT_PROFILE_INTERVAL
+        self.diagnostics_profile_dir = None
+        self.diagnostics_profile_socket = None
+        if self.config.has_section("diagnostics"):
+            diagnostics_enabled = self.config["diagnostics"].get("enabled", fallback="no").lower()
+            if diagnostics_enabled in configparser.ConfigParser.BOOLEAN_STATES:
+                self.diagnostics_enabled = configparser.ConfigParser.BOOLEAN_STATES[diagnostics_enabled]
+            else:
+                self.print_error("diagnostics.enabled", msg="Must be a boolean (yes/no).")
+
+            diagnostics_lag_interval = self.config["diagnostics"].getfloat("lag_interval", fallback=DEFAULT_LAG_INTERVAL)
+            if diagnostics_lag_interval and diagnostics_lag_interval > 0:
+                self.diagnostics_lag_interval = diagnostics_lag_interval
+            else:
+                self.print_error("diagnostics.lag_interval")
+
+            diagnostics_lag_warn = self.config["diagnostics"].getfloat("lag_warn", fallback=DEFAULT_LAG_WARN)
+            if diagnostics_lag_warn and diagnostics_lag_warn > 0:
+                self.diagnostics_lag_warn = diagnostics_lag_warn
+            else:
+                self.print_error("diagnostics.lag_warn")
+
+            diagnostics_slow_callback = self.config["diagnostics"].getfloat("slow_callback", fallback=DEFAULT_SLOW_CALLBACK)
+            if diagnostics_slow_callback is not None and diagnostics_slow_callback >= 0:
+                self.diagnostics_slow_callback = diagnostics_slow_callback
+            else:
+                self.print_error("diagnostics.slow_callback", msg="Must not be negative.")
+
+            diagnostics_profile_seconds = self.config["diagnostics"].getfloat("profile_seconds", fallback=DEFAULT_PROFILE_SECONDS)
+            if diagnostics_profile_seconds and diagnostics_profile_seconds > 0:
+                self.diagnostics_profile_seconds = diagnostics_profile_seconds
+            else:
+                self.print_error("diagnostics.profile_seconds")
+
+            diagnostics_profile_interval = self.config["diagnostics"].getfloat("profile_interval", fallback=DEFAULT_PROFILE_INTERVAL)
+            if diagnostics_profile_interval and diagnostics_profile_interval > 0:
+                self.diagnostics_profile_interval = diagnostics_profile_interval
+            else:
+                self.print_error("diagnostics.profile_interval")
+
+            diagnostics_profile_dir = self.config["diagnostics"].get("profile_dir", fallback=None)
+            if diagnostics_profile_dir is None or os.path.isdir(diagnostics_profile_dir):
+                self.diagnostics_profile_dir = diagnostics_profile_dir
+            else:
+                self.print_error("diagnostics.profile_dir", msg="Directory not found!")
+
+            self.diagnostics_profile_socket = self.config["diagnostics"].get("profile_socket", fallback=None)
+
+    def parse_upstream(self):
+        self.upstream_dns_ttl = DEFAULT_DNS_TTL
+        self.upstream_pool_size = DEFAULT_POOL_SIZE
+        self.upstream_pool_idle = DEFAULT_POOL_IDLE
+        if self.config.has_section("upstream"):
+            upstream_dns_ttl = self.config["upstream"].getfloat("dns_ttl", fallback=DEFAULT_DNS_TTL)
+            if upstream_dns_ttl is not None and upstream_dns_ttl >= 0:
+                self.upstream_dns_ttl = upstream_dns_ttl
+            else:
+                self.print_error("upstream.dns_ttl", msg="Must not be negative.")
+
+            upstream_pool_size = self.config["upstream"].getint("pool_size", fallback=DEFAULT_POOL_SIZE)
+            if upstream_pool_size is not None and upstream_pool_size >= 0:
+                self.upstream_pool_size = upstream_pool_size
+            else:
+                self.print_error("upstream.pool_size", msg="Must not be negative.")
+
+            upstream_pool_idle = self.config["upstream"].getfloat("pool_idle", fallback=DEFAULT_POOL_IDLE)
+            if upstream_pool_idle and upstream_pool_idle > 0:
+                self.upstream_pool_idle = upstream_pool_idle
+            else:
+                self.print_error("upstream.pool_idle")
+
+    def parse_tcp(self):
+        self.tcp_max_read_size = DEFAULT_MAX_READ_SIZE
+        self.tcp_high_water = DEFAULT_HIGH_WATER
+        self.tcp_write_high_water = DEFAULT_WRITE_HIGH_WATER
+        if self.config.has_section("tcp"):
+            tcp_max_read_size = self.config["tcp"].getint("max_read_size", fallback=DEFAULT_MAX_READ_SIZE)
+            if tcp_max_read_size and tcp_max_read_size > 0:
+                self.tcp_max_read_size = tcp_max_read_size
+            else:
+                self.print_error("tcp.max_read_size")
+
+            tcp_high_water = self.config["tcp"].getint("high_water", fallback=DEFAULT_HIGH_WATER)
+            if tcp_high_water and tcp_high_water > 0:
+                self.tcp_high_water = tcp_high_water
+            else:
+                self.print_error("tcp.high_water")
+
+            tcp_write_high_water = self.config["tcp"].getint("write_high_water", fallback=DEFAULT_WRITE_HIGH_WATER)
+            if tcp_write_high_water and tcp_write_high_water > 0:
+                self.tcp_write_high_water = tcp_write_high_water
+            else:
+                self.print_error("tcp.write_high_water")
+
+    def parse_flow_control(self):
+        self.flow_window = DEFAULT_WINDOW_SIZE
+        self.flow_max_window = DEFAULT_MAX_WINDOW_SIZE
+        self.flow_max_queued = DEFAULT_MAX_QUEUED
+        if self.config.has_section("flow"):
+            flow_window = self.config["flow"].getint("window", fallback=DEFAULT_WINDOW_SIZE)
+            if flow_window and flow_window > 0:
+                self.flow_window = flow_window
+            else:
+                self.print_error("flow.window")
+
+            flow_max_window = self.config["flow"].getint("max_window", fallback=DEFAULT_MAX_WINDOW_SIZE)
+            if flow_max_window and flow_max_window > 0:
+                self.flow_max_window = flow_max_window
+            else:
+                self.print_error("flow.max_window")
+
+            flow_max_queued = self.config["flow"].getint("max_queued", fallback=DEFAULT_MAX_QUEUED)
+            # a stream following the flow control may have this much in flight
+            if flow_max_queued and flow_max_queued >= max(self.flow_max_window, INITIAL_WINDOW_SIZE):
+                self.flow_max_queued = flow_max_queued
+            else:
+                self.print_error("flow.max_queued", msg="Must be at least flow.max_window and {}.".format(INITIAL_WINDOW_SIZE))
 
     def parse_log(self):
         self.logLevel = logging.WARN 
         self.logFilename = None
+        self.traceSample = 1
         if self.config.has_section("log"):
             logLevelText = self.config["log"].get("level", fallback="WARNING").upper()
             if logLevelText in logging._nameToLevel:
@@ -86,6 +467,12 @@ class WSGWConfigParser(object):
                 else:
                     self.print_error("log.filename", msg="File not found!")
 
+            traceSample = self.config["log"].getint("trace_sample", fallback=1)
+            if traceSample and traceSample > 0:
+                self.traceSample = traceSample
+            else:
+                self.print_error("log.trace_sample", msg="Must be at least 1.")
+
     def finish(self):
         if self.failed:
             print("Please correct the configuration file! Exiting...")
@@ -99,13 +486,15 @@ class WSGWConfigParser(object):
 
         print("Invalid value for field \"{}\".{}".format(field, msgText))
 
-def setup_args_and_config(tool_name: str):
+def setup_args_and_config(tool_name: str, add_arguments: Union[Callable[[argparse.ArgumentParser], None], None] = None):
     parser = argparse.ArgumentParser(description='Websocket Gateway - {}'.format(tool_name))
     parser.add_argument('--config', dest='config', help='.ini file storing the configuration.')
+    if add_arguments:
+        add_arguments(parser)
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
     config.read(args.config)
 
-    return WSGWConfigParser(config)
+    return WSGWConfigParser(config, args)
 
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Union
+from wsgateway.log import log_internal, log_internal_warn
+from wsgateway.metrics import Histogram, MetricsWriter
+from wsgateway.tcp import remove_stale_socket
+
+if TYPE_CHECKING:
+    from wsgateway.config import WSGWConfigParser
+
+DEFAULT_LAG_INTERVAL = 0.1
+DEFAULT_LAG_WARN = 0.1
+DEFAULT_SLOW_CALLBACK = 0.05
+DEFAULT_PROFILE_SECONDS = 10.0
+DEFAULT_PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 300.0
+# lag and slow callbacks are logged at most this often, the metrics count all of them
+WARN_INTERVAL = 10.0
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# frames of a blocked event loop shown in the warning, innermost last
+SLOW_CALLBACK_FRAMES = 4
+
+def frame_label(frame):
+    code = frame.f_code
+    return "{} ({})".format(getattr(code, "co_qualname", code.co_name), os.path.basename(code.co_filename))
+
+def describe_blocking(frame):
+    """The innermost frames of a stack, up to the callback the event loop runs."""
+    labels = []
+    while frame is not None and len(labels) < SLOW_CALLBACK_FRAMES:
+        if frame.f_code.co_name == "_run" and os.path.basename(frame.f_code.co_filename) == "events.py":
+            break
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels)) or "the event loop"
+
+class Diagnostics(object):
+    """Watches the event loop of a tool and profiles it on demand.
+
+    Every `lag_interval` seconds a timer measures how late the loop runs it, the lag is
+    counted in `lag` and logged once it reaches `lag_warn`. Callbacks which block the loop
+    for `slow_callback` seconds or longer are logged with the code they were running, 0
+    turns this off: a timer of the loop beats every `slow_callback / 2` seconds and a
+    watchdog thread samples the stack of the loop once a beat is that late.
+
+    SIGUSR1 or a line with the number of seconds sent to the unix socket `profile_socket`
+    start the sampling profiler: a thread samples the stack of the event loop every
+    `profile_interval` seconds and writes the stacks with their sample counts to a file in
+    `profile_dir`, one line per stack as flame graph tools read them. The socket answers
+    with the path of the file once it is written."""
+    name: str
+    lag_interval: float
+    lag_warn: float
+    slow_callback: float
+    profile_seconds: float
+    profile_interval: float
+    profile_dir: str
+    profile_socket: Union[str, None]
+    lag: Histogram
+    lag_warnings: int
+    slow_callbacks: int
+    profiling: bool
+    warned: float
+    callback_warned: float
+    heartbeat: float
+
+    def __init__(self, name: str, lag_interval: float = DEFAULT_LAG_INTERVAL, lag_warn: float = DEFAULT_LAG_WARN, slow_callback: float = DEFAULT_SLOW_CALLBACK,
+            profile_seconds: float = DEFAULT_PROFILE_SECONDS, profile_interval: float = DEFAULT_PROFILE_INTERVAL, profile_dir: Union[str, None] = None, profile_socket: Union[str, None] = None):
+        self.name = name
+        self.lag_interval = lag_interval
+        self.lag_warn = lag_warn
+        self.slow_callback = slow_callback
+        self.profile_seconds = profile_seconds
+        self.profile_interval = profile_interval
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        self.profile_socket = profile_socket
+        self.lag = Histogram(LAG_BUCKETS)
+        self.lag_warnings = 0
+        self.slow_callbacks = 0
+        self.profiling = False
+        self.warned = 0.0
+        self.callback_warned = 0.0
+        self.heartbeat = 0.0
+
+    def for_worker(self, index: int):
+        """A copy for a worker process, listening on its own socket."""
+        worker = copy.copy(self)
+        worker.lag = Histogram(LAG_BUCKETS)
+        if self.profile_socket:
+            worker.profile_socket = "{}.{}".format(self.profile_socket, index)
+        return worker
+
+    async def start(self):
+        """Starts watching the running loop of this process."""
+        loop = asyncio.get_running_loop()
+        asyncio.ensure_future(self.watch_lag())
+        if self.slow_callback > 0:
+            self.heartbeat = time.monotonic()
+            asyncio.ensure_future(self.beat())
+            threading.Thread(target=self.watch_callbacks, args=(loop, threading.get_ident()), name="wsgw-watchdog", daemon=True).start()
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.ensure_future(self.profile(self.profile_seconds)))
+        except (NotImplementedError, RuntimeError) as e:
+            log_internal_warn("the profiler can't be started with SIGUSR1: {}".format(e))
+        if self.profile_socket:
+            remove_stale_socket(self.profile_socket)
+            await asyncio.start_unix_server(self.handle_profile_request, path=self.profile_socket)
+        log_internal("diagnostics of {} (pid {}) started".format(self.name, os.getpid()))
+
+    # loop lag
+
+    async def watch_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            now = loop.time()
+            lag = max(now - expected, 0.0)
+            self.lag.observe(lag)
+            if lag < self.lag_warn:
+                continue
+            self.lag_warnings += 1
+            if now - self.warned >= WARN_INTERVAL:
+                log_internal_warn("event loop of {} ran {:.0f} ms late, lagged {} times in total".format(self.name, lag * 1000, self.lag_warnings))
+                self.warned = now
+
+    # slow callbacks
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.slow_callback / 2)
+
+    def watch_callbacks(self, loop: asyncio.AbstractEventLoop, thread_id: int):
+        """Runs in the watchdog thread, counts a blocked loop once per heartbeat it delayed."""
+        interval = self.slow_callback / 2
+        reported = 0.0
+        while not loop.is_closed():
+            time.sleep(interval)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - interval
+            if blocked < self.slow_callback or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            self.slow_callbacks += 1
+            now = time.monotonic()
+            if now - self.callback_warned >= WARN_INTERVAL:
+                self.callback_warned = now
+                log_internal_warn("slow callback in {}: blocked the event loop for {:.0f} ms so far in {}, {} slow callbacks in total".format(self.name, blocked * 1000, describe_blocking(frame), self.slow_callbacks))
+
+    # profiling
+
+    def sample_stacks(self, thread_id: int, seconds: float):
+        """Runs in the profiler thread, counts the stacks of the thread `thread_id`."""
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            stacks[";".join(reversed(labels))] += 1
+            time.sleep(self.profile_interval)
+        return stacks
+
+    async def profile(self, seconds: float):
+        """Samples the event loop for `seconds` and returns the path of the profile, None if a profile is running already."""
+        if self.profiling:
+            log_internal_warn("a profile of {} is running already".format(self.name))
+            return None
+        self.profiling = True
+        seconds = min(max(seconds, self.profile_interval), MAX_PROFILE_SECONDS)
+        log_internal_warn("profiling {} (pid {}) for {:.1f}s".format(self.name, os.getpid(), seconds))
+
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        thread_id = threading.get_ident()
+
+        def sample():
+            try:
+                result = self.sample_stacks(thread_id, seconds)
+            except Exception as e:
+                loop.call_soon_threadsafe(done.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(done.set_result, result)
+
+        threading.Thread(target=sample, name="wsgw-profiler", daemon=True).start()
+        try:
+            stacks = await done
+        finally:
+            self.profiling = False
+
+        path = os.path.join(self.profile_dir, "wsgw-{}-{}-{}.folded".format(self.name, os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in stacks.most_common():
+                file.write("{} {}\n".format(stack, count))
+
+        # the loop waits in the selector while it has nothing to do
+        samples = sum(stacks.values())
+        idle = sum(count for stack, count in stacks.items() if stack.endswith("(selectors.py)"))
+        log_internal_warn("profile of {} samples written to {}, the event loop was busy in {:.0f}% of them".format(samples, path, 100 * (samples - idle) / max(samples, 1)))
+        return path
+
+    async def handle_profile_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = (await reader.readline()).decode(encoding="utf-8").strip()
+            try:
+                path = await self.profile(float(line) if line else self.profile_seconds)
+                answer = path or "error: a profile is running already"
+            except (ValueError, OSError) as e:
+                answer = "error: {}".format(e)
+            writer.write((answer + "\n").encode(encoding="utf-8"))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # metrics
+
+    def write_metrics(self, writer: MetricsWriter, **labels):
+        writer.metric("wsgw_event_loop_lag_seconds", "histogram", "How late the event loop ran a timer.")
+        writer.histogram("wsgw_event_loop_lag_seconds", self.lag, **labels)
+        writer.metric("wsgw_slow_callbacks_total", "counter", "Callbacks of the event loop which ran longer than the slow callback threshold.")
+        writer.sample("wsgw_slow_callbacks_total", self.slow_callbacks, **labels)
+
+def setup_diagnostics(config: WSGWConfigParser, name: str) -> Union[Diagnostics, None]:
+    if not config.diagnostics_enabled:
+        return None
+    return Diagnostics(name, config.diagnostics_lag_interval, config.diagnostics_lag_warn, config.diagnostics_slow_callback,
+        config.diagnostics_profile_seconds, config.diagnostics_profile_interval, config.diagnostics_profile_dir, config.diagnostics_profile_socket)
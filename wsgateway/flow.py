@@ -0,0 +1,161 @@
+import asyncio
+from typing import Union
+
+from wsgateway.messages import unpack_msg_data_len, unpack_msg_open_data_len, unpack_msg_window_update, MSG_TYPE_DATA, MSG_TYPE_OPEN, MSG_TYPE_DATA_COMPRESSED, MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_WINDOW_ACK
+
+DEFAULT_WINDOW_SIZE = 262144
+DEFAULT_MAX_WINDOW_SIZE = 4194304
+# the window every sender may use before the receiving end granted one
+INITIAL_WINDOW_SIZE = 65536
+# the most bytes the gateway or the provider hold for one direction of a stream, whether or
+# not its peers use flow control. a stream exceeding it is closed.
+DEFAULT_MAX_QUEUED = 16777216
+
+# Flow control works per stream and per direction. The receiving end of a direction grants
+# its window with a WINDOW_UPDATE right after the stream is opened and grants consumed bytes
+# again once they were written to the tcp connection. Until then the sender may send
+# INITIAL_WINDOW_SIZE bytes, which count against the first grant like in HTTP/2. The sender
+# answers the first grant with WINDOW_ACK and from then on only sends while it has credit
+# left. Peers that send data before granting a window don't use flow control and are not
+# limited, which keeps older clients and providers working.
+
+class SendWindow(object):
+    """Credit the sending end of a stream has left. It starts with the initial window,
+    `credit` is None once the peer turned out not to use flow control."""
+    __slots__ = ("credit", "granted", "sent", "waiter")
+    credit: Union[int, None]
+    granted: bool
+    sent: int
+    waiter: Union[asyncio.Future, None]
+
+    def __init__(self, initial_window: int = INITIAL_WINDOW_SIZE):
+        self.credit = initial_window
+        self.granted = False
+        self.sent = 0
+        self.waiter = None
+
+    def grant(self, increment: int):
+        """Returns True for the first grant, which has to be acknowledged with WINDOW_ACK."""
+        is_first_grant = not self.granted
+        if is_first_grant:
+            # everything sent before the first grant counts against the granted window
+            self.granted = True
+            self.credit = increment - self.sent
+        else:
+            self.credit += increment
+
+        if self.credit > 0:
+            self.wake()
+        return is_first_grant
+
+    def data_received(self):
+        """Called for data from the peer. A peer which sends data before granting a window
+        doesn't use flow control, the window stops limiting the sender."""
+        if not self.granted and self.credit is not None:
+            self.credit = None
+            self.wake()
+
+    def wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def limit(self, max_size: int):
+        return max_size if self.credit is None else min(self.credit, max_size)
+
+    def consume(self, size: int):
+        self.sent += size
+        if self.credit is not None:
+            self.credit -= size
+
+    async def wait(self):
+        while self.credit is not None and self.credit <= 0:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+class ReceiveWindow(object):
+    """The window the receiving end of a stream grants. Consumed bytes are granted back in
+    batches of at least half the window, so updates don't double the message rate."""
+    __slots__ = ("size", "consumed")
+    size: int
+    consumed: int
+
+    def __init__(self, size: int = DEFAULT_WINDOW_SIZE):
+        self.size = size
+        self.consumed = 0
+
+    def consume(self, size: int):
+        """Returns the increment to grant back, 0 if no update should be sent yet."""
+        self.consumed += size
+        if self.consumed < self.size // 2:
+            return 0
+        increment = self.consumed
+        self.consumed = 0
+        return increment
+
+class FlowDirection(object):
+    __slots__ = ("granted", "forwarded", "forwarded_before_grant", "credit")
+    granted: int
+    forwarded: int
+    forwarded_before_grant: int
+    credit: Union[int, None]
+
+    def __init__(self):
+        self.granted = 0
+        self.forwarded = 0
+        self.forwarded_before_grant = 0
+        self.credit = None
+
+class StreamFlowPolicer(object):
+    """Checks the messages of a stream relayed by the gateway against the windows granted by
+    its ends. A direction is policed once its sender acknowledged the first grant with
+    WINDOW_ACK. A sender which sent more than the initial window before the first grant, or
+    exceeds its credit from then on, or a receiver granting more than `max_window` at once
+    violates the protocol. This bounds the bytes the gateway holds per direction of a flow
+    controlled stream by the larger of `max_window` and the initial window."""
+    __slots__ = ("max_window", "to_provider", "to_client", "violated")
+    max_window: int
+    to_provider: FlowDirection
+    to_client: FlowDirection
+    violated: bool
+
+    def __init__(self, max_window: int = DEFAULT_MAX_WINDOW_SIZE):
+        self.max_window = max_window
+        self.to_provider = FlowDirection()
+        self.to_client = FlowDirection()
+        self.violated = False
+
+    def check_client_message(self, msg: bytes):
+        return self.check(msg, self.to_provider, self.to_client)
+
+    def check_provider_message(self, msg: bytes):
+        return self.check(msg, self.to_client, self.to_provider)
+
+    def check(self, msg: bytes, direction: FlowDirection, reverse_direction: FlowDirection):
+        """Returns False if the message violates the flow control of the stream. `direction`
+        is the one the message travels in."""
+        if msg[0] == MSG_TYPE_DATA or msg[0] == MSG_TYPE_DATA_COMPRESSED:
+            size = unpack_msg_data_len(msg)
+            direction.forwarded += size
+            if direction.credit is not None:
+                direction.credit -= size
+                self.violated = direction.credit < 0
+        elif msg[0] == MSG_TYPE_OPEN:
+            # the first data of the stream can be carried by the OPEN, before any grant
+            direction.forwarded += unpack_msg_open_data_len(msg)
+        elif msg[0] == MSG_TYPE_WINDOW_UPDATE:
+            increment = unpack_msg_window_update(msg)
+            if not reverse_direction.granted:
+                reverse_direction.forwarded_before_grant = reverse_direction.forwarded
+            reverse_direction.granted += increment
+            if reverse_direction.credit is not None:
+                reverse_direction.credit += increment
+            self.violated = increment > self.max_window
+        elif msg[0] == MSG_TYPE_WINDOW_ACK:
+            # everything the sender sent before the ack was forwarded already, the sender's
+            # own credit can't be larger than this
+            direction.credit = direction.granted - direction.forwarded
+            self.violated = direction.forwarded_before_grant > INITIAL_WINDOW_SIZE
+        return not self.violated
@@ -1,28 +1,141 @@
 from __future__ import annotations
 
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 import configparser
-from wsgateway.config import WSGWConfigParser
+from typing import TYPE_CHECKING, Union
+from wsgateway.messages import MSG_TYPE_DATA, MSG_TYPE_OPEN, MSG_TYPE_CLOSE, MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_WINDOW_ACK, MSG_TYPE_HELLO, MSG_TYPE_BATCH, MSG_TYPE_DATA_COMPRESSED, MSG_TYPE_COMPRESS_ACK, MSG_TYPE_OPEN_ACK, MSG_TYPE_OPEN_FAIL, MSG_TYPE_SESSION, MSG_TYPE_SESSION_ACK, MSG_TYPE_RESUME
+
+if TYPE_CHECKING:
+    # the config imports the defaults of modules which log
+    from wsgateway.config import WSGWConfigParser
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread as they are. Messages are formatted there and
+    not by the event loop which logged them, the arguments of a record must not change
+    after logging it."""
+    def prepare(self, record: logging.LogRecord):
+        return record
+
+log_listener: Union[logging.handlers.QueueListener, None] = None
+log_listener_pid = 0
 
 def setup_logging(config: WSGWConfigParser):
-    if config.logFilename:
-        logging.basicConfig(filename=config.logFilename, encoding='utf-8', level=config.logLevel)
+    configure_logging(config.logLevel, config.logFilename, config.traceSample)
+
+def configure_logging(level: int, filename: Union[str, None] = None, trace_sample: int = 1):
+    """Logs through a queue to a listener thread writing to the file or stderr, so writing
+    never blocks the event loop. Worker processes call this again after they started."""
+    global log_listener, log_listener_pid
+
+    if filename:
+        handler = logging.FileHandler(filename, encoding='utf-8')
     else:
-        logging.basicConfig(level=config.logLevel)
-    
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    stop_logging()
+    root = logging.getLogger()
+    for inherited_handler in [ h for h in root.handlers if isinstance(h, DeferredQueueHandler) ]:
+        root.removeHandler(inherited_handler)
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    if not log_listener_pid:
+        atexit.register(stop_logging)
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener_pid = os.getpid()
+    log_listener.start()
+
+    tracer.configure(trace_sample)
+
+def stop_logging():
+    """Writes the queued records and stops the listener thread. A forked process only has
+    a copy of the listener of its parent, which is left alone."""
+    global log_listener
+    if log_listener and log_listener_pid == os.getpid():
+        log_listener.stop()
+    log_listener = None
+
+# tracing
+
+MSG_TYPE_NAMES = {
+    MSG_TYPE_DATA: "data",
+    MSG_TYPE_OPEN: "open",
+    MSG_TYPE_CLOSE: "close",
+    MSG_TYPE_WINDOW_UPDATE: "window_update",
+    MSG_TYPE_WINDOW_ACK: "window_ack",
+    MSG_TYPE_HELLO: "hello",
+    MSG_TYPE_BATCH: "batch",
+    MSG_TYPE_DATA_COMPRESSED: "data_compressed",
+    MSG_TYPE_COMPRESS_ACK: "compress_ack",
+    MSG_TYPE_OPEN_ACK: "open_ack",
+    MSG_TYPE_OPEN_FAIL: "open_fail",
+    MSG_TYPE_SESSION: "session",
+    MSG_TYPE_SESSION_ACK: "session_ack",
+    MSG_TYPE_RESUME: "resume",
+}
+
+trace_logger = logging.getLogger("wsgateway.trace")
+
+class Tracer(object):
+    """Structured events for the frames relayed on the hot path.
+
+    Whether tracing is enabled is decided once in `configure`, call sites check `enabled`
+    before building anything. Only every `sample_every`-th frame is logged, with the
+    direction, stream id, message type and size as attributes of the record."""
+    __slots__ = ("enabled", "sample_every", "skipped")
+    enabled: bool
+    sample_every: int
+    skipped: int
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_every = 1
+        self.skipped = 0
+
+    def configure(self, sample_every: int = 1):
+        self.enabled = trace_logger.isEnabledFor(logging.INFO)
+        self.sample_every = max(sample_every, 1)
+        self.skipped = 0
+
+    def frame(self, direction: str, stream_id: int, msg_type: int, size: int):
+        self.skipped += 1
+        if self.skipped < self.sample_every:
+            return
+        self.skipped = 0
+
+        msg_type = MSG_TYPE_NAMES.get(msg_type, msg_type)
+        trace_logger.info("[%s] stream %d: %s, %s bytes", direction, stream_id, msg_type, size,
+            extra={ "direction": direction, "stream_id": stream_id, "msg_type": msg_type, "size": size })
+
+tracer = Tracer()
+
+# the text of the internal log functions is formatted with `args` like logging does, only
+# if the record is logged. per-stream call sites pass their values instead of formatting them.
+def log_internal_warn(text: str, *args):
+    logging.warning("[internal] " + text, *args)
 
-def log_internal_warn(text: str):
-    logging.warning("[internal] {}".format(text))
+def log_internal(text: str, *args):
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.root.debug("[internal] " + text, *args)
 
-def log_internal(text: str):
-    logging.debug("[internal] {}".format(text))
+def log_internal_enabled():
+    """Whether `log_internal` logs, for call sites which compute their values."""
+    return logging.root.isEnabledFor(logging.DEBUG)
 
-def log_inbound(text: str):
-    logging.info("[inbound]  {}".format(text))
+def log_inbound(text: str, *args):
+    if logging.root.isEnabledFor(logging.INFO):
+        logging.root.info("[inbound]  " + text, *args)
 
-def log_outbound(text: str):
-    logging.info("[outbound] {}".format(text))
+def log_outbound(text: str, *args):
+    if logging.root.isEnabledFor(logging.INFO):
+        logging.root.info("[outbound] " + text, *args)
 
 def log_outbound_msg_open_connection():
     log_outbound("MSG: open")
@@ -40,4 +153,4 @@ def log_inbound_msg_close_connection():
     log_inbound("MSG: close")
 
 def log_inbound_msg_data():
-    log_inbound("MSG: data")
\ No newline at end of file
+    log_inbound("MSG: data")
@@ -1,35 +1,256 @@
 import struct
+from typing import List, Tuple, Union
 
 MSG_TYPE_DATA = 0x00
 MSG_TYPE_OPEN = 0x01
 MSG_TYPE_CLOSE = 0x02
+MSG_TYPE_WINDOW_UPDATE = 0x03
+MSG_TYPE_WINDOW_ACK = 0x04
+MSG_TYPE_HELLO = 0x05
+MSG_TYPE_BATCH = 0x06
+MSG_TYPE_DATA_COMPRESSED = 0x07
+MSG_TYPE_COMPRESS_ACK = 0x08
+MSG_TYPE_OPEN_ACK = 0x09
+MSG_TYPE_OPEN_FAIL = 0x0A
+MSG_TYPE_SESSION = 0x0B
+MSG_TYPE_SESSION_ACK = 0x0C
+MSG_TYPE_RESUME = 0x0D
+
+# flags in the high bits of the second byte of OPEN, the low bits are the connection type.
+# the client accepts and offers compressed data.
+OPEN_FLAG_COMPRESS = 0x80
+# the OPEN carries the first data of the stream after the hostname
+OPEN_FLAG_DATA = 0x40
+OPEN_FLAGS_MASK = 0xF0
+
+# connection types in the low bits of the second byte of OPEN
+OPEN_TYPE_TCP = 0x00
+# every DATA of the stream is one datagram
+OPEN_TYPE_UDP = 0x01
+# the hostname is the path of a unix socket, the port is 0
+OPEN_TYPE_UNIX = 0x02
+OPEN_TYPE_MASK = 0x0F
+
+# reasons of an OPEN_FAIL
+OPEN_FAIL_ERROR = 0x01
+OPEN_FAIL_UNREACHABLE = 0x02
+OPEN_FAIL_REFUSED = 0x03
+OPEN_FAIL_TIMEOUT = 0x04
+
+# client id 0 is never given to a stream. Messages with it are meant for the link between
+# the provider and the gateway itself.
+CONTROL_STREAM_ID = 0
+
+# features offered in a HELLO, the answering HELLO carries the ones both ends use
+FEATURE_BATCH = 0x01
+# the gateway issues a session token, which lets the provider resume the link after it dropped
+FEATURE_RESUME = 0x02
+
+# results of a RESUME in the answer of the gateway
+RESUME_OK = 0x00
+# the session expired or is not known to this gateway
+RESUME_UNKNOWN = 0x01
+# messages the provider did not receive were dropped from the replay buffer
+RESUME_LOST = 0x02
+
+# payloads at least this large are not copied when a header is added or stripped.
+# copying smaller payloads is cheaper than creating a memoryview or an extra websocket frame.
+GATHER_MIN_SIZE = 16384
+
+def slice_payload(msg: bytes, start: int, end: int):
+    if end - start < GATHER_MIN_SIZE:
+        return msg[start:end]
+    return memoryview(msg)[start:end]
 
 def pack_msg_data(data: bytes):
     return struct.pack("!cI", bytes([MSG_TYPE_DATA]), len(data)) + data
 
-def pack_msg_open(hostname: str, port: int):
+def pack_msg_data_compressed(raw_len: int, compressed: bytes):
+    # the length is the one of the uncompressed data, flow control counts uncompressed bytes
+    return struct.pack("!cI", bytes([MSG_TYPE_DATA_COMPRESSED]), raw_len) + compressed
+
+def pack_msg_open(hostname: str, port: int, flags: int = 0, data: bytes = b"", connection_type: int = OPEN_TYPE_TCP):
     hostname_bin = hostname.encode(encoding="utf-8")
-    # 0 is reserved for udp connections
-    return struct.pack("!ccII", bytes([MSG_TYPE_OPEN]), bytes([0]), port, len(hostname_bin)) + hostname_bin
+    flags = (flags & OPEN_FLAGS_MASK) | connection_type
+    if not data:
+        return struct.pack("!ccII", bytes([MSG_TYPE_OPEN]), bytes([flags & ~OPEN_FLAG_DATA]), port, len(hostname_bin)) + hostname_bin
+    return struct.pack("!ccII", bytes([MSG_TYPE_OPEN]), bytes([flags | OPEN_FLAG_DATA]), port, len(hostname_bin)) + hostname_bin + struct.pack("!I", len(data)) + data
+
+def pack_msg_open_ack():
+    return struct.pack("!c", bytes([MSG_TYPE_OPEN_ACK]))
+
+def pack_msg_open_fail(reason: int, text: str = ""):
+    return struct.pack("!cB", bytes([MSG_TYPE_OPEN_FAIL]), reason) + text.encode(encoding="utf-8")
+
+def pack_msg_compress_ack():
+    return struct.pack("!c", bytes([MSG_TYPE_COMPRESS_ACK]))
 
 def pack_msg_close():
     return struct.pack("!c", bytes([MSG_TYPE_CLOSE]))
 
+def pack_msg_window_update(increment: int):
+    return struct.pack("!cI", bytes([MSG_TYPE_WINDOW_UPDATE]), increment)
+
+def pack_msg_window_ack():
+    return struct.pack("!c", bytes([MSG_TYPE_WINDOW_ACK]))
+
+def pack_msg_hello(features: int):
+    return struct.pack("!cI", bytes([MSG_TYPE_HELLO]), features)
+
+def unpack_msg_hello(data: bytes):
+    _, features = struct.unpack_from("!cI", data)
+    return features
+
+def pack_msg_session(token: bytes):
+    return struct.pack("!c", bytes([MSG_TYPE_SESSION])) + token
+
+def unpack_msg_session(data: bytes):
+    return bytes(data[1:])
+
+def pack_msg_session_ack(received_count: int):
+    return struct.pack("!cQ", bytes([MSG_TYPE_SESSION_ACK]), received_count)
+
+def unpack_msg_session_ack(data: bytes):
+    _, received_count = struct.unpack_from("!cQ", data)
+    return received_count
+
+def pack_msg_resume(received_count: int, token: bytes = b"", result: int = RESUME_OK):
+    """The provider sends its token, the gateway answers with the result and without a token.
+    Both send the number of session messages they received."""
+    return struct.pack("!cBQ", bytes([MSG_TYPE_RESUME]), result, received_count) + token
+
+def unpack_msg_resume(data: bytes):
+    """Returns the result, the number of received messages and the token."""
+    meta_size = struct.calcsize("!cBQ")
+    _, result, received_count = struct.unpack_from("!cBQ", data)
+    return result, received_count, bytes(data[meta_size:])
+
 def unpack_msg_data(data: bytes):
     meta_size = struct.calcsize("!cI")
-    _, data_len = struct.unpack("!cI", data[:meta_size])
-    return data[-data_len:]
+    _, data_len = struct.unpack_from("!cI", data)
+    return slice_payload(data, meta_size, meta_size + data_len)
+
+def unpack_msg_data_view(data: bytes):
+    """Like `unpack_msg_data`, but always a memoryview sharing the memory of `data`. A vectored
+    write copies its buffers once anyway, a slice would copy small payloads twice."""
+    meta_size = struct.calcsize("!cI")
+    _, data_len = struct.unpack_from("!cI", data)
+    return memoryview(data)[meta_size:meta_size + data_len]
+
+def unpack_msg_data_compressed(data: bytes):
+    """Returns the length of the uncompressed data and the compressed payload."""
+    meta_size = struct.calcsize("!cI")
+    _, raw_len = struct.unpack_from("!cI", data)
+    return raw_len, data[meta_size:]
+
+def unpack_msg_data_len(data: bytes):
+    _, data_len = struct.unpack_from("!cI", data)
+    return data_len
+
+def unpack_msg_window_update(data: bytes):
+    _, increment = struct.unpack_from("!cI", data)
+    return increment
 
 def unpack_msg_open(data: bytes):
     meta_size = struct.calcsize("!ccII")
-    _, _, port, hostname_len = struct.unpack("!ccII", data[:meta_size])
-    return data[-hostname_len:].decode(encoding="utf-8"), port
+    _, _, port, hostname_len = struct.unpack_from("!ccII", data)
+    return str(data[meta_size:meta_size + hostname_len], encoding="utf-8"), port
+
+def unpack_msg_open_flags(data: bytes):
+    return data[1] & OPEN_FLAGS_MASK
+
+def unpack_msg_open_type(data: bytes):
+    return data[1] & OPEN_TYPE_MASK
+
+def unpack_msg_open_data(data: bytes):
+    """Returns the first data of the stream carried by an OPEN, empty if there is none."""
+    if not data[1] & OPEN_FLAG_DATA:
+        return b""
+    meta_size = struct.calcsize("!ccII")
+    _, _, _, hostname_len = struct.unpack_from("!ccII", data)
+    data_len, = struct.unpack_from("!I", data, meta_size + hostname_len)
+    data_start = meta_size + hostname_len + 4
+    return data[data_start:data_start + data_len]
+
+def unpack_msg_open_data_len(data: bytes):
+    if not data[1] & OPEN_FLAG_DATA:
+        return 0
+    _, _, _, hostname_len = struct.unpack_from("!ccII", data)
+    data_len, = struct.unpack_from("!I", data, struct.calcsize("!ccII") + hostname_len)
+    return data_len
+
+def unpack_msg_open_fail(data: bytes):
+    """Returns the reason and the description of the error."""
+    _, reason = struct.unpack_from("!cB", data)
+    return reason, str(data[2:], encoding="utf-8", errors="replace")
+
+def pack_msg_provider_header(client_id: int, inner_msg_len: int):
+    return struct.pack("!II", client_id, inner_msg_len)
 
 def pack_msg_provider(client_id: int, inner_msg: bytes):
-    return struct.pack("!II", client_id, len(inner_msg)) + inner_msg
+    return pack_msg_provider_header(client_id, len(inner_msg)) + inner_msg
+
+def pack_msg_provider_gathered(client_id: int, inner_msg: bytes) -> Union[bytes, List[bytes]]:
+    """Like `pack_msg_provider`, but large inner messages are left untouched. The header and
+    the inner message are returned as a list, which websockets sends as a fragmented message."""
+    if len(inner_msg) < GATHER_MIN_SIZE:
+        return pack_msg_provider(client_id, inner_msg)
+    return [ pack_msg_provider_header(client_id, len(inner_msg)), inner_msg ]
+
+def frame_len(frame: Union[bytes, List[bytes], Tuple[int, bytes]]):
+    """Length of a message as returned by `pack_msg_provider` or `pack_msg_provider_gathered`.
+    Messages received on a version 2 link are counted like the provider message of version 1."""
+    if isinstance(frame, list):
+        return sum(len(part) for part in frame)
+    if isinstance(frame, tuple):
+        return 8 + len(frame[1])
+    return len(frame)
+
+def frame_stream_id(frame: Union[bytes, List[bytes]]) -> int:
+    """Client id of a message as returned by `pack_msg_provider` or `pack_msg_provider_gathered`."""
+    return struct.unpack_from("!I", frame[0] if isinstance(frame, list) else frame)[0]
+
+def unpack_msg_provider(msg: Union[bytes, Tuple[int, bytes]]):
+    """Returns the client id and the inner message. Large inner messages are returned as a memoryview sharing the memory of `msg`.
+    Messages received on a version 2 link are unpacked already."""
+    if isinstance(msg, tuple):
+        return msg
+    client_id, client_msg_len = struct.unpack_from("!II", msg)
+    client_msg = slice_payload(msg, 8, 8 + client_msg_len)
+
+    return client_id, client_msg
+
+def pack_msg_batch(frames: List[Union[bytes, List[bytes]]]) -> Union[bytes, List[bytes]]:
+    """Packs several provider messages into one, sent on the control stream. Small messages
+    are joined, the parts of gathered ones are passed on so their payloads aren't copied."""
+    parts = [ b"", bytes([MSG_TYPE_BATCH]) ]
+    joined = bytearray()
+    for frame in frames:
+        if isinstance(frame, list):
+            if joined:
+                parts.append(bytes(joined))
+                joined = bytearray()
+            parts.extend(frame)
+        else:
+            joined += frame
+    if joined:
+        parts.append(bytes(joined))
 
-def unpack_msg_provider(msg: bytes):
-    client_id, client_msg_len = struct.unpack("!II", msg[:8])
-    client_msg = msg[-client_msg_len:]
+    parts[0] = pack_msg_provider_header(CONTROL_STREAM_ID, sum(len(part) for part in parts))
+    if len(parts) == 3:
+        return parts[0] + parts[1] + parts[2]
+    return parts
 
-    return client_id, client_msg
\ No newline at end of file
+def iter_msg_batch(batch_msg: bytes):
+    """Yields the client id and the inner message of every provider message in the inner
+    message of a batch."""
+    is_view = isinstance(batch_msg, memoryview)
+    offset = 1
+    while offset < len(batch_msg):
+        client_id, client_msg_len = struct.unpack_from("!II", batch_msg, offset)
+        client_msg = slice_payload(batch_msg, offset + 8, offset + 8 + client_msg_len)
+        if is_view and client_msg_len < GATHER_MIN_SIZE:
+            # a large batch is itself a memoryview, small messages in it are copied as usual
+            client_msg = bytes(client_msg)
+        yield client_id, client_msg
+        offset += 8 + client_msg_len
@@ -0,0 +1,133 @@
+import asyncio
+import bisect
+import time
+from collections import deque
+from http import HTTPStatus
+from typing import Callable, List, Sequence, Union
+
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Histogram(object):
+    """Counts observations in fixed buckets, like a prometheus histogram."""
+    __slots__ = ("buckets", "counts", "sum", "count")
+    buckets: Sequence[float]
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction: float):
+        """The upper bound of the bucket reaching `fraction` of the observations, None without any."""
+        if not self.count:
+            return None
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= fraction * self.count:
+                return bucket
+        return float("inf")
+
+class TrafficCounter(object):
+    """Frames and bytes sent in one direction."""
+    __slots__ = ("frames", "bytes")
+    frames: int
+    bytes: int
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def add(self, size: int):
+        self.frames += 1
+        self.bytes += size
+
+class TimedQueue(asyncio.Queue):
+    """A queue recording how long its items waited in `wait_histogram`. Without a histogram
+    nothing is recorded."""
+    wait_histogram: Union[Histogram, None]
+    put_times: Union[deque, None]
+
+    def __init__(self, wait_histogram: Union[Histogram, None] = None):
+        super().__init__()
+        self.wait_histogram = wait_histogram
+        self.put_times = deque() if wait_histogram else None
+
+    def _put(self, item):
+        super()._put(item)
+        if self.put_times is not None:
+            self.put_times.append(time.monotonic())
+
+    def _get(self):
+        item = super()._get()
+        if self.put_times is not None:
+            self.wait_histogram.observe(time.monotonic() - self.put_times.popleft())
+        return item
+
+def format_labels(labels: dict):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels.items()) + "}"
+
+class MetricsWriter(object):
+    """Writes metrics in the prometheus text format."""
+    lines: List[str]
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name: str, metric_type: str, help_text: str):
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+
+    def sample(self, name: str, value: Union[int, float], **labels):
+        self.lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+    def histogram(self, name: str, histogram: Histogram, **labels):
+        cumulative = 0
+        for bucket, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.sample(name + "_bucket", cumulative, **labels, le=bucket)
+        self.sample(name + "_bucket", histogram.count, **labels, le="+Inf")
+        self.sample(name + "_sum", histogram.sum, **labels)
+        self.sample(name + "_count", histogram.count, **labels)
+
+    def render(self):
+        return ("\n".join(self.lines) + "\n").encode(encoding="utf-8")
+
+def render_metrics(collect: Callable[[MetricsWriter], None]):
+    writer = MetricsWriter()
+    collect(writer)
+    return writer.render()
+
+async def serve_metrics(collect: Callable[[MetricsWriter], None], host: str, port: int, path: str = "/metrics"):
+    """Serves the metrics written by `collect` over http, for tools without an http server of their own."""
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode(encoding="latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == path:
+                status, content_type, body = HTTPStatus.OK, CONTENT_TYPE, render_metrics(collect)
+            else:
+                status, content_type, body = HTTPStatus.NOT_FOUND, "text/plain", b"not found\n"
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status.value, status.phrase, content_type, len(body)).encode(encoding="latin-1") + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_request, host, port)
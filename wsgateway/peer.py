@@ -0,0 +1,53 @@
+import asyncio
+import os
+import struct
+from typing import List, Union
+
+class PeerLink(object):
+    """Length prefixed frames over a unix socket between two processes of the same tool.
+
+    It offers the `recv`, `send`, `close` and `open` members of a websocket, so the handlers
+    of websocket connections can serve a link as well. A list passed to `send` is written
+    as a single frame."""
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def open(self):
+        return not self.writer.is_closing()
+
+    async def recv(self):
+        frame_len, = struct.unpack("!I", await self.reader.readexactly(4))
+        return await self.reader.readexactly(frame_len)
+
+    async def send(self, frame: Union[bytes, List[bytes]]):
+        if isinstance(frame, list):
+            self.writer.write(struct.pack("!I", sum(len(part) for part in frame)))
+            self.writer.writelines(frame)
+        else:
+            self.writer.write(struct.pack("!I", len(frame)))
+            self.writer.write(frame)
+        await self.writer.drain()
+
+    async def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+async def open_peer_link(path: str, retry_interval: float = 0.1, retries: int = 100):
+    """Connects to the unix socket at `path`. The peer may still be starting, so connecting
+    is retried."""
+    for attempt in range(retries):
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+            return PeerLink(reader, writer)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if attempt == retries - 1:
+                raise
+            await asyncio.sleep(retry_interval)
+
+def peer_socket_path(run_dir: str, index: int):
+    return os.path.join(run_dir, "worker-{}.sock".format(index))
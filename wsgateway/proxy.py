@@ -0,0 +1,114 @@
+import ipaddress
+import struct
+from typing import Union
+
+from wsgateway.tcp import TCPStream
+from wsgateway.messages import OPEN_FAIL_UNREACHABLE, OPEN_FAIL_REFUSED, OPEN_FAIL_TIMEOUT
+
+SOCKS_VERSION = 0x05
+SOCKS_AUTH_NONE = 0x00
+SOCKS_AUTH_UNACCEPTABLE = 0xFF
+SOCKS_CMD_CONNECT = 0x01
+SOCKS_ATYP_IPV4 = 0x01
+SOCKS_ATYP_DOMAIN = 0x03
+SOCKS_ATYP_IPV6 = 0x04
+
+SOCKS_REPLY_SUCCEEDED = 0x00
+SOCKS_REPLY_FAILURE = 0x01
+SOCKS_REPLY_HOST_UNREACHABLE = 0x04
+SOCKS_REPLY_CONNECTION_REFUSED = 0x05
+SOCKS_REPLY_TTL_EXPIRED = 0x06
+SOCKS_REPLY_COMMAND_NOT_SUPPORTED = 0x07
+SOCKS_REPLY_ADDRESS_TYPE_NOT_SUPPORTED = 0x08
+
+# the reasons of an OPEN_FAIL as reply codes, other reasons are a general failure
+SOCKS_REPLIES = {
+    OPEN_FAIL_UNREACHABLE: SOCKS_REPLY_HOST_UNREACHABLE,
+    OPEN_FAIL_REFUSED: SOCKS_REPLY_CONNECTION_REFUSED,
+    OPEN_FAIL_TIMEOUT: SOCKS_REPLY_TTL_EXPIRED,
+}
+HTTP_REPLIES = {
+    OPEN_FAIL_TIMEOUT: b"HTTP/1.1 504 Gateway Timeout\r\n\r\n",
+}
+HTTP_REPLY_SUCCEEDED = b"HTTP/1.1 200 Connection established\r\n\r\n"
+HTTP_REPLY_FAILURE = b"HTTP/1.1 502 Bad Gateway\r\n\r\n"
+HTTP_MAX_HEADER_SIZE = 8192
+
+class ProxyError(Exception):
+    """The handshake of a proxy client failed, a reply was written already if the protocol has one."""
+
+class ProxyRequest(object):
+    """The destination requested by a SOCKS5 or HTTP CONNECT client. The client waits for
+    `reply` before it sends data."""
+    protocol: str
+    hostname: str
+    port: int
+
+    def __init__(self, protocol: str, hostname: str, port: int):
+        self.protocol = protocol
+        self.hostname = hostname
+        self.port = port
+
+    def reply(self, stream: TCPStream, failure: Union[int, None] = None):
+        """Tells the client that the destination was reached, or why not with the reason of an OPEN_FAIL."""
+        if self.protocol == "socks5":
+            code = SOCKS_REPLY_SUCCEEDED if failure is None else SOCKS_REPLIES.get(failure, SOCKS_REPLY_FAILURE)
+            write_socks_reply(stream, code)
+        elif failure is None:
+            stream.write(HTTP_REPLY_SUCCEEDED)
+        else:
+            stream.write(HTTP_REPLIES.get(failure, HTTP_REPLY_FAILURE))
+
+def write_socks_reply(stream: TCPStream, code: int):
+    # the address the provider bound to is not known here, clients don't use it for CONNECT
+    stream.write(struct.pack("!BBBBIH", SOCKS_VERSION, code, 0, SOCKS_ATYP_IPV4, 0, 0))
+
+async def accept_socks5(stream: TCPStream):
+    # the version was read already
+    methods_count, = await stream.read_exactly(1)
+    methods = await stream.read_exactly(methods_count)
+    if SOCKS_AUTH_NONE not in methods:
+        stream.write(bytes([ SOCKS_VERSION, SOCKS_AUTH_UNACCEPTABLE ]))
+        raise ProxyError("the client offers no authentication method without credentials")
+    stream.write(bytes([ SOCKS_VERSION, SOCKS_AUTH_NONE ]))
+
+    version, command, _, address_type = await stream.read_exactly(4)
+    if version != SOCKS_VERSION:
+        raise ProxyError("unsupported socks version {}".format(version))
+
+    if address_type == SOCKS_ATYP_IPV4:
+        hostname = str(ipaddress.IPv4Address(await stream.read_exactly(4)))
+    elif address_type == SOCKS_ATYP_IPV6:
+        hostname = str(ipaddress.IPv6Address(await stream.read_exactly(16)))
+    elif address_type == SOCKS_ATYP_DOMAIN:
+        hostname_len, = await stream.read_exactly(1)
+        hostname = str(await stream.read_exactly(hostname_len), encoding="utf-8", errors="replace")
+    else:
+        write_socks_reply(stream, SOCKS_REPLY_ADDRESS_TYPE_NOT_SUPPORTED)
+        raise ProxyError("unsupported address type {}".format(address_type))
+    port, = struct.unpack("!H", await stream.read_exactly(2))
+
+    if command != SOCKS_CMD_CONNECT:
+        write_socks_reply(stream, SOCKS_REPLY_COMMAND_NOT_SUPPORTED)
+        raise ProxyError("unsupported socks command {}".format(command))
+    return ProxyRequest("socks5", hostname, port)
+
+async def accept_http_connect(stream: TCPStream, first_byte: bytes):
+    header = str(first_byte + await stream.read_until(b"\r\n\r\n", HTTP_MAX_HEADER_SIZE), encoding="latin-1")
+    parts = header.split("\r\n", 1)[0].split()
+    if len(parts) != 3 or parts[0] != "CONNECT":
+        stream.write(b"HTTP/1.1 405 Method Not Allowed\r\nAllow: CONNECT\r\n\r\n")
+        raise ProxyError("not a CONNECT request: {}".format(" ".join(parts[:1])))
+
+    hostname, _, port = parts[1].rpartition(":")
+    if not hostname or not port.isdigit() or not 0 < int(port) < 65536:
+        stream.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        raise ProxyError("invalid CONNECT target {}".format(parts[1]))
+    return ProxyRequest("http", hostname.strip("[]"), int(port))
+
+async def accept_proxy_request(stream: TCPStream):
+    """Reads the request of a SOCKS5 or HTTP CONNECT client, told apart by their first byte."""
+    first_byte = await stream.read_exactly(1)
+    if first_byte[0] == SOCKS_VERSION:
+        return await accept_socks5(stream)
+    return await accept_http_connect(stream, first_byte)
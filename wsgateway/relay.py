@@ -0,0 +1,45 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Union
+
+# the most messages a gathered source takes at once, a vectored write takes at most 1024 buffers
+DEFAULT_GATHER_MESSAGES = 64
+
+async def pump(source: Callable[[], Awaitable[Any]], sink: Callable[[Any], Awaitable[Union[bool, None]]]):
+    """Moves messages from `source` to `sink` until the source returns None or the sink returns False.
+
+    A message taken from the source is always handed to the sink before the next one is
+    requested, so a stopping relay never loses a message that was already dequeued."""
+    while True:
+        message = await source()
+        if message is None:
+            return
+        if await sink(message) is False:
+            return
+
+def gathered(queue: asyncio.Queue, max_messages: int = DEFAULT_GATHER_MESSAGES) -> Callable[[], Awaitable[List[Any]]]:
+    """A source taking every message waiting in `queue` at once, up to `max_messages`, as a list.
+    It waits for the first one only, so the sink can handle the ones that arrived together in one go."""
+    async def source():
+        messages = [ await queue.get() ]
+        while len(messages) < max_messages and not queue.empty():
+            messages.append(queue.get_nowait())
+        return messages
+    return source
+
+async def run_relay(*pumps: Awaitable):
+    """Runs every pump in its own long-lived task until the first one finishes.
+
+    The remaining pumps are cancelled and awaited before returning. If the pump that
+    finished first raised an exception, it is raised again. Cancelling the relay cancels
+    all of its pumps."""
+    tasks = [ asyncio.ensure_future(p) for p in pumps ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in done:
+        if not task.cancelled() and task.exception():
+            raise task.exception()
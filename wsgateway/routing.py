@@ -0,0 +1,55 @@
+from typing import Any, Dict
+
+# stream ids are packed as "!I", 0 is the control stream and never allocated
+MAX_STREAM_ID = 0xFFFFFFFF
+
+class RoutingTable(object):
+    """Maps stream ids to the records of their streams.
+
+    A table belongs to a single event loop, so it is used without a lock and none of its
+    methods await. `allocate` hands out ids in increasing order and wraps around after
+    `max_id`, skipping ids still in use. A freed id is only reused after a full round, so
+    late messages of a closed stream don't reach a new one."""
+    __slots__ = ("routes", "next_id", "max_id")
+    routes: Dict[int, Any]
+    next_id: int
+    max_id: int
+
+    def __init__(self, max_id: int = MAX_STREAM_ID):
+        self.routes = {}
+        self.next_id = 1
+        self.max_id = max_id
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, stream_id: int):
+        return stream_id in self.routes
+
+    def get(self, stream_id: int):
+        return self.routes.get(stream_id)
+
+    def add(self, stream_id: int, record: Any):
+        self.routes[stream_id] = record
+
+    def allocate(self, record: Any):
+        """Adds `record` under a free id and returns the id."""
+        if len(self.routes) >= self.max_id:
+            raise OverflowError("no free stream id left")
+
+        stream_id = self.next_id
+        while stream_id in self.routes:
+            stream_id = stream_id % self.max_id + 1
+        self.next_id = stream_id % self.max_id + 1
+
+        self.routes[stream_id] = record
+        return stream_id
+
+    def remove(self, stream_id: int):
+        return self.routes.pop(stream_id, None)
+
+    def clear(self):
+        self.routes.clear()
+
+    def values(self):
+        return self.routes.values()
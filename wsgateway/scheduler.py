@@ -0,0 +1,200 @@
+import struct
+import time
+from collections import deque
+from typing import Deque, Dict, List, Tuple, Union
+
+from wsgateway.messages import frame_len, CONTROL_STREAM_ID, MSG_TYPE_OPEN, MSG_TYPE_OPEN_ACK, MSG_TYPE_OPEN_FAIL, MSG_TYPE_WINDOW_UPDATE
+
+DEFAULT_QUANTUM = 16384
+# a token bucket holds the bytes of this many seconds, but at least one quantum
+RATE_BURST_SECONDS = 0.1
+BUCKET_EXPIRY_INTERVAL = 1.0
+
+# Messages which may overtake the queued messages of their stream. A WINDOW_UPDATE grants
+# credit for the other direction, the others start a stream. All other messages of a stream
+# with queued messages wait behind them, the flow control of the gateway relies on their order.
+PRIORITY_TYPES = frozenset((MSG_TYPE_OPEN, MSG_TYPE_OPEN_ACK, MSG_TYPE_OPEN_FAIL, MSG_TYPE_WINDOW_UPDATE))
+
+STREAM_ID = struct.Struct("!I")
+
+Entry = Tuple[Union[bytes, List[bytes]], float]
+
+class TokenBucket(object):
+    """Limits a flow of messages to `rate` bytes per second. A message is sent as soon as
+    there are tokens left and may leave the bucket in debt, so messages larger than the
+    burst are not stuck."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, min_burst: float = DEFAULT_QUANTUM):
+        self.rate = rate
+        self.burst = max(rate * RATE_BURST_SECONDS, min_burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def delay(self, now: float):
+        """Seconds until there are tokens, 0 if there are some."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens > 0 else -self.tokens / self.rate
+
+    def take(self, size: int):
+        self.tokens -= size
+
+class StreamLane(object):
+    """The queued messages of one stream."""
+    __slots__ = ("entries", "deficit", "bucket")
+    entries: Deque[Entry]
+    deficit: int
+    bucket: Union[TokenBucket, None]
+
+    def __init__(self, bucket: Union[TokenBucket, None]):
+        self.entries = deque()
+        self.deficit = 0
+        self.bucket = bucket
+
+class StreamScheduler(object):
+    """Orders the provider messages of a link shared by several streams.
+
+    Streams take turns with deficit round-robin: on its turn a stream may send `quantum` bytes
+    more than it is owed, so a stream with large messages can't delay one with small messages
+    by more than a round. A stream which had nothing queued takes the next turn. Messages of
+    `PRIORITY_TYPES` and control messages skip the round in a FIFO priority lane.
+
+    With `stream_rate` every stream is limited to that many bytes per second, `link_bucket`
+    limits all streams of the link and can be shared by several links. The priority lane is
+    counted against `link_bucket` but not limited by it.
+
+    Entries are the message and the time it was queued. Idle streams have no lane, so the
+    scheduler costs nothing per stream which has nothing queued."""
+    __slots__ = ("quantum", "stream_rate", "link_bucket", "priority", "lanes", "active", "size", "stream_buckets", "buckets_expired")
+    quantum: int
+    stream_rate: float
+    link_bucket: Union[TokenBucket, None]
+    priority: Deque[Entry]
+    lanes: Dict[int, StreamLane]
+    active: Deque[int]
+    size: int
+    # buckets of streams whose lanes ran empty, kept until they are full again
+    stream_buckets: Dict[int, TokenBucket]
+    buckets_expired: float
+
+    def __init__(self, quantum: int = DEFAULT_QUANTUM, stream_rate: float = 0, link_bucket: Union[TokenBucket, None] = None):
+        self.quantum = quantum
+        self.stream_rate = stream_rate
+        self.link_bucket = link_bucket
+        self.priority = deque()
+        self.lanes = {}
+        self.active = deque()
+        self.size = 0
+        self.stream_buckets = {}
+        self.buckets_expired = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        yield from (frame for frame, _ in self.priority)
+        for stream_id in self.active:
+            yield from (frame for frame, _ in self.lanes[stream_id].entries)
+
+    def push(self, frame: Union[bytes, List[bytes]], put_time: float = 0.0, front: bool = False):
+        """Queues a message, `front` puts a message that was taken back in front of its lane."""
+        if isinstance(frame, list):
+            stream_id, = STREAM_ID.unpack_from(frame[0])
+            msg_type = frame[1][0]
+        else:
+            stream_id, = STREAM_ID.unpack_from(frame)
+            msg_type = frame[8]
+        self.size += 1
+
+        if stream_id == CONTROL_STREAM_ID or msg_type in PRIORITY_TYPES:
+            if front:
+                self.priority.appendleft((frame, put_time))
+            else:
+                self.priority.append((frame, put_time))
+            return
+
+        lane = self.lanes.get(stream_id)
+        if lane is None:
+            # a stream which had nothing queued takes the next turn, which keeps the latency
+            # of interactive streams low while others have messages queued
+            lane = self.lanes[stream_id] = StreamLane(self.stream_bucket(stream_id))
+            self.active.appendleft(stream_id)
+        if front:
+            lane.entries.appendleft((frame, put_time))
+        else:
+            lane.entries.append((frame, put_time))
+
+    def stream_bucket(self, stream_id: int):
+        if not self.stream_rate:
+            return None
+        bucket = self.stream_buckets.pop(stream_id, None)
+        return bucket or TokenBucket(self.stream_rate, self.quantum)
+
+    def delay(self):
+        """Seconds until a message may be sent, 0 if one may be sent now and None if none is queued."""
+        if self.priority:
+            return 0.0
+        if not self.active:
+            return None
+        now = time.monotonic()
+        link_delay = self.link_bucket.delay(now) if self.link_bucket else 0.0
+        if not self.stream_rate:
+            return link_delay
+        return max(link_delay, min(self.lanes[stream_id].bucket.delay(now) for stream_id in self.active))
+
+    def pop(self) -> Entry:
+        """Takes the next message, `delay` has to be 0."""
+        self.size -= 1
+        if self.priority:
+            entry = self.priority.popleft()
+            if self.link_bucket:
+                self.link_bucket.take(frame_len(entry[0]))
+            return entry
+
+        now = time.monotonic()
+        while True:
+            stream_id = self.active[0]
+            lane = self.lanes[stream_id]
+            if lane.bucket and lane.bucket.delay(now) > 0:
+                self.active.rotate(-1)
+                continue
+            size = frame_len(lane.entries[0][0])
+            if lane.deficit < size:
+                # a new turn of the stream
+                lane.deficit += self.quantum
+                if lane.deficit < size:
+                    self.active.rotate(-1)
+                    continue
+
+            entry = lane.entries.popleft()
+            lane.deficit -= size
+            if lane.bucket:
+                lane.bucket.take(size)
+            if self.link_bucket:
+                self.link_bucket.take(size)
+
+            if not lane.entries:
+                self.active.popleft()
+                del self.lanes[stream_id]
+                if lane.bucket and lane.bucket.tokens < lane.bucket.burst:
+                    self.stream_buckets[stream_id] = lane.bucket
+                    self.expire_stream_buckets(now)
+            elif lane.deficit < frame_len(lane.entries[0][0]):
+                # the turn is over
+                self.active.rotate(-1)
+            return entry
+
+    def expire_stream_buckets(self, now: float):
+        # a full bucket is the same as a new one
+        if now - self.buckets_expired < BUCKET_EXPIRY_INTERVAL:
+            return
+        self.buckets_expired = now
+        for stream_id, bucket in list(self.stream_buckets.items()):
+            bucket.delay(now)
+            if bucket.tokens >= bucket.burst:
+                del self.stream_buckets[stream_id]
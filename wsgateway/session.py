@@ -0,0 +1,94 @@
+import os
+import struct
+from collections import deque
+from typing import Deque, List, Tuple, Union
+
+from wsgateway.messages import frame_len, CONTROL_STREAM_ID, MSG_TYPE_BATCH
+
+DEFAULT_RESUME_TIMEOUT = 30.0
+DEFAULT_REPLAY_BUFFER = 4194304
+# a SESSION_ACK is sent once this many messages or bytes were received since the last one
+ACK_INTERVAL_MESSAGES = 32
+ACK_INTERVAL_BYTES = 262144
+TOKEN_SIZE = 16
+# delays between the attempts to resume a session
+RESUME_BACKOFF_MIN = 0.1
+RESUME_BACKOFF_MAX = 5.0
+
+def new_token():
+    return os.urandom(TOKEN_SIZE)
+
+def is_session_message(frame: Union[bytes, List[bytes], Tuple[int, bytes]]):
+    """Messages of streams and batches of them belong to the session. Other messages on the
+    control stream belong to the link and are neither counted nor replayed."""
+    if isinstance(frame, tuple):
+        return frame[0] != CONTROL_STREAM_ID or frame[1][0] == MSG_TYPE_BATCH
+    header = frame[0] if isinstance(frame, list) else frame
+    stream_id, = struct.unpack_from("!I", header)
+    if stream_id != CONTROL_STREAM_ID:
+        return True
+    return (frame[1][0] if isinstance(frame, list) else frame[8]) == MSG_TYPE_BATCH
+
+class LinkSession(object):
+    """One end of a link between provider and gateway which survives reconnects.
+
+    Both ends count the session messages they send and receive. Sent messages are kept until
+    the peer acknowledges them with a SESSION_ACK, up to `max_replay_bytes`; older ones are
+    dropped, which makes resuming fail if the peer misses them. After a reconnect each end
+    tells the number of messages it received and the other one sends the rest again."""
+    __slots__ = ("token", "sent_count", "received_count", "acked_count", "unacked_bytes", "replay", "replay_bytes", "max_replay_bytes")
+    token: Union[bytes, None]
+    sent_count: int
+    received_count: int
+    acked_count: int
+    unacked_bytes: int
+    replay: Deque[Union[bytes, List[bytes]]]
+    replay_bytes: int
+    max_replay_bytes: int
+
+    def __init__(self, max_replay_bytes: int = DEFAULT_REPLAY_BUFFER, token: Union[bytes, None] = None):
+        self.token = token
+        self.sent_count = 0
+        self.received_count = 0
+        self.acked_count = 0
+        self.unacked_bytes = 0
+        self.replay = deque()
+        self.replay_bytes = 0
+        self.max_replay_bytes = max_replay_bytes
+
+    def sent(self, frame: Union[bytes, List[bytes]]):
+        self.sent_count += 1
+        if self.max_replay_bytes <= 0:
+            return
+        self.replay.append(frame)
+        self.replay_bytes += frame_len(frame)
+        while self.replay_bytes > self.max_replay_bytes:
+            self.replay_bytes -= frame_len(self.replay.popleft())
+
+    def received(self, size: int):
+        """Counts a received message, returns True if a SESSION_ACK is due."""
+        self.received_count += 1
+        self.unacked_bytes += size
+        if self.received_count - self.acked_count < ACK_INTERVAL_MESSAGES and self.unacked_bytes < ACK_INTERVAL_BYTES:
+            return False
+        self.acked_count = self.received_count
+        self.unacked_bytes = 0
+        return True
+
+    def acknowledged(self, received_count: int):
+        # the messages before the oldest one kept were acknowledged or dropped
+        for _ in range(min(received_count - (self.sent_count - len(self.replay)), len(self.replay))):
+            self.replay_bytes -= frame_len(self.replay.popleft())
+
+    def replay_after(self, received_count: int):
+        """The messages sent after the first `received_count` ones, None if some of them were dropped."""
+        first_kept = self.sent_count - len(self.replay)
+        if received_count < first_kept or received_count > self.sent_count:
+            return None
+        self.acknowledged(received_count)
+        return list(self.replay)
+
+    def disable_replay(self):
+        self.max_replay_bytes = 0
+        self.replay.clear()
+        self.replay_bytes = 0
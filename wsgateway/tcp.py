@@ -0,0 +1,278 @@
+import asyncio
+import os
+import stat
+from typing import Awaitable, Callable, Dict, List, Union
+
+DEFAULT_MIN_READ_SIZE = 4096
+DEFAULT_MAX_READ_SIZE = 262144
+DEFAULT_HIGH_WATER = 1048576
+DEFAULT_WRITE_HIGH_WATER = 262144
+# read buffers which are not in use are kept for the next read, at most this many of every size
+MAX_FREE_READ_BUFFERS = 4
+# addresses of unix sockets in the config start with this
+UNIX_ADDRESS_PREFIX = "unix:"
+
+def unix_address_path(address: str):
+    """The path of a `unix:` address, None for other addresses."""
+    if address.startswith(UNIX_ADDRESS_PREFIX):
+        return address[len(UNIX_ADDRESS_PREFIX):]
+    return None
+
+# free read buffers of all streams, by size
+free_read_buffers: Dict[int, List[bytearray]] = {}
+
+def take_read_buffer(size: int):
+    buffers = free_read_buffers.get(size)
+    return buffers.pop() if buffers else bytearray(size)
+
+def give_back_read_buffer(buffer: bytearray):
+    buffers = free_read_buffers.setdefault(len(buffer), [])
+    if len(buffers) < MAX_FREE_READ_BUFFERS:
+        buffers.append(buffer)
+
+class TCPStream(asyncio.BufferedProtocol):
+    """A tcp connection, read frame by frame by the relay and written like a `StreamWriter`.
+
+    Received bytes are collected in a buffer until `read` takes them, so everything that
+    arrived in the meantime is coalesced into one frame. The size of the buffer handed to
+    the transport doubles whenever a read fills it, up to `max_read_size`, and shrinks again
+    after small reads. Reading from the socket is paused while more than `high_water` bytes
+    wait to be taken and resumed once the buffer is drained to half of that.
+
+    The buffer handed to the transport is taken from the free buffers of all streams and
+    given back as soon as the read is done, so an idle stream holds no buffer. Instead of
+    waiting in a task, a reader can be called back with `on_readable` whenever bytes arrive
+    or the connection reaches eof.
+
+    Writes are buffered by the transport, writers only have to drain once more than
+    `write_high_water` bytes are waiting to be sent."""
+    __slots__ = ("transport", "min_read_size", "max_read_size", "high_water", "write_high_water", "read_size", "read_buffer", "pending", "eof", "lost",
+        "reading_paused", "read_waiter", "on_readable", "writing_paused", "drain_waiter", "closed")
+    transport: Union[asyncio.Transport, None]
+    min_read_size: int
+    max_read_size: int
+    high_water: int
+    write_high_water: int
+    read_size: int
+    read_buffer: Union[bytearray, None]
+    pending: bytearray
+    eof: bool
+    lost: bool
+    reading_paused: bool
+    read_waiter: Union[asyncio.Future, None]
+    on_readable: Union[Callable[[], None], None]
+    writing_paused: bool
+    drain_waiter: Union[asyncio.Future, None]
+    closed: Union[asyncio.Future, None]
+
+    def __init__(self, max_read_size: int = DEFAULT_MAX_READ_SIZE, high_water: int = DEFAULT_HIGH_WATER, write_high_water: int = DEFAULT_WRITE_HIGH_WATER):
+        self.transport = None
+        self.min_read_size = min(DEFAULT_MIN_READ_SIZE, max_read_size)
+        self.max_read_size = max_read_size
+        self.high_water = high_water
+        self.write_high_water = write_high_water
+        self.read_size = self.min_read_size
+        self.read_buffer = None
+        self.pending = bytearray()
+        self.eof = False
+        self.lost = False
+        self.reading_paused = False
+        self.read_waiter = None
+        self.on_readable = None
+        self.writing_paused = False
+        self.drain_waiter = None
+        self.closed = None
+
+    # protocol callbacks
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.write_high_water)
+
+    def get_buffer(self, sizehint: int):
+        # a read which found nothing to read keeps its buffer for the next one
+        if self.read_buffer is None:
+            self.read_buffer = take_read_buffer(self.read_size)
+        return self.read_buffer
+
+    def buffer_updated(self, nbytes: int):
+        self.pending += memoryview(self.read_buffer)[:nbytes]
+        self.release_read_buffer()
+
+        if nbytes == self.read_size and self.read_size < self.max_read_size:
+            self.read_size = min(self.read_size * 2, self.max_read_size)
+        elif nbytes < self.read_size // 4 and self.read_size > self.min_read_size:
+            self.read_size = max(self.read_size // 2, self.min_read_size)
+
+        if len(self.pending) > self.high_water and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+        self._wake_reader()
+
+    def eof_received(self):
+        self.eof = True
+        self.release_read_buffer()
+        self._wake_reader()
+        return False
+
+    def connection_lost(self, exc: Union[Exception, None]):
+        self.eof = True
+        self.lost = True
+        self.release_read_buffer()
+        self._wake_reader()
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(ConnectionResetError("Connection lost"))
+        if self.closed and not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def _wake_reader(self):
+        if self.read_waiter and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+        if self.on_readable:
+            self.on_readable()
+
+    def release_read_buffer(self):
+        if self.read_buffer is not None:
+            give_back_read_buffer(self.read_buffer)
+            self.read_buffer = None
+
+    # reading
+
+    async def _wait_received(self):
+        self.read_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self.read_waiter
+        finally:
+            self.read_waiter = None
+
+    async def wait_readable(self):
+        """Waits until bytes are buffered or the connection is at eof."""
+        while not self.pending and not self.eof:
+            await self._wait_received()
+
+    async def read_exactly(self, size: int):
+        """Returns the next `size` bytes, for reading the handshakes of protocols. Raises
+        `asyncio.IncompleteReadError` if the connection reaches eof before."""
+        while len(self.pending) < size:
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.pending), size)
+            await self._wait_received()
+        return self.read_nowait(size)
+
+    async def read_until(self, separator: bytes, limit: int):
+        """Returns the bytes up to and including `separator`. Raises `asyncio.LimitOverrunError`
+        if it isn't found within `limit` bytes."""
+        while True:
+            end = self.pending.find(separator, 0, limit)
+            if end >= 0:
+                return self.read_nowait(end + len(separator))
+            if len(self.pending) >= limit:
+                raise asyncio.LimitOverrunError("separator not found within {} bytes".format(limit), len(self.pending))
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.pending), None)
+            await self._wait_received()
+
+    async def read(self, max_size: Union[int, None] = None):
+        """Returns all buffered bytes, at most `max_size` or `max_read_size` of them. Returns None at eof."""
+        await self.wait_readable()
+        return self.read_nowait(max_size)
+
+    def read_nowait(self, max_size: Union[int, None] = None):
+        """Like `read`, but returns an empty bytes object if nothing is buffered yet."""
+        if not self.pending:
+            return None if self.eof else b""
+
+        max_size = max_size or self.max_read_size
+        # copied once through a view, which has to be released before the buffer is resized
+        with memoryview(self.pending) as view:
+            data = bytes(view[:max_size])
+        del self.pending[:max_size]
+
+        if self.reading_paused and len(self.pending) <= self.high_water // 2:
+            self.reading_paused = False
+            if not self.transport.is_closing():
+                self.transport.resume_reading()
+
+        return data
+
+    # writing
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    def writelines(self, chunks: List[Union[bytes, memoryview]]):
+        """Writes all chunks with one vectored send where the event loop supports it."""
+        self.transport.writelines(chunks)
+
+    def needs_drain(self):
+        """Whether `drain` would wait or raise, writes below the high-water mark don't need one."""
+        return self.writing_paused or self.lost
+
+    async def drain(self):
+        if self.lost:
+            raise ConnectionResetError("Connection lost")
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.drain_waiter
+            finally:
+                self.drain_waiter = None
+
+    def is_closing(self):
+        return self.transport is None or self.transport.is_closing()
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    async def wait_closed(self):
+        if self.lost:
+            return
+        if self.closed is None:
+            self.closed = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self.closed)
+
+async def open_tcp_stream(host: str, port: int, **kwargs):
+    _, stream = await asyncio.get_running_loop().create_connection(lambda: TCPStream(**kwargs), host, port)
+    return stream
+
+async def open_unix_stream(path: str, **kwargs):
+    """Like `open_tcp_stream`, for a unix socket."""
+    _, stream = await asyncio.get_running_loop().create_unix_connection(lambda: TCPStream(**kwargs), path)
+    return stream
+
+def stream_factory(handler: Callable[[TCPStream], Awaitable], **kwargs):
+    def create_stream():
+        stream = TCPStream(**kwargs)
+        loop = asyncio.get_running_loop()
+        # the transport calls connection_made with call_soon after this factory returns.
+        # creating the task one iteration later makes sure the handler starts after it.
+        loop.call_soon(lambda: loop.create_task(handler(stream)))
+        return stream
+    return create_stream
+
+async def start_tcp_server(handler: Callable[[TCPStream], Awaitable], host: str, port: int, **kwargs):
+    """Like `asyncio.start_server`, but `handler` is called with a `TCPStream`."""
+    return await asyncio.get_running_loop().create_server(stream_factory(handler, **kwargs), host, port)
+
+async def start_unix_server(handler: Callable[[TCPStream], Awaitable], path: str, **kwargs):
+    """Like `start_tcp_server`, listening on the unix socket `path`. A socket left behind by
+    an earlier process is replaced."""
+    remove_stale_socket(path)
+    return await asyncio.get_running_loop().create_unix_server(stream_factory(handler, **kwargs), path)
+
+def remove_stale_socket(path: str):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
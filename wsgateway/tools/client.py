@@ -1,109 +1,490 @@
 import asyncio
-import socket
-import struct
-import logging
 import websockets
-import os
-import json
-from wsgateway.messages import pack_msg_close, pack_msg_data, pack_msg_open, unpack_msg_data, MSG_TYPE_CLOSE, MSG_TYPE_DATA
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Union
+from wsgateway.messages import pack_msg_close, pack_msg_open, pack_msg_provider, unpack_msg_provider, MSG_TYPE_DATA, MSG_TYPE_DATA_COMPRESSED, MSG_TYPE_CLOSE, OPEN_FLAG_COMPRESS, OPEN_TYPE_TCP, OPEN_TYPE_UDP, OPEN_TYPE_UNIX, OPEN_FAIL_ERROR, OPEN_FAIL_TIMEOUT
 from wsgateway.log import *
-from wsgateway.utils import read_into_queue
+from wsgateway.utils import TCPStreamEndpoint
+from wsgateway.flow import DEFAULT_WINDOW_SIZE
+from wsgateway.tcp import TCPStream, start_tcp_server, start_unix_server, unix_address_path
+from wsgateway.relay import gathered, pump, run_relay
+from wsgateway.routing import RoutingTable
+from wsgateway.batch import FrameQueue
+from wsgateway.scheduler import StreamScheduler, TokenBucket
+from wsgateway.diagnostics import Diagnostics, setup_diagnostics
+from wsgateway.udp import DatagramFlow, MAX_PENDING_DATAGRAMS, expire_flows
+from wsgateway.proxy import ProxyError, ProxyRequest, accept_proxy_request
+from wsgateway.wire import subprotocols, wire_link
 from wsgateway.config import setup_args_and_config
 
 # config
 
 REMOTE_PORT = 0
 REMOTE_HOSTNAME = ""
+# the hostname of a unix socket target is its path
+REMOTE_TYPE = OPEN_TYPE_TCP
 
 GATEWAY_URL_FULL = ""
 GATEWAY_PW = ""
+PROTOCOL_VERSION = 1
 
 CLIENT_PORT = 0
+CLIENT_UNIX_PATH = None
+CLIENT_MULTIPLEX = False
+CLIENT_CONNECTIONS = 1
+CLIENT_POOL_SIZE = 0
+CLIENT_FAST_OPEN = True
+CLIENT_PROTOCOL = "tcp"
+UDP_IDLE_TIMEOUT = 0.0
 
-async def handle_client(reader, writer):
-    log_internal("opening the websocket connection")
-    websocket = await websockets.connect(GATEWAY_URL_FULL)
+TCP_MAX_READ_SIZE = 0
+TCP_HIGH_WATER = 0
+TCP_WRITE_HIGH_WATER = 0
+FLOW_WINDOW = DEFAULT_WINDOW_SIZE
+COMPRESSION_LEVEL = None
+# permessage-deflate of the websocket, turned off when the payloads are compressed already
+WEBSOCKET_COMPRESSION = "deflate"
+
+SCHEDULER_ENABLED = True
+SCHEDULER_QUANTUM = 0
+SCHEDULER_STREAM_RATE = 0
+SCHEDULER_PROVIDER_RATE = 0
+DIAGNOSTICS: Union[Diagnostics, None] = None
+
+# data buffered when the stream is opened is sent along with the OPEN, up to this size
+FAST_OPEN_MAX_SIZE = 16384
+# how long the OPEN waits for that data, targets which speak first wait this long in vain
+FAST_OPEN_WAIT = 0.001
+
+# proxy clients are answered once the provider answered the OPEN. A provider which answered
+# an OPEN before gets OPEN_ANSWER_TIMEOUT seconds, others are assumed to be too old to answer
+# and to have reached the destination after LEGACY_OPEN_WAIT seconds.
+OPEN_ANSWER_TIMEOUT = 30.0
+LEGACY_OPEN_WAIT = 1.0
+PROXY_HANDSHAKE_TIMEOUT = 10.0
+
+async def connect_gateway():
+    websocket = await websockets.connect(GATEWAY_URL_FULL, compression=WEBSOCKET_COMPRESSION, subprotocols=subprotocols(PROTOCOL_VERSION))
     log_outbound("logging in")
     await websocket.send(GATEWAY_PW.encode(encoding="utf-8"))
-    log_outbound_msg_open_connection()
-    await websocket.send(pack_msg_open(REMOTE_HOSTNAME, REMOTE_PORT))
+    return wire_link(websocket, CLIENT_MULTIPLEX or CLIENT_PROTOCOL == "udp")
+
+class WebsocketPool(object):
+    """Websockets to the gateway which are connected and logged in before a client needs
+    them. `acquire` takes one of them and connects a replacement in the background, with
+    none ready it connects one itself."""
+    size: int
+    websockets: Deque[websockets.WebSocketClientProtocol]
+    connecting: int
+
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.websockets = deque()
+        self.connecting = 0
+
+    async def acquire(self):
+        while self.websockets:
+            websocket = self.websockets.popleft()
+            if websocket.open:
+                self.refill()
+                return websocket
+        self.refill()
+        return await connect_gateway()
+
+    def refill(self):
+        for _ in range(self.size - len(self.websockets) - self.connecting):
+            self.connecting += 1
+            asyncio.create_task(self.prewarm())
+
+    async def prewarm(self):
+        try:
+            websocket = await connect_gateway()
+        except (OSError, websockets.WebSocketException, asyncio.TimeoutError) as e:
+            log_internal("could not connect a websocket ahead of time: %s", str(e) or "timeout")
+            return
+        finally:
+            self.connecting -= 1
+        self.websockets.append(websocket)
+
+websocket_pool: WebsocketPool = None
+# limits the traffic to the provider over all multiplexed connections
+provider_bucket: Union[TokenBucket, None] = None
+
+def send_scheduler():
+    global provider_bucket
+    if not SCHEDULER_ENABLED:
+        return None
+    if SCHEDULER_PROVIDER_RATE and not provider_bucket:
+        provider_bucket = TokenBucket(SCHEDULER_PROVIDER_RATE, SCHEDULER_QUANTUM)
+    return StreamScheduler(SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, provider_bucket)
+
+class MultiplexedConnection(object):
+    """A single authenticated websocket carrying many streams, each tagged with a stream id."""
+    websocket: websockets.WebSocketClientProtocol
+    send_queue: FrameQueue
+    stream_queues: RoutingTable
+
+    def __init__(self, websocket: websockets.WebSocketClientProtocol):
+        self.websocket = websocket
+        self.send_queue = FrameQueue(scheduler=send_scheduler())
+        self.stream_queues = RoutingTable()
+
+    def create_stream(self):
+        queue = asyncio.Queue()
+        return self.stream_queues.allocate(queue), queue
+
+    def remove_stream(self, stream_id: int):
+        self.stream_queues.remove(stream_id)
 
-    reader_closed = asyncio.Event()
-    reader_queue = asyncio.Queue()
-    asyncio.create_task(read_into_queue(reader_queue, reader, reader_closed))
+    async def distribute_message(self, message: bytes):
+        stream_id, stream_msg = unpack_msg_provider(message)
+        queue = self.stream_queues.get(stream_id)
+        if queue:
+            await queue.put(stream_msg)
+        elif stream_msg[0] != MSG_TYPE_CLOSE:
+            log_internal("stream with id %d not found. Closing...", stream_id)
+            await self.send_queue.put(pack_msg_provider(stream_id, pack_msg_close()))
 
-    is_remote_connection_closed = False
+    async def run(self):
+        try:
+            await run_relay(
+                pump(self.websocket.recv, self.distribute_message),
+                pump(self.send_queue.get, self.websocket.send))
+        except Exception as e:
+            log_internal("multiplexed connection had error event: {}".format(e))
+        finally:
+            log_internal("multiplexed connection closed, closing {} streams".format(len(self.stream_queues)))
+            for queue in list(self.stream_queues.values()):
+                queue.put_nowait(pack_msg_close())
+            self.stream_queues.clear()
+            await self.websocket.close()
 
+multiplexed_connections: List[MultiplexedConnection] = []
+multiplexed_connections_lock: asyncio.Lock = None
+
+async def get_multiplexed_connection():
+    async with multiplexed_connections_lock:
+        multiplexed_connections[:] = [ connection for connection in multiplexed_connections if connection.websocket.open ]
+        if len(multiplexed_connections) < CLIENT_CONNECTIONS:
+            log_internal("opening multiplexed websocket connection {}/{}".format(len(multiplexed_connections) + 1, CLIENT_CONNECTIONS))
+            connection = MultiplexedConnection(await connect_gateway())
+            asyncio.create_task(connection.run())
+            multiplexed_connections.append(connection)
+
+        return min(multiplexed_connections, key=lambda connection: len(connection.stream_queues))
+
+def open_flags():
+    # the provider answers with COMPRESS_ACK if it compresses as well
+    return OPEN_FLAG_COMPRESS if COMPRESSION_LEVEL is not None else 0
+
+# whether the provider answered an OPEN before. providers which don't would drop the data
+# sent along with an OPEN, so the first stream is opened without.
+provider_answers_open = False
+
+def note_open_answer(opened: asyncio.Future):
+    global provider_answers_open
+    provider_answers_open = True
+
+async def pack_open(endpoint: TCPStreamEndpoint, request: Union[ProxyRequest, None] = None):
+    hostname, port, connection_type = (request.hostname, request.port, OPEN_TYPE_TCP) if request else (REMOTE_HOSTNAME, REMOTE_PORT, REMOTE_TYPE)
+    if not provider_answers_open:
+        endpoint.opened.add_done_callback(note_open_answer)
+        return pack_msg_open(hostname, port, open_flags(), connection_type=connection_type)
+    # proxy clients only send data after the reply
+    if not CLIENT_FAST_OPEN or request:
+        return pack_msg_open(hostname, port, open_flags(), connection_type=connection_type)
+
+    # the first data of a client usually follows its handshake right away
+    try:
+        await asyncio.wait_for(endpoint.stream.wait_readable(), FAST_OPEN_WAIT)
+    except asyncio.TimeoutError:
+        pass
+    return pack_msg_open(hostname, port, open_flags(), endpoint.read_first_data(FAST_OPEN_MAX_SIZE), connection_type)
+
+async def answer_proxy_request(endpoint: TCPStreamEndpoint, request: ProxyRequest, receive_message: Callable[[], Awaitable[bytes]]):
+    """Handles the messages of the stream until the provider answered the OPEN and replies
+    to the proxy client. Providers too old to answer OPEN close the stream if they could not
+    reach the destination, their data means they did. Returns False if the stream is closed."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (OPEN_ANSWER_TIMEOUT if provider_answers_open else LEGACY_OPEN_WAIT)
+    message = None
+    while not endpoint.opened.done():
+        try:
+            message = await asyncio.wait_for(receive_message(), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            break
+        if message[0] in (MSG_TYPE_DATA, MSG_TYPE_DATA_COMPRESSED, MSG_TYPE_CLOSE):
+            break
+        await endpoint.write_message(message)
+        message = None
+
+    if endpoint.opened.done():
+        opened = endpoint.opened.result()
+    elif message is not None:
+        opened = message[0] != MSG_TYPE_CLOSE
+    else:
+        opened = not provider_answers_open
+
+    if opened:
+        request.reply(endpoint.stream)
+    elif endpoint.open_error:
+        request.reply(endpoint.stream, endpoint.open_error[0])
+    else:
+        request.reply(endpoint.stream, OPEN_FAIL_ERROR if message is not None else OPEN_FAIL_TIMEOUT)
+    log_internal("%s request for %s:%d %s", request.protocol, request.hostname, request.port, "succeeded" if opened else "failed")
+
+    # the message which ended the wait comes after the reply
+    if message is not None:
+        await endpoint.write_message(message)
+    return opened and not endpoint.closed_remotely
+
+def refuse_client(stream: TCPStream, request: Union[ProxyRequest, None], error: Exception):
+    """Closes a stream for which no connection to the gateway could be opened, a proxy
+    client is told first."""
+    log_internal_warn("could not connect to the gateway: {}".format(str(error) or "timeout"))
+    if request:
+        request.reply(stream, OPEN_FAIL_ERROR)
+    stream.close()
+
+async def handle_client(stream: TCPStream, request: Union[ProxyRequest, None] = None):
+    log_internal("opening the websocket connection")
     try:
-        while not writer.is_closing() and not reader_closed.is_set():
-            listener_task = asyncio.ensure_future(reader_queue.get())
-            producer_task = asyncio.ensure_future(websocket.recv())
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if listener_task in done:
-                message = listener_task.result()
-                if len(message) > 0:
-                    log_outbound_msg_data()
-                    await websocket.send(pack_msg_data(message))
-            else:
-                listener_task.cancel()
-
-            if producer_task in done:
-                message = producer_task.result()
-
-                if message[0] == MSG_TYPE_DATA:
-                    message_data = unpack_msg_data(message)
-                    log_inbound_msg_data()
-                    writer.write(message_data)
-                    await writer.drain()
-                elif message[0] == MSG_TYPE_CLOSE:
-                    log_inbound_msg_close_connection()
-                    is_remote_connection_closed = True
-                    writer.close()
-                    await writer.wait_closed()
-                else:
-                    log_inbound("client received an unexpected message: {}".format(message.hex()[:10]))
-            else:
-                producer_task.cancel()
+        websocket = await websocket_pool.acquire()
+    except (OSError, websockets.WebSocketException, asyncio.TimeoutError) as e:
+        refuse_client(stream, request, e)
+        return
+
+    endpoint = TCPStreamEndpoint(stream, websocket.send, FLOW_WINDOW, COMPRESSION_LEVEL)
+    log_outbound_msg_open_connection()
+    try:
+        await websocket.send(await pack_open(endpoint, request))
+    except websockets.WebSocketException as e:
+        # a pooled websocket may have been closed without the pool noticing yet
+        refuse_client(stream, request, e)
+        return
+
+    try:
+        await endpoint.grant_window()
+        if request and not await answer_proxy_request(endpoint, request, websocket.recv):
+            return
+        await run_relay(
+            pump(endpoint.read_data, endpoint.send_data),
+            pump(websocket.recv, endpoint.write_message))
     finally:
         log_internal("client host closed!")
-        if not is_remote_connection_closed:
+        if not endpoint.closed_remotely and websocket.open:
             log_outbound_msg_close_connection()
             await websocket.send(pack_msg_close())
+        endpoint.log_compression()
         log_internal("closing the websocket connection!")
         await websocket.close()
+        if not stream.is_closing():
+            stream.close()
+
+async def handle_multiplexed_client(stream: TCPStream, request: Union[ProxyRequest, None] = None):
+    try:
+        connection = await get_multiplexed_connection()
+    except (OSError, websockets.WebSocketException, asyncio.TimeoutError) as e:
+        refuse_client(stream, request, e)
+        return
+    stream_id, recv_queue = connection.create_stream()
+
+    async def send_message(message: bytes):
+        await connection.send_queue.put(pack_msg_provider(stream_id, message))
+
+    endpoint = TCPStreamEndpoint(stream, send_message, FLOW_WINDOW, COMPRESSION_LEVEL, stream_id)
+    log_outbound_msg_open_connection()
+    await send_message(await pack_open(endpoint, request))
+
+    try:
+        await endpoint.grant_window()
+        if request and not await answer_proxy_request(endpoint, request, recv_queue.get):
+            return
+        await run_relay(
+            pump(endpoint.read_data, endpoint.send_data),
+            pump(gathered(recv_queue), endpoint.write_messages))
+    finally:
+        log_internal("client host closed!")
+        connection.remove_stream(stream_id)
+        if not endpoint.closed_remotely:
+            log_outbound_msg_close_connection()
+            await connection.send_queue.put(pack_msg_provider(stream_id, pack_msg_close()))
+        endpoint.log_compression()
+        if not stream.is_closing():
+            stream.close()
+
+async def handle_proxy_client(stream: TCPStream):
+    try:
+        request = await asyncio.wait_for(accept_proxy_request(stream), PROXY_HANDSHAKE_TIMEOUT)
+    except (ProxyError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError) as e:
+        log_internal("proxy handshake failed: %s", str(e) or "timeout")
+        stream.close()
+        return
+
+    log_internal("%s client requests %s:%d", request.protocol, request.hostname, request.port)
+    if CLIENT_MULTIPLEX:
+        await handle_multiplexed_client(stream, request)
+    else:
+        await handle_client(stream, request)
+
+class UDPListener(asyncio.DatagramProtocol):
+    """Receives the datagrams of local clients. Datagrams from every source address are a
+    flow, tunneled as a stream of a multiplexed connection. Only opening a flow runs in a
+    task, the datagrams of open flows are queued right away."""
+    transport: Union[asyncio.DatagramTransport, None]
+    flows: Dict[tuple, DatagramFlow]
+    opening: Dict[tuple, List[bytes]]
+
+    def __init__(self):
+        self.transport = None
+        self.flows = {}
+        self.opening = {}
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        flow = self.flows.get(addr)
+        if flow:
+            flow.datagram_received(data)
+        elif addr in self.opening:
+            if len(self.opening[addr]) < MAX_PENDING_DATAGRAMS:
+                self.opening[addr].append(data)
+        else:
+            self.opening[addr] = [ data ]
+            asyncio.create_task(self.open_flow(addr))
+
+    def error_received(self, exc: Exception):
+        pass
+
+    async def open_flow(self, addr: tuple):
+        try:
+            connection = await get_multiplexed_connection()
+        except (OSError, websockets.WebSocketException) as e:
+            log_internal_warn("could not open a udp flow for {}: {}".format(addr, e))
+            del self.opening[addr]
+            return
+
+        flow = DatagramFlow(connection.send_queue)
+        flow.stream_id = connection.stream_queues.allocate(flow)
+
+        def remove_flow(flow: DatagramFlow):
+            if self.flows.get(addr) is flow:
+                del self.flows[addr]
+            if connection.stream_queues.get(flow.stream_id) is flow:
+                connection.remove_stream(flow.stream_id)
+
+        flow.on_close = remove_flow
+        flow.attach(lambda datagram: self.transport.sendto(datagram, addr))
+        log_outbound_msg_open_connection()
+        connection.send_queue.put_nowait(pack_msg_provider(flow.stream_id, pack_msg_open(REMOTE_HOSTNAME, REMOTE_PORT, connection_type=OPEN_TYPE_UDP)))
+        self.flows[addr] = flow
+        for datagram in self.opening.pop(addr):
+            flow.datagram_received(datagram)
+
+async def run_udp_server():
+    global multiplexed_connections_lock
+
+    log_internal("starting udp server")
+    multiplexed_connections_lock = asyncio.Lock()
+    if DIAGNOSTICS:
+        await DIAGNOSTICS.start()
+    transport, listener = await asyncio.get_running_loop().create_datagram_endpoint(UDPListener, local_addr=('localhost', CLIENT_PORT))
+    try:
+        await expire_flows(lambda: listener.flows.values(), UDP_IDLE_TIMEOUT)
+    finally:
+        transport.close()
 
 async def run_server():
+    global multiplexed_connections_lock, websocket_pool
+
     log_internal("starting server")
-    server = await asyncio.start_server(handle_client, 'localhost', CLIENT_PORT)
+    if DIAGNOSTICS:
+        await DIAGNOSTICS.start()
+    if CLIENT_MULTIPLEX:
+        multiplexed_connections_lock = asyncio.Lock()
+        handler = handle_multiplexed_client
+    else:
+        websocket_pool = WebsocketPool(CLIENT_POOL_SIZE)
+        websocket_pool.refill()
+        handler = handle_client
+    if CLIENT_PROTOCOL == "socks":
+        handler = handle_proxy_client
+    stream_kwargs = { "max_read_size": TCP_MAX_READ_SIZE, "high_water": TCP_HIGH_WATER, "write_high_water": TCP_WRITE_HIGH_WATER }
+    if CLIENT_UNIX_PATH:
+        server = await start_unix_server(handler, CLIENT_UNIX_PATH, **stream_kwargs)
+    else:
+        server = await start_tcp_server(handler, 'localhost', CLIENT_PORT, **stream_kwargs)
     async with server:
         await server.serve_forever()
 
 def main():
     config = setup_args_and_config("Client")
-    config.parse_remote_provider()
+    config.parse_client_protocol()
+    # in proxy mode every client chooses its destination
+    if config.client_protocol != "socks":
+        config.parse_remote_provider()
     config.parse_provider_name()
     config.parse_client_port()
+    config.parse_client_multiplex()
+    config.parse_client_pool()
+    config.parse_udp()
+    config.parse_tcp()
+    config.parse_flow_control()
+    config.parse_compression()
+    config.parse_scheduler()
+    config.parse_diagnostics()
     config.parse_gateway_password()
     config.parse_gateway_url()
+    config.parse_gateway_protocol()
+    if config.client_protocol == "udp" and (config.client_unix_path or unix_address_path(getattr(config, "provider_hostname", ""))):
+        config.print_error("client.protocol", msg="Udp flows can't use unix sockets.")
     config.finish()
+    setup_logging(config)
 
-    global REMOTE_PORT, REMOTE_HOSTNAME, CLIENT_PORT, GATEWAY_URL_FULL, GATEWAY_PW
+    global REMOTE_PORT, REMOTE_HOSTNAME, REMOTE_TYPE, CLIENT_PORT, CLIENT_UNIX_PATH, CLIENT_MULTIPLEX, CLIENT_CONNECTIONS, CLIENT_POOL_SIZE, CLIENT_FAST_OPEN, CLIENT_PROTOCOL, UDP_IDLE_TIMEOUT, GATEWAY_URL_FULL, GATEWAY_PW, PROTOCOL_VERSION, TCP_MAX_READ_SIZE, TCP_HIGH_WATER, TCP_WRITE_HIGH_WATER, FLOW_WINDOW, COMPRESSION_LEVEL, WEBSOCKET_COMPRESSION, SCHEDULER_ENABLED, SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, SCHEDULER_PROVIDER_RATE, DIAGNOSTICS
 
-    REMOTE_PORT = config.provider_port
-    REMOTE_HOSTNAME = config.provider_hostname
+    if config.client_protocol != "socks":
+        REMOTE_PORT = config.provider_port
+        REMOTE_HOSTNAME = config.provider_hostname
+        if unix_address_path(REMOTE_HOSTNAME):
+            REMOTE_HOSTNAME = unix_address_path(REMOTE_HOSTNAME)
+            REMOTE_TYPE = OPEN_TYPE_UNIX
 
     CLIENT_PORT = config.client_port
+    CLIENT_UNIX_PATH = config.client_unix_path
+    CLIENT_MULTIPLEX = config.client_multiplex
+    CLIENT_CONNECTIONS = config.client_connections
+    CLIENT_POOL_SIZE = config.client_pool_size
+    CLIENT_FAST_OPEN = config.client_fast_open
+    CLIENT_PROTOCOL = config.client_protocol
+    UDP_IDLE_TIMEOUT = config.udp_idle_timeout
+
+    TCP_MAX_READ_SIZE = config.tcp_max_read_size
+    TCP_HIGH_WATER = config.tcp_high_water
+    TCP_WRITE_HIGH_WATER = config.tcp_write_high_water
+    FLOW_WINDOW = config.flow_window
+    COMPRESSION_LEVEL = config.compression_level if config.compression_enabled else None
+    WEBSOCKET_COMPRESSION = None if config.compression_enabled else "deflate"
+    SCHEDULER_ENABLED = config.scheduler_enabled
+    SCHEDULER_QUANTUM = config.scheduler_quantum
+    SCHEDULER_STREAM_RATE = config.scheduler_stream_rate
+    SCHEDULER_PROVIDER_RATE = config.scheduler_provider_rate
+    DIAGNOSTICS = setup_diagnostics(config, "client")
 
+    # multiplexed clients share their websockets between many streams, udp flows always do
+    connection_type = "m/" if CLIENT_MULTIPLEX or CLIENT_PROTOCOL == "udp" else "c/"
     gateway_url = config.gateway_url
-    gateway_url_base = gateway_url + "c/" if gateway_url.endswith("/") else gateway_url + "/c/"
+    gateway_url_base = gateway_url + connection_type if gateway_url.endswith("/") else gateway_url + "/" + connection_type
     GATEWAY_URL_FULL = gateway_url_base + config.provider_name
 
     GATEWAY_PW = config.gateway_pw
+    PROTOCOL_VERSION = config.gateway_protocol
 
-    asyncio.run(run_server())
+    if CLIENT_PROTOCOL == "udp":
+        asyncio.run(run_udp_server())
+    else:
+        asyncio.run(run_server())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
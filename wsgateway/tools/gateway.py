@@ -1,111 +1,735 @@
 import asyncio
+import atexit
 import websockets
-import random
 import struct
-from typing import Dict, Union
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from typing import Any, Dict, List, Set, Tuple, Union
 import logging
 import argparse
+from http import HTTPStatus
 
-from wsgateway.messages import unpack_msg_provider, pack_msg_provider, pack_msg_close
-from wsgateway.utils import KeyedQueueMap
+from wsgateway.messages import unpack_msg_provider, pack_msg_provider, pack_msg_provider_gathered, pack_msg_close, pack_msg_hello, unpack_msg_hello, pack_msg_session, pack_msg_session_ack, unpack_msg_session_ack, pack_msg_resume, unpack_msg_resume, iter_msg_batch, frame_len, MSG_TYPE_OPEN, MSG_TYPE_CLOSE, MSG_TYPE_HELLO, MSG_TYPE_BATCH, MSG_TYPE_SESSION_ACK, MSG_TYPE_RESUME, CONTROL_STREAM_ID, FEATURE_BATCH, FEATURE_RESUME, RESUME_UNKNOWN, RESUME_LOST
+from wsgateway.batch import FrameQueue
+from wsgateway.scheduler import StreamScheduler, TokenBucket
+from wsgateway.capture import CaptureWriter, CAPTURE_TO_PROVIDER, CAPTURE_TO_CLIENT, CAPTURE_FLUSH_INTERVAL
+from wsgateway.diagnostics import Diagnostics, setup_diagnostics
+from wsgateway.routing import RoutingTable
+from wsgateway.relay import pump, run_relay
+from wsgateway.flow import StreamFlowPolicer, DEFAULT_MAX_WINDOW_SIZE, DEFAULT_MAX_QUEUED
+from wsgateway.peer import PeerLink, open_peer_link, peer_socket_path
+from wsgateway.tcp import remove_stale_socket
+from wsgateway.session import LinkSession, is_session_message, new_token
+from wsgateway.metrics import Histogram, MetricsWriter, TimedQueue, TrafficCounter, render_metrics, CONTENT_TYPE
+from wsgateway.wire import negotiated_version, subprotocols, wire_link
 from wsgateway.config import setup_args_and_config
 from wsgateway.log import *
 
 PW = ""
+PROTOCOL_VERSION = 1
+FLOW_MAX_WINDOW = DEFAULT_MAX_WINDOW_SIZE
+FLOW_MAX_QUEUED = DEFAULT_MAX_QUEUED
+PLACEMENT = "least-streams"
+BATCH_ENABLED = False
+BATCH_MAX_SIZE = 0
+BATCH_DELAY_US = 0
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+RUN_DIR = ""
+METRICS_PATH = None
+METRICS_PER_STREAM = False
+SESSION_RESUME = True
+SESSION_RESUME_TIMEOUT = 0.0
+SESSION_REPLAY_BUFFER = 0
+SCHEDULER_ENABLED = True
+SCHEDULER_QUANTUM = 0
+SCHEDULER_STREAM_RATE = 0
+SCHEDULER_PROVIDER_RATE = 0
+CAPTURE_PATH = None
+CAPTURE_PAYLOAD = False
+DIAGNOSTICS: Union[Diagnostics, None] = None
 
-client_recv_queue_map = KeyedQueueMap()
-provider_recv_queue_map = KeyedQueueMap()
+# first frame of a link between two workers, telling what the link is used for
+PEER_LINK_REGISTRY = b"r"
+PEER_LINK_STREAMS = b"m"
 
-async def handle_client_message(msg: bytes, client_id: int, provider_name: str, client_queue: asyncio.Queue):
-    provider_msg = pack_msg_provider(client_id, msg)
+# frames on a registry link, followed by provider names separated by newlines
+REGISTRY_ADD = b"+"
+REGISTRY_REMOVE = b"-"
 
-    provider_queue = await provider_recv_queue_map.get_queue(provider_name)
-    if provider_queue:
-        log_outbound("sending message to provider")
-        await provider_queue.put(provider_msg)
+# allocates the client ids of all streams of this process
+client_routes = RoutingTable()
+
+# how long frames wait in the queues of the gateway, by queue. only recorded with metrics enabled.
+queue_wait_histograms: Dict[str, Histogram] = {}
+
+def queue_wait_histogram(queue_name: str):
+    if not METRICS_PATH:
+        return None
+    return queue_wait_histograms.setdefault(queue_name, Histogram())
+
+# the relayed messages are recorded with a capture path
+capture: Union[CaptureWriter, None] = None
+
+def start_capture():
+    """Opens the capture file of this process, every worker writes its own one."""
+    global capture
+    if not CAPTURE_PATH:
+        return
+    path = CAPTURE_PATH if WORKER_COUNT == 1 else "{}.{}".format(CAPTURE_PATH, WORKER_INDEX)
+    capture = CaptureWriter(path, CAPTURE_PAYLOAD)
+    atexit.register(capture.close)
+
+    def flush():
+        capture.flush()
+        asyncio.get_running_loop().call_later(CAPTURE_FLUSH_INTERVAL, flush)
+    asyncio.get_running_loop().call_later(CAPTURE_FLUSH_INTERVAL, flush)
+
+# limits the traffic to a provider over all of its connections to this process, by provider name
+provider_buckets: Dict[str, TokenBucket] = {}
+
+def send_scheduler(provider_name: Union[str, None] = None):
+    if not SCHEDULER_ENABLED:
+        return None
+    bucket = None
+    if provider_name and SCHEDULER_PROVIDER_RATE:
+        bucket = provider_buckets.setdefault(provider_name, TokenBucket(SCHEDULER_PROVIDER_RATE, SCHEDULER_QUANTUM))
+    return StreamScheduler(SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, bucket)
+
+class ProviderStats(object):
+    """Traffic of all connections of a provider to this process."""
+    __slots__ = ("to_provider", "to_client", "streams_total", "resumes_total")
+    to_provider: TrafficCounter
+    to_client: TrafficCounter
+    streams_total: int
+    resumes_total: int
+
+    def __init__(self):
+        self.to_provider = TrafficCounter()
+        self.to_client = TrafficCounter()
+        self.streams_total = 0
+        self.resumes_total = 0
+
+provider_stats: Dict[str, ProviderStats] = {}
+
+class ProviderConnection(object):
+    """A websocket of a provider. A provider may open several of them under the same name,
+    every stream is placed on one of them when it starts and stays there. Once the provider
+    agreed to it, the queued messages of several streams are sent as one batch message.
+
+    Connections reaching a provider over another worker have no `stats`, their traffic is
+    counted by that worker.
+
+    The websocket of a provider with a `session` token can drop and be replaced by a new one
+    resuming the session. In between the connection is detached: `relay` is None and the
+    messages for the provider wait in the queue until `gap_timer` gives up on it."""
+    name: Union[str, None]
+    queue: FrameQueue
+    client_queues: Dict[int, "ClientQueue"]
+    closed: bool
+    batching: bool
+    stats: Union[ProviderStats, None]
+    session: Union[LinkSession, None]
+    relay: Union[asyncio.Task, None]
+    gap_timer: Union[asyncio.TimerHandle, None]
+
+    def __init__(self, provider_name: Union[str, None] = None):
+        self.name = provider_name
+        self.queue = FrameQueue(queue_wait_histogram("provider"), send_scheduler(provider_name))
+        self.client_queues = {}
+        self.closed = False
+        self.batching = False
+        self.stats = provider_stats.setdefault(provider_name, ProviderStats()) if provider_name else None
+        self.session = None
+        self.relay = None
+        self.gap_timer = None
+
+    @property
+    def attached(self):
+        return self.gap_timer is None
+
+    @property
+    def queued_bytes(self):
+        return self.queue.queued_bytes
+
+    async def put(self, msg: bytes):
+        if self.stats:
+            self.stats.to_provider.add(frame_len(msg))
+        await self.queue.put(msg)
+
+    async def get(self):
+        if self.batching:
+            return await self.queue.get_batch(BATCH_MAX_SIZE, BATCH_DELAY_US)
+        return await self.queue.get()
+
+provider_connection_map: Dict[str, List[ProviderConnection]] = {}
+
+# provider connections which can be resumed, by session token
+provider_sessions: Dict[bytes, ProviderConnection] = {}
+
+# providers connected to other workers of the gateway, by name
+remote_provider_map: Dict[str, Set[int]] = {}
+# links announcing the providers connected to this worker, by the index of the receiving worker
+registry_links: Dict[int, PeerLink] = {}
+# connections reaching a provider on another worker, by worker index and provider name
+peer_provider_connections: Dict[Tuple[int, str], ProviderConnection] = {}
+peer_provider_connections_lock = asyncio.Lock()
+
+async def get_peer_provider_connections(provider_name: str):
+    connections = []
+    for index in sorted(remote_provider_map.get(provider_name, ())):
+        async with peer_provider_connections_lock:
+            provider = peer_provider_connections.get((index, provider_name))
+            if not provider:
+                try:
+                    provider = await connect_peer_provider(index, provider_name)
+                except OSError as e:
+                    log_internal_warn("could not reach worker {}: {}".format(index, e))
+                    continue
+        connections.append(provider)
+    return connections
+
+async def place_stream(client_id: int, provider_name: str, client_queue: "ClientQueue"):
+    # providers connected to this worker are preferred, streams only cross to another
+    # worker if the provider is not connected here
+    connections = provider_connection_map.get(provider_name)
+    if not connections:
+        connections = await get_peer_provider_connections(provider_name)
+    if not connections:
+        return None
+
+    # detached connections only get streams if the provider has no other ones, the streams wait for the provider to resume
+    if PLACEMENT == "least-bytes":
+        provider = min(connections, key=lambda connection: (not connection.attached, connection.queued_bytes, len(connection.client_queues)))
+    else:
+        provider = min(connections, key=lambda connection: (not connection.attached, len(connection.client_queues), connection.queued_bytes))
+
+    if log_internal_enabled():
+        log_internal("placing stream of client with id %d on provider connection %d/%d", client_id, connections.index(provider) + 1, len(connections))
+    provider.client_queues[client_id] = client_queue
+    client_queue.provider = provider
+    if provider.stats:
+        provider.stats.streams_total += 1
+    return provider
+
+def unpin_stream(client_id: int, client_queue: "ClientQueue"):
+    if client_queue.provider:
+        client_queue.provider.client_queues.pop(client_id, None)
+
+class ClientQueue(TimedQueue):
+    """Recv queue of a client connection, carrying the flow control state of its stream,
+    the provider connection it is placed on, the bytes sent in both directions and the
+    bytes waiting in the queue."""
+    flow: StreamFlowPolicer
+    provider: Union[ProviderConnection, None]
+    bytes_to_provider: int
+    bytes_to_client: int
+    queued_bytes: int
+
+    def __init__(self):
+        super().__init__(queue_wait_histogram("client"))
+        self.flow = StreamFlowPolicer(FLOW_MAX_WINDOW)
+        self.provider = None
+        self.bytes_to_provider = 0
+        self.bytes_to_client = 0
+        self.queued_bytes = 0
+
+    async def put(self, msg: bytes):
+        self.queued_bytes += len(msg)
+        await super().put(msg)
+
+    async def get(self):
+        msg = await super().get()
+        self.queued_bytes -= len(msg)
+        return msg
+
+    def queued_to_client(self):
+        return self.queued_bytes
+
+def exceeds_queue_limit(queued_bytes: int, msg: bytes):
+    """Whether queueing `msg` behind `queued_bytes` of its stream exceeds the limit, which
+    holds whether or not the ends of the stream use flow control. CLOSE always fits."""
+    return msg[0] != MSG_TYPE_CLOSE and queued_bytes + len(msg) > FLOW_MAX_QUEUED
+
+async def send_to_provider(provider_msg: bytes, client_id: int, provider_name: str, client_queue: ClientQueue):
+    provider = client_queue.provider or await place_stream(client_id, provider_name, client_queue)
+    if provider and not provider.closed:
+        await provider.put(provider_msg)
     else: 
         log_outbound("sending message to client")
         await client_queue.put(pack_msg_close())
         log_internal_warn("provider with id {} was no found! A connection closed message should be sent to the client!".format(provider_name))
 
+async def handle_client_message(msg: bytes, client_id: int, provider_name: str, client_queue: ClientQueue):
+    if client_queue.flow.violated:
+        return
+    if tracer.enabled:
+        tracer.frame("client->provider", client_id, msg[0], len(msg))
+    if capture:
+        capture.frame(CAPTURE_TO_PROVIDER, client_id, msg)
+    client_queue.bytes_to_provider += len(msg)
+    if not client_queue.flow.check_client_message(msg):
+        await close_flow_violating_stream(client_id, provider_name, client_queue, "violated flow control")
+    elif client_queue.provider and exceeds_queue_limit(client_queue.provider.queue.stream_queued(client_id), msg):
+        await close_flow_violating_stream(client_id, provider_name, client_queue, "queued more than {} bytes for the provider".format(FLOW_MAX_QUEUED))
+    else:
+        await send_to_provider(pack_msg_provider_gathered(client_id, msg), client_id, provider_name, client_queue)
+
+async def close_flow_violating_stream(client_id: int, provider_name: str, client_queue: ClientQueue, reason: str):
+    """Closes both ends of a stream which violated flow control or exceeded the queue limit.
+    Later messages of the stream are dropped."""
+    log_internal_warn("stream of client with id {} {}! Closing it...".format(client_id, reason))
+    client_queue.flow.violated = True
+    await send_to_provider(pack_msg_provider(client_id, pack_msg_close()), client_id, provider_name, client_queue)
+    await client_queue.put(pack_msg_close())
 
 async def handle_connection_client(websocket, provider_name: str):
-    client_id, recv_queue = await client_recv_queue_map.create_inc_queue()
+    recv_queue = ClientQueue()
+    client_id = client_routes.allocate(recv_queue)
+
+    async def forward_to_provider(message: bytes):
+        await handle_client_message(message, client_id, provider_name, recv_queue)
 
     try:
-        while websocket.open:
-            listener_task = asyncio.ensure_future(websocket.recv())
-            producer_task = asyncio.ensure_future(recv_queue.get())
-
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if listener_task in done:
-                message = listener_task.result()
-                log_inbound("received message for provider")
-                await handle_client_message(message, client_id, provider_name, recv_queue)
-            else:
-                listener_task.cancel()
+        await run_relay(
+            pump(websocket.recv, forward_to_provider),
+            pump(recv_queue.get, websocket.send))
+    except Exception as e:
+        logging.info("server had error event: %s", e)
+    finally:
+        unpin_stream(client_id, recv_queue)
+        client_routes.remove(client_id)
 
-            if producer_task in done:
-                message = producer_task.result()
-                log_inbound("received message for client")
-                log_outbound("sending message to client")
-                await websocket.send(message)
-            else:
-                producer_task.cancel()
+class MultiplexedStreamQueue(object):
+    """Stands in for the recv queue of a single stream on a multiplexed client connection.
+    Messages put into it are tagged with the stream id chosen by the client and sent over
+    the shared websocket."""
+    __slots__ = ("connection", "stream_id", "client_id", "flow", "provider", "bytes_to_provider", "bytes_to_client")
+    connection: "MultiplexedClientConnection"
+    stream_id: int
+    client_id: int
+    flow: StreamFlowPolicer
+    provider: Union[ProviderConnection, None]
+    bytes_to_provider: int
+    bytes_to_client: int
+
+    def __init__(self, connection: "MultiplexedClientConnection", stream_id: int):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.client_id = 0
+        self.flow = StreamFlowPolicer(FLOW_MAX_WINDOW)
+        self.provider = None
+        self.bytes_to_provider = 0
+        self.bytes_to_client = 0
+
+    def qsize(self):
+        # frames for the client wait in the send queue of the connection
+        return 0
+
+    def queued_to_client(self):
+        return self.connection.send_queue.stream_queued(self.stream_id)
+
+    async def put(self, msg: bytes):
+        if msg[0] == MSG_TYPE_CLOSE:
+            self.connection.remove_stream(self.stream_id)
+        await self.connection.send_queue.put(pack_msg_provider_gathered(self.stream_id, msg))
+
+class MultiplexedClientConnection(object):
+    send_queue: FrameQueue
+    streams: Dict[int, MultiplexedStreamQueue]
+
+    def __init__(self):
+        self.send_queue = FrameQueue(queue_wait_histogram("multiplexed_client"), send_scheduler())
+        self.streams = {}
+
+    def create_stream(self, stream_id: int):
+        stream_queue = MultiplexedStreamQueue(self, stream_id)
+        stream_queue.client_id = client_routes.allocate(stream_queue)
+        self.streams[stream_id] = stream_queue
+        return stream_queue
+
+    def remove_stream(self, stream_id: int):
+        stream_queue = self.streams.pop(stream_id, None)
+        if stream_queue:
+            unpin_stream(stream_queue.client_id, stream_queue)
+            client_routes.remove(stream_queue.client_id)
+
+multiplexed_client_connections: Set[MultiplexedClientConnection] = set()
+
+async def handle_multiplexed_client_message(msg: bytes, connection: MultiplexedClientConnection, provider_name: str):
+    stream_id, client_msg = unpack_msg_provider(msg)
+
+    if client_msg[0] == MSG_TYPE_OPEN:
+        if stream_id in connection.streams:
+            log_internal_warn("stream with id {} was opened twice! Closing the old stream.".format(stream_id))
+            old_stream_queue = connection.streams[stream_id]
+            connection.remove_stream(stream_id)
+            await handle_client_message(pack_msg_close(), old_stream_queue.client_id, provider_name, old_stream_queue)
+        stream_queue = connection.create_stream(stream_id)
+    else:
+        stream_queue = connection.streams.get(stream_id)
+        if not stream_queue:
+            # a close is never answered with a close, the stream is already gone on both ends
+            if client_msg[0] != MSG_TYPE_CLOSE:
+                log_outbound("sending close message to client")
+                await connection.send_queue.put(pack_msg_provider(stream_id, pack_msg_close()))
+            return
+        if client_msg[0] == MSG_TYPE_CLOSE:
+            connection.remove_stream(stream_id)
+
+    await handle_client_message(client_msg, stream_queue.client_id, provider_name, stream_queue)
+
+async def handle_connection_multiplexed_client(websocket, provider_name: str):
+    connection = MultiplexedClientConnection()
+    multiplexed_client_connections.add(connection)
+
+    async def forward_to_provider(message: bytes):
+        await handle_multiplexed_client_message(message, connection, provider_name)
+
+    try:
+        await run_relay(
+            pump(websocket.recv, forward_to_provider),
+            pump(connection.send_queue.get, websocket.send))
     except Exception as e:
         logging.info("server had error event: {}".format(e))
     finally:
-        await client_recv_queue_map.remove_queue(client_id)
+        multiplexed_client_connections.discard(connection)
+        log_internal("multiplexed client disconnected, closing {} streams".format(len(connection.streams)))
+        for stream_id, stream_queue in list(connection.streams.items()):
+            connection.remove_stream(stream_id)
+            await handle_client_message(pack_msg_close(), stream_queue.client_id, provider_name, stream_queue)
 
-async def handle_provider_message(msg: bytes, provider_queue: asyncio.Queue):
+async def handle_provider_message(msg: bytes, provider: ProviderConnection):
     client_id, client_msg = unpack_msg_provider(msg)
+    if client_id == CONTROL_STREAM_ID:
+        await handle_provider_control_message(client_msg, provider)
+    else:
+        await handle_provider_stream_message(client_id, client_msg, provider)
+
+async def handle_provider_control_message(msg: bytes, provider: ProviderConnection):
+    if msg[0] == MSG_TYPE_BATCH:
+        for client_id, client_msg in iter_msg_batch(msg):
+            if client_id == CONTROL_STREAM_ID:
+                await handle_provider_control_message(client_msg, provider)
+            else:
+                await handle_provider_stream_message(client_id, client_msg, provider)
+    elif msg[0] == MSG_TYPE_HELLO:
+        # the provider offers its features, the answer carries the ones the gateway uses as well
+        supported = (FEATURE_BATCH if BATCH_ENABLED else 0) | (FEATURE_RESUME if SESSION_RESUME and provider.session else 0)
+        features = unpack_msg_hello(msg) & supported
+        log_internal("provider connection negotiated features {:#x}".format(features))
+        await provider.put(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_hello(features)))
+        provider.batching = bool(features & FEATURE_BATCH)
+        if not features & FEATURE_RESUME:
+            provider.session = None
+        elif not provider.session.token:
+            provider.session.token = new_token()
+            provider.session.max_replay_bytes = SESSION_REPLAY_BUFFER
+            provider_sessions[provider.session.token] = provider
+            await provider.put(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_session(provider.session.token)))
+    elif msg[0] == MSG_TYPE_SESSION_ACK:
+        if provider.session:
+            provider.session.acknowledged(unpack_msg_session_ack(msg))
+    else:
+        log_internal_warn("unexpected message of type {} on the control stream".format(msg[0]))
 
-    client_queue = await client_recv_queue_map.get_queue(client_id)
-    if client_queue:
-        log_outbound("sending message to client with id {}".format(client_id))
+async def handle_provider_stream_message(client_id: int, client_msg: bytes, provider: ProviderConnection):
+    # a provider connection only reaches the streams placed on it
+    client_queue = provider.client_queues.get(client_id)
+    if client_queue and client_queue.flow.violated:
+        return
+    elif client_queue and not client_queue.flow.check_provider_message(client_msg):
+        log_internal_warn("stream of client with id {} violated flow control! Closing it...".format(client_id))
+        await provider.put(pack_msg_provider(client_id, pack_msg_close()))
+        await client_queue.put(pack_msg_close())
+    elif client_queue and exceeds_queue_limit(client_queue.queued_to_client(), client_msg):
+        log_internal_warn("stream of client with id {} queued more than {} bytes for the client! Closing it...".format(client_id, FLOW_MAX_QUEUED))
+        client_queue.flow.violated = True
+        await provider.put(pack_msg_provider(client_id, pack_msg_close()))
+        await client_queue.put(pack_msg_close())
+    elif client_queue:
+        if tracer.enabled:
+            tracer.frame("provider->client", client_id, client_msg[0], len(client_msg))
+        if capture:
+            capture.frame(CAPTURE_TO_CLIENT, client_id, client_msg)
+        client_queue.bytes_to_client += len(client_msg)
         await client_queue.put(client_msg)
-    else: 
+    elif client_msg[0] != MSG_TYPE_CLOSE:
         log_outbound("sending close message to provider")
-        await provider_queue.put(pack_msg_provider(client_id, pack_msg_close()))
+        await provider.put(pack_msg_provider(client_id, pack_msg_close()))
         log_internal_warn("client with id {} was no found! A connection closed message should be sent to the provider!".format(client_id))
 
+async def run_provider_connection(websocket, provider: ProviderConnection, replay: Union[List[bytes], None] = None):
+    """Relays the messages of a provider connection. `websocket` is either the websocket of
+    the provider or a link to the worker it is connected to. The messages in `replay` are
+    sent first."""
+    async def forward_to_client(message: bytes):
+        if provider.stats:
+            provider.stats.to_client.add(frame_len(message))
+        session = provider.session
+        if session and is_session_message(message) and session.received(frame_len(message)):
+            await provider.put(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_session_ack(session.received_count)))
+        await handle_provider_message(message, provider)
+
+    async def send_to_provider(message: bytes):
+        if provider.session and is_session_message(message):
+            provider.session.sent(message)
+        await websocket.send(message)
+
+    try:
+        for message in replay or ():
+            await websocket.send(message)
+        await run_relay(
+            pump(websocket.recv, forward_to_client),
+            pump(provider.get, send_to_provider))
+    except Exception as e:
+        logging.info("server had error event: {}".format(e))
+
+async def close_provider_streams(provider: ProviderConnection):
+    provider.closed = True
+    log_internal("provider connection closed, closing {} streams".format(len(provider.client_queues)))
+    for client_queue in list(provider.client_queues.values()):
+        await client_queue.put(pack_msg_close())
+    provider.client_queues.clear()
+
 async def handle_connection_provider(websocket, provider_name: str):
-    log_internal("creating provider with name: {}".format(provider_name))
-    
-    recv_queue = await provider_recv_queue_map.create_named_queue(provider_name)
+    provider = ProviderConnection(provider_name)
+    # the messages are counted from the start, a session may be agreed on later
+    provider.session = LinkSession(0)
+    connections = provider_connection_map.setdefault(provider_name, [])
+    connections.append(provider)
+    log_internal("creating provider connection {} with name: {}".format(len(connections), provider_name))
+    if len(connections) == 1:
+        await announce_providers(REGISTRY_ADD, [ provider_name ])
+
+    await serve_provider_connection(websocket, provider)
+
+async def serve_provider_connection(websocket, provider: ProviderConnection, replay: Union[List[bytes], None] = None):
+    """Runs the connection with the websocket. When it closes, a connection with a session
+    is detached for SESSION_RESUME_TIMEOUT seconds, others are removed right away."""
+    relay = asyncio.ensure_future(run_provider_connection(websocket, provider, replay))
+    provider.relay = relay
     try:
-        while websocket.open:
-            listener_task = asyncio.ensure_future(websocket.recv())
-            producer_task = asyncio.ensure_future(recv_queue.get())
-
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if listener_task in done:
-                message = listener_task.result()
-                log_inbound("received message for client")
-                await handle_provider_message(message, recv_queue)
+        await asyncio.wait([ relay ])
+    finally:
+        # a resumed websocket may have taken over already
+        if provider.relay is relay:
+            relay.cancel()
+            provider.relay = None
+            if provider.session and provider.session.token:
+                log_internal("provider connection of {} dropped, holding {} streams for {}s".format(provider.name, len(provider.client_queues), SESSION_RESUME_TIMEOUT))
+                provider.gap_timer = asyncio.get_running_loop().call_later(SESSION_RESUME_TIMEOUT,
+                    lambda: asyncio.ensure_future(remove_provider_connection(provider)))
             else:
-                listener_task.cancel()
+                await remove_provider_connection(provider)
 
-            if producer_task in done:
-                message = producer_task.result()
-                log_inbound("received message for provider")
-                log_outbound("sending message to provider")
-                await websocket.send(message)
-            else:
-                producer_task.cancel()
-    except Exception as e:
-        logging.info("server had error event: {}".format(e))
+async def remove_provider_connection(provider: ProviderConnection):
+    if provider.gap_timer:
+        provider.gap_timer.cancel()
+        log_internal_warn("provider connection of {} was not resumed".format(provider.name))
+    provider.gap_timer = None
+    if provider.session and provider.session.token:
+        provider_sessions.pop(provider.session.token, None)
+
+    connections = provider_connection_map.get(provider.name, [])
+    if provider in connections:
+        connections.remove(provider)
+    if not connections and provider.name in provider_connection_map:
+        provider_connection_map.pop(provider.name)
+        await announce_providers(REGISTRY_REMOVE, [ provider.name ])
+    await close_provider_streams(provider)
+
+async def handle_connection_resume(websocket, provider_name: str):
+    """Takes over the session of a provider connection with the websocket, which sends a RESUME first."""
+    _, msg = unpack_msg_provider(await websocket.recv())
+    if msg[0] != MSG_TYPE_RESUME:
+        log_internal_warn("provider {} did not send a RESUME on a resuming connection".format(provider_name))
+        return
+    _, received_count, token = unpack_msg_resume(msg)
+    provider = provider_sessions.get(token)
+    if not provider or provider.name != provider_name:
+        log_internal_warn("provider {} tried to resume an unknown session".format(provider_name))
+        await websocket.send(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_resume(0, result=RESUME_UNKNOWN)))
+        return
+
+    if provider.relay:
+        # the provider noticed that its websocket dropped before the gateway did
+        relay = provider.relay
+        provider.relay = None
+        relay.cancel()
+        await asyncio.wait([ relay ])
+    if provider.gap_timer:
+        provider.gap_timer.cancel()
+        provider.gap_timer = None
+
+    replay = provider.session.replay_after(received_count)
+    if replay is None:
+        log_internal_warn("provider {} can't resume, messages it missed were dropped from the replay buffer".format(provider_name))
+        await websocket.send(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_resume(0, result=RESUME_LOST)))
+        await remove_provider_connection(provider)
+        return
+
+    log_internal("provider {} resumed its session, sending {} messages again".format(provider_name, len(replay)))
+    if provider.stats:
+        provider.stats.resumes_total += 1
+    answer = pack_msg_provider(CONTROL_STREAM_ID, pack_msg_resume(provider.session.received_count))
+    await serve_provider_connection(websocket, provider, [ answer ] + replay)
+
+# workers
+
+async def announce_providers(action: bytes, provider_names: List[str]):
+    """Tells the other workers that the first connection of a provider was opened on this
+    worker or that its last one was closed."""
+    frame = action + "\n".join(provider_names).encode(encoding="utf-8")
+    for index, link in list(registry_links.items()):
+        try:
+            await link.send(frame)
+        except (ConnectionError, OSError) as e:
+            log_internal_warn("registry link to worker {} failed: {}".format(index, e))
+            registry_links.pop(index, None)
+
+async def connect_registry_link(index: int):
+    link = await open_peer_link(peer_socket_path(RUN_DIR, index))
+    await link.send(PEER_LINK_REGISTRY + struct.pack("!I", WORKER_INDEX))
+    # the link is added before sending the snapshot, so no change is missed. As the snapshot
+    # is a single frame written right away, it can't overtake a later removal.
+    registry_links[index] = link
+    if provider_connection_map:
+        await link.send(REGISTRY_ADD + "\n".join(provider_connection_map.keys()).encode(encoding="utf-8"))
+
+async def handle_peer_registry(link: PeerLink, index: int):
+    log_internal("worker {} connected".format(index))
+    try:
+        while True:
+            frame = await link.recv()
+            provider_names = frame[1:].decode(encoding="utf-8").split("\n")
+            for provider_name in provider_names:
+                if frame[:1] == REGISTRY_ADD:
+                    remote_provider_map.setdefault(provider_name, set()).add(index)
+                elif frame[:1] == REGISTRY_REMOVE:
+                    workers = remote_provider_map.get(provider_name, set())
+                    workers.discard(index)
+                    if not workers:
+                        remote_provider_map.pop(provider_name, None)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        log_internal_warn("worker {} disconnected".format(index))
+    finally:
+        for provider_name, workers in list(remote_provider_map.items()):
+            workers.discard(index)
+            if not workers:
+                remote_provider_map.pop(provider_name, None)
+
+async def connect_peer_provider(index: int, provider_name: str):
+    """Opens a link to a worker with a connection of the provider. The streams placed on the
+    link are served by that worker like the streams of a multiplexed client."""
+    log_internal("reaching provider {} over worker {}".format(provider_name, index))
+    link = await open_peer_link(peer_socket_path(RUN_DIR, index), retries=1)
+    await link.send(PEER_LINK_STREAMS + provider_name.encode(encoding="utf-8"))
+    provider = ProviderConnection()
+    peer_provider_connections[(index, provider_name)] = provider
+    asyncio.create_task(run_peer_provider_connection(link, provider, index, provider_name))
+    return provider
+
+async def run_peer_provider_connection(link: PeerLink, provider: ProviderConnection, index: int, provider_name: str):
+    try:
+        await run_provider_connection(link, provider)
     finally:
-        await provider_recv_queue_map.remove_queue(provider_name)
+        peer_provider_connections.pop((index, provider_name), None)
+        await link.close()
+        await close_provider_streams(provider)
+
+async def handle_peer_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    link = PeerLink(reader, writer)
+    try:
+        frame = await link.recv()
+        if frame[:1] == PEER_LINK_REGISTRY:
+            index, = struct.unpack("!I", frame[1:5])
+            await handle_peer_registry(link, index)
+        elif frame[:1] == PEER_LINK_STREAMS:
+            await handle_connection_multiplexed_client(link, frame[1:].decode(encoding="utf-8"))
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        await link.close()
+
+# metrics
+
+def collect_metrics(writer: MetricsWriter):
+    worker_labels = { "worker": WORKER_INDEX } if WORKER_COUNT > 1 else {}
+
+    writer.metric("wsgw_provider_connections", "gauge", "Open websockets of a provider.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_provider_connections", len(connections), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_streams", "gauge", "Streams placed on the connections of a provider.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_provider_streams", sum(len(connection.client_queues) for connection in connections), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_streams_total", "counter", "Streams placed on the connections of a provider.")
+    for provider_name, stats in provider_stats.items():
+        writer.sample("wsgw_provider_streams_total", stats.streams_total, provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_resumes_total", "counter", "Sessions a provider resumed after its websocket dropped.")
+    for provider_name, stats in provider_stats.items():
+        writer.sample("wsgw_provider_resumes_total", stats.resumes_total, provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_detached_connections", "gauge", "Connections of a provider waiting for it to resume them.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_provider_detached_connections", sum(not connection.attached for connection in connections), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_frames_total", "counter", "Websocket messages from and to a provider.")
+    for provider_name, stats in provider_stats.items():
+        writer.sample("wsgw_provider_frames_total", stats.to_provider.frames, provider=provider_name, direction="to_provider", **worker_labels)
+        writer.sample("wsgw_provider_frames_total", stats.to_client.frames, provider=provider_name, direction="to_client", **worker_labels)
+
+    writer.metric("wsgw_provider_bytes_total", "counter", "Bytes of the websocket messages from and to a provider.")
+    for provider_name, stats in provider_stats.items():
+        writer.sample("wsgw_provider_bytes_total", stats.to_provider.bytes, provider=provider_name, direction="to_provider", **worker_labels)
+        writer.sample("wsgw_provider_bytes_total", stats.to_client.bytes, provider=provider_name, direction="to_client", **worker_labels)
+
+    writer.metric("wsgw_provider_queue_frames", "gauge", "Messages waiting to be sent to a provider.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_provider_queue_frames", sum(connection.queue.qsize() for connection in connections), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_provider_queue_bytes", "gauge", "Bytes waiting to be sent to a provider.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_provider_queue_bytes", sum(connection.queued_bytes for connection in connections), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_client_queue_frames", "gauge", "Messages waiting to be sent to the clients of a provider.")
+    for provider_name, connections in provider_connection_map.items():
+        writer.sample("wsgw_client_queue_frames", sum(client_queue.qsize() for connection in connections for client_queue in connection.client_queues.values()), provider=provider_name, **worker_labels)
+
+    writer.metric("wsgw_multiplexed_client_queue_frames", "gauge", "Messages waiting to be sent to multiplexed clients.")
+    writer.sample("wsgw_multiplexed_client_queue_frames", sum(connection.send_queue.qsize() for connection in multiplexed_client_connections), **worker_labels)
+
+    writer.metric("wsgw_queue_wait_seconds", "histogram", "Time messages waited in a queue of the gateway.")
+    for queue_name, histogram in queue_wait_histograms.items():
+        writer.histogram("wsgw_queue_wait_seconds", histogram, queue=queue_name, **worker_labels)
+
+    if METRICS_PER_STREAM:
+        writer.metric("wsgw_stream_bytes_total", "counter", "Bytes of the messages of an open stream.")
+        for provider_name, connections in provider_connection_map.items():
+            for connection in connections:
+                for client_id, client_queue in connection.client_queues.items():
+                    writer.sample("wsgw_stream_bytes_total", client_queue.bytes_to_provider, provider=provider_name, client_id=client_id, direction="to_provider", **worker_labels)
+                    writer.sample("wsgw_stream_bytes_total", client_queue.bytes_to_client, provider=provider_name, client_id=client_id, direction="to_client", **worker_labels)
+
+    if DIAGNOSTICS:
+        DIAGNOSTICS.write_metrics(writer, **worker_labels)
+
+def process_request(path: str, request_headers):
+    """Answers requests for the metrics path with the metrics, all others become websockets."""
+    if METRICS_PATH and path == METRICS_PATH:
+        return HTTPStatus.OK, [ ("Content-Type", CONTENT_TYPE) ], render_metrics(collect_metrics)
+    return None
 
 async def handle_connection(websocket, path: str):
-    log_internal("ws-client connected to path: {}".format(path))
+    log_internal("ws-client connected to path: %s using protocol version %d", path, negotiated_version(websocket.subprotocol))
     
     pw_data: bytes = await websocket.recv()
     pw_text = pw_data.decode(encoding="utf-8")
@@ -119,24 +743,115 @@ async def handle_connection(websocket, path: str):
     if path.startswith("/c/"):
         log_internal("connection is used as client")
         provider_name = path[3:]
-        await handle_connection_client(websocket, provider_name)
+        await handle_connection_client(wire_link(websocket, False), provider_name)
+    elif path.startswith("/m/"):
+        log_internal("connection is used as multiplexed client")
+        provider_name = path[3:]
+        await handle_connection_multiplexed_client(wire_link(websocket, True), provider_name)
     elif path.startswith("/p/"):
         log_internal("connection is used as provider")
         provider_name = path[3:]
-        await handle_connection_provider(websocket, provider_name)
+        await handle_connection_provider(wire_link(websocket, True), provider_name)
+    elif path.startswith("/s/"):
+        log_internal("connection resumes a provider session")
+        provider_name = path[3:]
+        await handle_connection_resume(wire_link(websocket, True), provider_name)
+
+async def serve_websockets(port: Union[int, None], unix_path: Union[str, None], reuse_port: bool = False):
+    """Accepts websockets on the port, or on the unix socket behind a reverse proxy."""
+    if unix_path:
+        remove_stale_socket(unix_path)
+        return await websockets.unix_serve(handle_connection, unix_path, process_request=process_request, subprotocols=subprotocols(PROTOCOL_VERSION))
+    return await websockets.serve(handle_connection, 'localhost', port, reuse_port=reuse_port, process_request=process_request, subprotocols=subprotocols(PROTOCOL_VERSION))
+
+async def start_worker(port: Union[int, None], unix_path: Union[str, None]):
+    """Runs one worker of a gateway with several workers. Every worker accepts websockets
+    on the shared port, or on the unix socket suffixed with its index, and streams reach
+    providers connected to other workers over unix sockets."""
+    await serve_websockets(port, unix_path and "{}.{}".format(unix_path, WORKER_INDEX), reuse_port=True)
+    await asyncio.start_unix_server(handle_peer_connection, path=peer_socket_path(RUN_DIR, WORKER_INDEX))
+    await asyncio.gather(*[ connect_registry_link(index) for index in range(WORKER_COUNT) if index != WORKER_INDEX ])
+    start_capture()
+    if DIAGNOSTICS:
+        await DIAGNOSTICS.start()
+    log_internal("worker {} of {} started".format(WORKER_INDEX + 1, WORKER_COUNT))
+    await asyncio.get_running_loop().create_future()
+
+def run_worker(settings: Dict[str, Any], port: Union[int, None], unix_path: Union[str, None], log_settings: Tuple):
+    # the log listener thread of the parent is not running in this process
+    configure_logging(*log_settings)
+    globals().update(settings)
+    asyncio.run(start_worker(port, unix_path))
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--workers', dest='workers', type=int, help='Number of worker processes, overrides gateway.workers.')
 
 def main():
-    config = setup_args_and_config("Gateway")
+    config = setup_args_and_config("Gateway", add_arguments)
     config.parse_gateway_password()
     config.parse_gateway_port()
+    config.parse_gateway_protocol()
+    config.parse_gateway_workers()
+    config.parse_gateway_placement()
+    config.parse_flow_control()
+    config.parse_batch()
+    config.parse_session()
+    config.parse_scheduler()
+    config.parse_capture()
+    config.parse_metrics()
+    config.parse_diagnostics()
     config.finish()
+    setup_logging(config)
 
-    global PW
+    global PW, PROTOCOL_VERSION, FLOW_MAX_WINDOW, FLOW_MAX_QUEUED, PLACEMENT, BATCH_ENABLED, BATCH_MAX_SIZE, BATCH_DELAY_US, METRICS_PATH, METRICS_PER_STREAM, SESSION_RESUME, SESSION_RESUME_TIMEOUT, SESSION_REPLAY_BUFFER, SCHEDULER_ENABLED, SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, SCHEDULER_PROVIDER_RATE, CAPTURE_PATH, CAPTURE_PAYLOAD, DIAGNOSTICS, WORKER_COUNT, RUN_DIR
     PW = config.gateway_pw
+    PROTOCOL_VERSION = config.gateway_protocol
+    FLOW_MAX_WINDOW = config.flow_max_window
+    FLOW_MAX_QUEUED = config.flow_max_queued
+    PLACEMENT = config.gateway_placement
+    BATCH_ENABLED = config.batch_enabled
+    BATCH_MAX_SIZE = config.batch_max_size
+    BATCH_DELAY_US = config.batch_delay_us
+    METRICS_PATH = config.metrics_path
+    METRICS_PER_STREAM = config.metrics_per_stream
+    SESSION_RESUME = config.session_resume
+    SESSION_RESUME_TIMEOUT = config.session_resume_timeout
+    SESSION_REPLAY_BUFFER = config.session_replay_buffer
+    SCHEDULER_ENABLED = config.scheduler_enabled
+    SCHEDULER_QUANTUM = config.scheduler_quantum
+    SCHEDULER_STREAM_RATE = config.scheduler_stream_rate
+    SCHEDULER_PROVIDER_RATE = config.scheduler_provider_rate
+    CAPTURE_PATH = config.capture_path
+    CAPTURE_PAYLOAD = config.capture_payload
+    DIAGNOSTICS = setup_diagnostics(config, "gateway")
+    WORKER_COUNT = config.gateway_workers
+
+    if WORKER_COUNT == 1:
+        asyncio.get_event_loop().run_until_complete(serve_websockets(config.gateway_port, config.gateway_unix_path))
+        if DIAGNOSTICS:
+            asyncio.get_event_loop().run_until_complete(DIAGNOSTICS.start())
+        asyncio.get_event_loop().call_soon(start_capture)
+        asyncio.get_event_loop().run_forever()
+        return
 
-    start_server = websockets.serve(handle_connection, 'localhost', config.gateway_port)
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    RUN_DIR = tempfile.mkdtemp(prefix="wsgw-gateway-")
+    settings = { name: globals()[name] for name in [ "PW", "PROTOCOL_VERSION", "FLOW_MAX_WINDOW", "FLOW_MAX_QUEUED", "PLACEMENT", "BATCH_ENABLED", "BATCH_MAX_SIZE", "BATCH_DELAY_US", "METRICS_PATH", "METRICS_PER_STREAM", "SESSION_RESUME", "SESSION_RESUME_TIMEOUT", "SESSION_REPLAY_BUFFER", "SCHEDULER_ENABLED", "SCHEDULER_QUANTUM", "SCHEDULER_STREAM_RATE", "SCHEDULER_PROVIDER_RATE", "CAPTURE_PATH", "CAPTURE_PAYLOAD", "WORKER_COUNT", "RUN_DIR" ] }
+    workers = [ multiprocessing.Process(target=run_worker, args=(dict(settings, WORKER_INDEX=index, DIAGNOSTICS=DIAGNOSTICS and DIAGNOSTICS.for_worker(index)), config.gateway_port, config.gateway_unix_path, (config.logLevel, config.logFilename, config.traceSample)), daemon=True) for index in range(WORKER_COUNT) ]
+    for worker in workers:
+        worker.start()
+
+    # daemon processes are only terminated on a regular exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if DIAGNOSTICS:
+        # every worker writes a profile of its own
+        signal.signal(signal.SIGUSR1, lambda signum, frame: [ os.kill(worker.pid, signal.SIGUSR1) for worker in workers ])
+    try:
+        # the workers depend on each other, if one of them exits the gateway stops
+        multiprocessing.connection.wait([ worker.sentinel for worker in workers ])
+    finally:
+        for worker in workers:
+            worker.terminate()
+        shutil.rmtree(RUN_DIR, ignore_errors=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
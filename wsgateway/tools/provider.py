@@ -1,144 +1,533 @@
 import asyncio
+import errno
+import multiprocessing
+import os
+import random
+import socket
+import time
 import websockets
-from wsgateway.utils import KeyedQueueMap, read_into_queue
+from typing import Any, Dict, List, Set, Tuple, Union
+from wsgateway.utils import StreamRelay, TCPStreamEndpoint
+from wsgateway.flow import DEFAULT_WINDOW_SIZE, DEFAULT_MAX_QUEUED
+from wsgateway.routing import RoutingTable
+from wsgateway.upstream import DNSCache, UpstreamPool
+from wsgateway.udp import DatagramFlow, FlowProtocol, expire_flows
+from wsgateway.relay import pump, run_relay
+from wsgateway.session import LinkSession, is_session_message, RESUME_BACKOFF_MIN, RESUME_BACKOFF_MAX
+from wsgateway.batch import FrameQueue
+from wsgateway.scheduler import StreamScheduler, TokenBucket
+from wsgateway.diagnostics import Diagnostics, setup_diagnostics
+from wsgateway.metrics import Histogram, MetricsWriter, TrafficCounter, serve_metrics
+from wsgateway.compression import compression_stats
 from wsgateway.messages import *
+from wsgateway.wire import subprotocols, wire_link
 from wsgateway.log import *
 import logging
 import argparse
 from wsgateway.config import setup_args_and_config
 
 GATEWAY_URL_FULL = ""
+GATEWAY_RESUME_URL_FULL = ""
 GATEWAY_PW = ""
+PROTOCOL_VERSION = 1
+TCP_MAX_READ_SIZE = 0
+TCP_HIGH_WATER = 0
+TCP_WRITE_HIGH_WATER = 0
+FLOW_WINDOW = DEFAULT_WINDOW_SIZE
+FLOW_MAX_QUEUED = DEFAULT_MAX_QUEUED
+PROVIDER_CONNECTIONS = 1
+PROVIDER_WORKERS = 1
+# the unix sockets clients may open streams to
+UNIX_PATHS: Set[str] = set()
+BATCH_ENABLED = False
+BATCH_MAX_SIZE = 0
+BATCH_DELAY_US = 0
+COMPRESSION_LEVEL = None
+# permessage-deflate of the websocket, turned off when the payloads are compressed already
+WEBSOCKET_COMPRESSION = "deflate"
+METRICS_PORT = None
+UPSTREAM_DNS_TTL = 0.0
+UPSTREAM_POOL_SIZE = 0
+UPSTREAM_POOL_IDLE = 0.0
+UDP_IDLE_TIMEOUT = 0.0
+SESSION_RESUME = True
+SESSION_RESUME_TIMEOUT = 0.0
+SESSION_REPLAY_BUFFER = 0
+SCHEDULER_ENABLED = True
+SCHEDULER_QUANTUM = 0
+SCHEDULER_STREAM_RATE = 0
+SCHEDULER_PROVIDER_RATE = 0
+DIAGNOSTICS: Union[Diagnostics, None] = None
 
-websocket_send_queue: asyncio.Queue = None
-websocket_recv_queue_map = KeyedQueueMap()
+class ProviderStats(object):
+    """Traffic and streams of this process."""
+    __slots__ = ("to_gateway", "from_gateway", "streams_total", "tcp_connect")
+    to_gateway: TrafficCounter
+    from_gateway: TrafficCounter
+    streams_total: int
+    tcp_connect: Histogram
 
-async def handle_client(client_id: int, open_msg: bytes):
-    log_internal("creating client with id: {}".format(client_id))
+    def __init__(self):
+        self.to_gateway = TrafficCounter()
+        self.from_gateway = TrafficCounter()
+        self.streams_total = 0
+        self.tcp_connect = Histogram()
+
+stats = ProviderStats()
+
+# how long messages wait in the queues of the provider, by queue. only recorded with metrics enabled.
+queue_wait_histograms: Dict[str, Histogram] = {}
+
+def queue_wait_histogram(queue_name: str):
+    if not METRICS_PORT:
+        return None
+    return queue_wait_histograms.setdefault(queue_name, Histogram())
+
+# limits the traffic to the gateway over all connections of this process
+provider_bucket: Union[TokenBucket, None] = None
+
+def send_scheduler():
+    global provider_bucket
+    if not SCHEDULER_ENABLED:
+        return None
+    if SCHEDULER_PROVIDER_RATE and not provider_bucket:
+        provider_bucket = TokenBucket(SCHEDULER_PROVIDER_RATE, SCHEDULER_QUANTUM)
+    return StreamScheduler(SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, provider_bucket)
+
+class GatewayConnection(object):
+    """A websocket to the gateway. The gateway places every stream on one of the connections
+    of a provider, so each connection has its own streams. With a `session` the websocket
+    can be replaced by a new one resuming it, the streams stay open in between.
+
+    The streams are kept in `recv_queues` as `StreamRelay` and `DatagramFlow` records."""
+    send_queue: FrameQueue
+    recv_queues: RoutingTable
+    batching: bool
+    session: Union[LinkSession, None]
+
+    def __init__(self):
+        self.send_queue = FrameQueue(queue_wait_histogram("gateway_send"), send_scheduler())
+        self.recv_queues = RoutingTable()
+        self.batching = False
+        self.session = None
+
+    async def next_message(self):
+        if self.batching:
+            return await self.send_queue.get_batch(BATCH_MAX_SIZE, BATCH_DELAY_US)
+        return await self.send_queue.get()
+
+    def remove_stream(self, record: Union[StreamRelay, DatagramFlow]):
+        if self.recv_queues.get(record.stream_id) is record:
+            self.recv_queues.remove(record.stream_id)
+
+    def close_streams(self):
+        """Ends the streams once the connection is gone for good. Streams whose socket is
+        still being opened are finished as well, their opener closes the socket."""
+        for record in list(self.recv_queues.values()):
+            if isinstance(record, DatagramFlow):
+                record.close(send_close=False)
+            else:
+                record.finish()
+
+gateway_connections: List[GatewayConnection] = []
+upstream_pool: UpstreamPool = None
+udp_flows: Set[DatagramFlow] = set()
+
+def open_fail_reason(error: OSError):
+    if isinstance(error, socket.gaierror) or error.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH):
+        return OPEN_FAIL_UNREACHABLE
+    if isinstance(error, (ConnectionRefusedError, PermissionError)):
+        return OPEN_FAIL_REFUSED
+    if isinstance(error, TimeoutError):
+        return OPEN_FAIL_TIMEOUT
+    return OPEN_FAIL_ERROR
+
+async def handle_client(connection: GatewayConnection, client_id: int, open_msg: bytes):
+    log_internal("creating client with id: %d", client_id)
     hostname, port = unpack_msg_open(open_msg)
 
     log_internal("resolving the recv queue")
-    recv_queue = await websocket_recv_queue_map.get_queue(client_id)
-    if not recv_queue:
-        await websocket_send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
+    relay: StreamRelay = connection.recv_queues.get(client_id)
+    if not relay:
+        await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
         log_internal("client recv queue not found. Closing...")
         return
 
-    log_internal("opening a tcp connection to {}:{}".format(hostname, port))
-    reader, writer = await asyncio.open_connection(hostname, port)
-    is_remote_connection_closed = False
+    unix = unpack_msg_open_type(open_msg) == OPEN_TYPE_UNIX
+    if unix:
+        log_internal("opening a connection to unix:%s", hostname)
+    else:
+        log_internal("opening a connection to %s:%d", hostname, port)
+    connect_started = time.monotonic()
+    try:
+        if unix and os.path.normpath(hostname) not in UNIX_PATHS:
+            raise PermissionError(errno.EACCES, "not one of the unix sockets of the provider")
+        stream = await upstream_pool.acquire(hostname, port, unix)
+    except OSError as e:
+        target = "unix:" + hostname if unix else "{}:{}".format(hostname, port)
+        log_internal("could not connect to %s: %s", target, e)
+        connection.remove_stream(relay)
+        await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_open_fail(open_fail_reason(e), "{}: {}".format(target, e))))
+        await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
+        return
+    stats.tcp_connect.observe(time.monotonic() - connect_started)
+    if relay.closing:
+        # the stream was closed while connecting
+        stream.close()
+        return
+
+    endpoint = TCPStreamEndpoint(stream, relay.send_message, FLOW_WINDOW, COMPRESSION_LEVEL, client_id)
+    relay.attach(endpoint)
+
+    try:
+        await relay.send_message(pack_msg_open_ack())
+        await endpoint.grant_window()
+        if unpack_msg_open_flags(open_msg) & OPEN_FLAG_COMPRESS and COMPRESSION_LEVEL is not None:
+            await relay.send_message(pack_msg_compress_ack())
+            endpoint.enable_compression()
+        first_data = unpack_msg_open_data(open_msg)
+        if first_data:
+            await endpoint.write_data(first_data)
+    except Exception as e:
+        log_internal("server had error event: %s", e)
+        relay.finish()
+        return
+    if relay.closing:
+        # the stream was closed while answering the OPEN, which closed the socket
+        return
+    # from here on the stream only has a task while there is data to relay
+    relay.start()
+
+async def handle_udp_client(connection: GatewayConnection, flow: DatagramFlow, open_msg: bytes):
+    hostname, port = unpack_msg_open(open_msg)
+    transport = None
 
-    reader_closed = asyncio.Event()
-    reader_queue = asyncio.Queue()
-    asyncio.create_task(read_into_queue(reader_queue, reader, reader_closed))
+    def remove_flow(flow: DatagramFlow):
+        udp_flows.discard(flow)
+        connection.remove_stream(flow)
+        if transport:
+            transport.close()
 
+    flow.on_close = remove_flow
+    log_internal("opening a udp socket to %s:%d", hostname, port)
     try:
-        while not writer.is_closing() and not reader_closed.is_set():
-            listener_task = asyncio.ensure_future(recv_queue.get())
-            producer_task = asyncio.ensure_future(reader_queue.get())
-
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
-
-            if listener_task in done:
-                message = listener_task.result()
-
-                if message[0] == MSG_TYPE_DATA:
-                    message_data = unpack_msg_data(message)
-                    log_inbound_msg_data()
-                    writer.write(message_data)
-                    await writer.drain()
-                elif message[0] == MSG_TYPE_CLOSE:
-                    log_inbound_msg_close_connection()
-                    is_remote_connection_closed = True
-                    writer.close()
-                    await writer.wait_closed()
+        family, _, _, _, address = (await upstream_pool.dns.resolve(hostname, port))[0]
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(lambda: FlowProtocol(flow), remote_addr=address[:2], family=family)
+    except OSError as e:
+        log_internal("could not open a udp socket to %s:%d: %s", hostname, port, e)
+        connection.send_queue.put_nowait(pack_msg_provider(flow.stream_id, pack_msg_open_fail(open_fail_reason(e), "{}:{}: {}".format(hostname, port, e))))
+        flow.close()
+        return
+
+    if flow.closed:
+        transport.close()
+        return
+    connection.send_queue.put_nowait(pack_msg_provider(flow.stream_id, pack_msg_open_ack()))
+    flow.attach(transport.sendto)
+
+async def connect_gateway(url: str):
+    websocket = await websockets.connect(url, compression=WEBSOCKET_COMPRESSION, subprotocols=subprotocols(PROTOCOL_VERSION))
+    await websocket.send(GATEWAY_PW.encode(encoding="utf-8"))
+    return wire_link(websocket, True)
+
+async def resume_session(connection: GatewayConnection):
+    """Opens a new websocket resuming the session of the connection, retrying with an exponential
+    backoff. Returns the websocket with the messages the gateway missed sent again, None if
+    the session can't be resumed."""
+    session = connection.session
+    deadline = time.monotonic() + SESSION_RESUME_TIMEOUT
+    delay = RESUME_BACKOFF_MIN
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(delay * random.uniform(0.5, 1.0), max(deadline - time.monotonic(), 0)))
+        delay = min(delay * 2, RESUME_BACKOFF_MAX)
+        try:
+            websocket = await asyncio.wait_for(connect_gateway(GATEWAY_RESUME_URL_FULL), max(deadline - time.monotonic(), 0.001))
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            log_internal("resuming the session failed, retrying: {}".format(e))
+            continue
+
+        try:
+            await websocket.send(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_resume(session.received_count, session.token)))
+            _, msg = unpack_msg_provider(await websocket.recv())
+            result, gateway_received, _ = unpack_msg_resume(msg)
+            replay = session.replay_after(gateway_received) if result == RESUME_OK else None
+            if replay is None:
+                log_internal_warn("gateway did not resume the session, result {}".format(result))
+                await websocket.close()
+                return None
+            log_internal("resumed the session, sending {} messages again".format(len(replay)))
+            for message in replay:
+                await websocket.send(message)
+            return websocket
+        except websockets.WebSocketException as e:
+            log_internal("resuming the session failed, retrying: {}".format(e))
+    return None
+
+async def run_gateway_connection():
+    connection = GatewayConnection()
+    if SESSION_RESUME:
+        connection.session = LinkSession(SESSION_REPLAY_BUFFER)
+    websocket = await connect_gateway(GATEWAY_URL_FULL)
+
+    features = (FEATURE_BATCH if BATCH_ENABLED else 0) | (FEATURE_RESUME if SESSION_RESUME else 0)
+    if features:
+        await websocket.send(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_hello(features)))
+
+    async def distribute_message(message: bytes):
+        client_id, client_msg = unpack_msg_provider(message)
+        if client_id == CONTROL_STREAM_ID:
+            await handle_control_message(client_msg)
+        else:
+            await distribute_stream_message(client_id, client_msg)
+
+    async def handle_control_message(control_msg: bytes):
+        if control_msg[0] == MSG_TYPE_BATCH:
+            for client_id, client_msg in iter_msg_batch(control_msg):
+                if client_id == CONTROL_STREAM_ID:
+                    await handle_control_message(client_msg)
                 else:
-                    log_inbound("unexpected message: {}".format(message.hex()[:20]))
-            else:
-                listener_task.cancel()
+                    await distribute_stream_message(client_id, client_msg)
+        elif control_msg[0] == MSG_TYPE_HELLO:
+            features = unpack_msg_hello(control_msg)
+            connection.batching = bool(features & FEATURE_BATCH)
+            log_internal("gateway agreed to batching: {}, resuming sessions: {}".format(connection.batching, bool(features & FEATURE_RESUME)))
+            if not features & FEATURE_RESUME:
+                connection.session = None
+        elif control_msg[0] == MSG_TYPE_SESSION:
+            if connection.session:
+                connection.session.token = unpack_msg_session(control_msg)
+        elif control_msg[0] == MSG_TYPE_SESSION_ACK:
+            if connection.session:
+                connection.session.acknowledged(unpack_msg_session_ack(control_msg))
+        elif control_msg[0] == MSG_TYPE_CLOSE:
+            # gateways without control messages answer the hello like a message of an unknown client
+            log_internal("gateway does not support batching")
+            connection.session = None
 
-            if producer_task in done:
-                message = producer_task.result()
-                if len(message) > 0:
-                    log_outbound_msg_data()
-                    await websocket_send_queue.put(pack_msg_provider(client_id, pack_msg_data(message)))
+    async def distribute_stream_message(client_id: int, client_msg: bytes):
+        if client_msg[0] == MSG_TYPE_OPEN:
+            log_inbound_msg_open_connection()
+            connection_type = unpack_msg_open_type(client_msg)
+            if connection_type in (OPEN_TYPE_TCP, OPEN_TYPE_UNIX):
+                relay = StreamRelay(connection.send_queue, client_id, queue_wait_histogram("stream"))
+                relay.on_close = connection.remove_stream
+                connection.recv_queues.add(client_id, relay)
+                stats.streams_total += 1
+                asyncio.create_task(handle_client(connection, client_id, client_msg))
+            elif connection_type == OPEN_TYPE_UDP:
+                # the flow takes the datagrams right away, the task only opens its socket
+                flow = DatagramFlow(connection.send_queue, client_id)
+                connection.recv_queues.add(client_id, flow)
+                udp_flows.add(flow)
+                stats.streams_total += 1
+                asyncio.create_task(handle_udp_client(connection, flow, client_msg))
             else:
-                producer_task.cancel()
-    except Exception as e:
-        log_internal("server had error event: {}".format(e))
+                await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_open_fail(OPEN_FAIL_ERROR, "unsupported connection type {}".format(connection_type))))
+                await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
+
+        else:
+            recv_queue: Union[StreamRelay, DatagramFlow] = connection.recv_queues.get(client_id)
+            if isinstance(recv_queue, StreamRelay) and client_msg[0] != MSG_TYPE_CLOSE and recv_queue.queued_bytes + len(client_msg) > FLOW_MAX_QUEUED:
+                # the limit holds whether or not the client uses flow control
+                log_internal_warn("stream with id {} queued more than {} bytes! Closing it...".format(client_id, FLOW_MAX_QUEUED))
+                recv_queue.finish()
+            elif recv_queue:
+                await recv_queue.put(client_msg)
+            elif client_msg[0] != MSG_TYPE_CLOSE:
+                await connection.send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
+                log_internal("client with id %d not found. Closing...", client_id)
+
+    async def send_message(message: bytes):
+        stats.to_gateway.add(frame_len(message))
+        if connection.session and is_session_message(message):
+            connection.session.sent(message)
+        await websocket.send(message)
+
+    async def receive_message():
+        message = await websocket.recv()
+        stats.from_gateway.add(frame_len(message))
+        session = connection.session
+        if session and is_session_message(message) and session.received(frame_len(message)):
+            connection.send_queue.put_nowait(pack_msg_provider(CONTROL_STREAM_ID, pack_msg_session_ack(session.received_count)))
+        return message
+
+    gateway_connections.append(connection)
+    try:
+        while websocket:
+            try:
+                await run_relay(
+                    pump(receive_message, distribute_message),
+                    pump(connection.next_message, send_message))
+            except websockets.WebSocketException as e:
+                log_internal("gateway connection closed: {}".format(e))
+            finally:
+                await websocket.close()
+
+            # the streams wait for the session to be resumed
+            if not connection.session or not connection.session.token:
+                break
+            log_internal_warn("gateway connection dropped, resuming the session with {} streams".format(len(connection.recv_queues)))
+            websocket = await resume_session(connection)
     finally:
-        log_internal("provider connectio has closed")
-        if not is_remote_connection_closed:
-            log_outbound_msg_close_connection()
-            await websocket_send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
-        if not writer.is_closing():
-            log_internal("closing the tcp socket")
-            writer.close()
-            await writer.wait_closed()
-        await websocket_recv_queue_map.remove_queue(client_id)
-        
+        gateway_connections.remove(connection)
+        connection.close_streams()
 
-async def start_provider():
-    global websocket_send_queue
+def collect_metrics(writer: MetricsWriter):
+    writer.metric("wsgw_gateway_connections", "gauge", "Open websockets to the gateway.")
+    writer.sample("wsgw_gateway_connections", len(gateway_connections))
 
-    websocket_send_queue = asyncio.Queue()
-    async with websockets.connect(GATEWAY_URL_FULL) as websocket:
-        await websocket.send(GATEWAY_PW.encode(encoding="utf-8"))
+    writer.metric("wsgw_streams", "gauge", "Open streams.")
+    writer.sample("wsgw_streams", sum(len(connection.recv_queues) for connection in gateway_connections))
 
-        while websocket.open:
-            listener_task = asyncio.ensure_future(websocket.recv())
-            producer_task = asyncio.ensure_future(websocket_send_queue.get())
+    writer.metric("wsgw_udp_flows", "gauge", "Open udp flows.")
+    writer.sample("wsgw_udp_flows", len(udp_flows))
 
-            done, pending = await asyncio.wait(
-                [listener_task, producer_task],
-                return_when=asyncio.FIRST_COMPLETED)
+    writer.metric("wsgw_streams_total", "counter", "Streams opened by the gateway.")
+    writer.sample("wsgw_streams_total", stats.streams_total)
 
-            if listener_task in done:
-                message = listener_task.result()
-                client_id, client_msg = unpack_msg_provider(message)
+    writer.metric("wsgw_gateway_frames_total", "counter", "Websocket messages from and to the gateway.")
+    writer.sample("wsgw_gateway_frames_total", stats.to_gateway.frames, direction="to_gateway")
+    writer.sample("wsgw_gateway_frames_total", stats.from_gateway.frames, direction="from_gateway")
 
-                if client_msg[0] == MSG_TYPE_OPEN:
-                    log_inbound_msg_open_connection()
-                    await websocket_recv_queue_map.create_named_queue(client_id)
-                    asyncio.create_task(handle_client(client_id, client_msg))
+    writer.metric("wsgw_gateway_bytes_total", "counter", "Bytes of the websocket messages from and to the gateway.")
+    writer.sample("wsgw_gateway_bytes_total", stats.to_gateway.bytes, direction="to_gateway")
+    writer.sample("wsgw_gateway_bytes_total", stats.from_gateway.bytes, direction="from_gateway")
 
-                else:
-                    log_internal("received message, distributing")
-                    recv_queue: asyncio.Queue = await websocket_recv_queue_map.get_queue(client_id)
-                    if recv_queue:
-                        await recv_queue.put(client_msg)
-                    else:
-                        await websocket_send_queue.put(pack_msg_provider(client_id, pack_msg_close()))
-                        log_internal("client with id {} not found. Closing...".format(client_id))
-            else:
-                listener_task.cancel()
+    writer.metric("wsgw_gateway_queue_frames", "gauge", "Messages waiting to be sent to the gateway.")
+    writer.sample("wsgw_gateway_queue_frames", sum(connection.send_queue.qsize() for connection in gateway_connections))
 
-            if producer_task in done:
-                message = producer_task.result()
-                if len(message) > 0:
-                    log_internal("sending message")
-                    await websocket.send(message)
-            else:
-                producer_task.cancel()
+    writer.metric("wsgw_gateway_queue_bytes", "gauge", "Bytes waiting to be sent to the gateway.")
+    writer.sample("wsgw_gateway_queue_bytes", sum(connection.send_queue.queued_bytes for connection in gateway_connections))
+
+    writer.metric("wsgw_stream_queue_frames", "gauge", "Messages waiting to be written to tcp connections.")
+    writer.sample("wsgw_stream_queue_frames", sum(queue.qsize() for connection in gateway_connections for queue in connection.recv_queues.values()))
+
+    writer.metric("wsgw_queue_wait_seconds", "histogram", "Time messages waited in a queue of the provider.")
+    for queue_name, histogram in queue_wait_histograms.items():
+        writer.histogram("wsgw_queue_wait_seconds", histogram, queue=queue_name)
 
+    writer.metric("wsgw_tcp_connect_seconds", "histogram", "Time to open the tcp connection of a stream.")
+    writer.histogram("wsgw_tcp_connect_seconds", stats.tcp_connect)
+
+    writer.metric("wsgw_upstream_pool_total", "counter", "Tcp connections taken from the pool or opened on demand.")
+    writer.sample("wsgw_upstream_pool_total", upstream_pool.hits, result="hit")
+    writer.sample("wsgw_upstream_pool_total", upstream_pool.misses, result="miss")
+    writer.sample("wsgw_upstream_pool_total", upstream_pool.prewarm_failures, result="prewarm_failure")
+
+    writer.metric("wsgw_upstream_pool_idle", "gauge", "Prewarmed tcp connections waiting in the pool.")
+    writer.sample("wsgw_upstream_pool_idle", upstream_pool.idle_connections())
+
+    writer.metric("wsgw_dns_lookups_total", "counter", "Hostname lookups answered by the cache or resolved.")
+    writer.sample("wsgw_dns_lookups_total", upstream_pool.dns.hits, result="hit")
+    writer.sample("wsgw_dns_lookups_total", upstream_pool.dns.misses, result="miss")
+
+    writer.metric("wsgw_compression_bytes_total", "counter", "Bytes before and after compressing stream data.")
+    writer.sample("wsgw_compression_bytes_total", compression_stats.raw_bytes, stage="raw")
+    writer.sample("wsgw_compression_bytes_total", compression_stats.compressed_bytes, stage="compressed")
+
+    writer.metric("wsgw_compression_cpu_seconds_total", "counter", "Cpu time spent compressing and decompressing stream data.")
+    writer.sample("wsgw_compression_cpu_seconds_total", compression_stats.compress_seconds, operation="compress")
+    writer.sample("wsgw_compression_cpu_seconds_total", compression_stats.decompress_seconds, operation="decompress")
+
+    if DIAGNOSTICS:
+        DIAGNOSTICS.write_metrics(writer)
+
+async def start_provider():
+    """Runs the gateway connections of this process until the first one closes."""
+    global upstream_pool
+    upstream_pool = UpstreamPool(DNSCache(UPSTREAM_DNS_TTL), UPSTREAM_POOL_SIZE, UPSTREAM_POOL_IDLE,
+        max_read_size=TCP_MAX_READ_SIZE, high_water=TCP_HIGH_WATER, write_high_water=TCP_WRITE_HIGH_WATER)
+    if METRICS_PORT:
+        await serve_metrics(collect_metrics, "localhost", METRICS_PORT)
+    if DIAGNOSTICS:
+        await DIAGNOSTICS.start()
+    expiry = asyncio.ensure_future(expire_flows(lambda: udp_flows, UDP_IDLE_TIMEOUT))
+    tasks = [ asyncio.ensure_future(run_gateway_connection()) for _ in range(PROVIDER_CONNECTIONS) ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        expiry.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        upstream_pool.close()
+
+def run_worker(settings: Dict[str, Any], log_settings: Tuple):
+    # the log listener thread of the parent is not running in this process
+    configure_logging(*log_settings)
+    globals().update(settings)
+    asyncio.run(start_provider())
 
 def main():
     config = setup_args_and_config("Provider")
     config.parse_gateway_password()
     config.parse_gateway_url()
+    config.parse_gateway_protocol()
     config.parse_provider_name()
+    config.parse_provider_connections()
+    config.parse_provider_unix_paths()
+    config.parse_tcp()
+    config.parse_upstream()
+    config.parse_udp()
+    config.parse_flow_control()
+    config.parse_batch()
+    config.parse_compression()
+    config.parse_session()
+    config.parse_scheduler()
+    config.parse_diagnostics()
+    config.parse_metrics()
     config.finish()
+    setup_logging(config)
 
-    global GATEWAY_PW, GATEWAY_URL_FULL
+    global GATEWAY_PW, GATEWAY_URL_FULL, PROTOCOL_VERSION, TCP_MAX_READ_SIZE, TCP_HIGH_WATER, TCP_WRITE_HIGH_WATER, FLOW_WINDOW, FLOW_MAX_QUEUED, PROVIDER_CONNECTIONS, PROVIDER_WORKERS, UNIX_PATHS, BATCH_ENABLED, BATCH_MAX_SIZE, BATCH_DELAY_US, COMPRESSION_LEVEL, WEBSOCKET_COMPRESSION, METRICS_PORT, UPSTREAM_DNS_TTL, UPSTREAM_POOL_SIZE, UPSTREAM_POOL_IDLE, UDP_IDLE_TIMEOUT, SESSION_RESUME, SESSION_RESUME_TIMEOUT, SESSION_REPLAY_BUFFER, GATEWAY_RESUME_URL_FULL, SCHEDULER_ENABLED, SCHEDULER_QUANTUM, SCHEDULER_STREAM_RATE, SCHEDULER_PROVIDER_RATE, DIAGNOSTICS
     GATEWAY_PW = config.gateway_pw
+    PROTOCOL_VERSION = config.gateway_protocol
+    TCP_MAX_READ_SIZE = config.tcp_max_read_size
+    TCP_HIGH_WATER = config.tcp_high_water
+    TCP_WRITE_HIGH_WATER = config.tcp_write_high_water
+    FLOW_WINDOW = config.flow_window
+    FLOW_MAX_QUEUED = config.flow_max_queued
+    PROVIDER_CONNECTIONS = config.provider_connections
+    PROVIDER_WORKERS = config.provider_workers
+    UNIX_PATHS = config.provider_unix_paths
+    BATCH_ENABLED = config.batch_enabled
+    BATCH_MAX_SIZE = config.batch_max_size
+    BATCH_DELAY_US = config.batch_delay_us
+    COMPRESSION_LEVEL = config.compression_level if config.compression_enabled else None
+    WEBSOCKET_COMPRESSION = None if config.compression_enabled else "deflate"
+    METRICS_PORT = config.metrics_port
+    UPSTREAM_DNS_TTL = config.upstream_dns_ttl
+    UPSTREAM_POOL_SIZE = config.upstream_pool_size
+    UPSTREAM_POOL_IDLE = config.upstream_pool_idle
+    UDP_IDLE_TIMEOUT = config.udp_idle_timeout
+    SESSION_RESUME = config.session_resume
+    SESSION_RESUME_TIMEOUT = config.session_resume_timeout
+    SESSION_REPLAY_BUFFER = config.session_replay_buffer
+    SCHEDULER_ENABLED = config.scheduler_enabled
+    SCHEDULER_QUANTUM = config.scheduler_quantum
+    SCHEDULER_STREAM_RATE = config.scheduler_stream_rate
+    SCHEDULER_PROVIDER_RATE = config.scheduler_provider_rate
+    DIAGNOSTICS = setup_diagnostics(config, "provider")
 
     gateway_url = config.gateway_url
-    gateway_url_base = gateway_url + "p/" if gateway_url.endswith("/") else gateway_url + "/p/"
-    GATEWAY_URL_FULL = gateway_url_base + config.provider_name
+    if not gateway_url.endswith("/"):
+        gateway_url += "/"
+    GATEWAY_URL_FULL = gateway_url + "p/" + config.provider_name
+    GATEWAY_RESUME_URL_FULL = gateway_url + "s/" + config.provider_name
 
-    asyncio.run(start_provider())
+    # every worker process opens its own gateway connections and runs its own event loop
+    settings = { name: globals()[name] for name in [ "GATEWAY_PW", "GATEWAY_URL_FULL", "PROTOCOL_VERSION", "TCP_MAX_READ_SIZE", "TCP_HIGH_WATER", "TCP_WRITE_HIGH_WATER", "FLOW_WINDOW", "FLOW_MAX_QUEUED", "PROVIDER_CONNECTIONS", "UNIX_PATHS", "BATCH_ENABLED", "BATCH_MAX_SIZE", "BATCH_DELAY_US", "COMPRESSION_LEVEL", "WEBSOCKET_COMPRESSION", "UPSTREAM_DNS_TTL", "UPSTREAM_POOL_SIZE", "UPSTREAM_POOL_IDLE", "UDP_IDLE_TIMEOUT", "SESSION_RESUME", "SESSION_RESUME_TIMEOUT", "SESSION_REPLAY_BUFFER", "GATEWAY_RESUME_URL_FULL", "SCHEDULER_ENABLED", "SCHEDULER_QUANTUM", "SCHEDULER_STREAM_RATE", "SCHEDULER_PROVIDER_RATE", "DIAGNOSTICS" ] }
+    # every worker serves its own metrics on the port after the one of the previous worker and
+    # listens for profile requests on its own socket
+    workers = [ multiprocessing.Process(target=run_worker, args=(dict(settings, METRICS_PORT=METRICS_PORT and METRICS_PORT + index, DIAGNOSTICS=DIAGNOSTICS and DIAGNOSTICS.for_worker(index)), (config.logLevel, config.logFilename, config.traceSample)), daemon=True) for index in range(1, PROVIDER_WORKERS) ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        asyncio.run(start_provider())
+    finally:
+        for worker in workers:
+            worker.terminate()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,384 @@
+import asyncio
+import heapq
+import re
+import time
+import urllib.parse
+import websockets
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple, Union
+from wsgateway.capture import CaptureRecord, read_capture, open_capture, CAPTURE_TO_PROVIDER, CAPTURE_TO_CLIENT, CAPTURE_DIRECTIONS
+from wsgateway.metrics import Histogram, TimedQueue
+from wsgateway.messages import *
+from wsgateway.wire import subprotocols, wire_link
+from wsgateway.log import *
+import argparse
+from wsgateway.config import setup_args_and_config
+
+# config
+
+GATEWAY_URL = ""
+GATEWAY_PW = ""
+PROTOCOL_VERSION = 1
+PROVIDER_NAME = ""
+REPLAY_SPEED = 1.0
+REPLAY_CLIENTS = 1
+REPLAY_PROVIDERS = 1
+METRICS_PATH = None
+
+# how long messages still in flight are waited for after the last one was sent
+DRAIN_TIMEOUT = 10.0
+METRICS_INTERVAL = 0.5
+# the streams are opened with this hostname and their index, which tells the synthetic
+# provider which stream the gateway opened
+OPEN_HOSTNAME_PREFIX = "wsgw-replay-"
+# flow control is not replayed, the gateway would police the replayed windows against
+# traffic with a different timing
+SKIPPED_TYPES = frozenset((MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_WINDOW_ACK))
+SLOWEST_SECONDS = 5
+
+class ReplayStream(object):
+    """A captured stream, opened by a synthetic client. `in_flight` holds the type, the send
+    time and the capture second of the messages sent in each direction and not received yet."""
+    __slots__ = ("index", "client_link", "stream_id", "provider_link", "client_id", "pending", "in_flight")
+    index: int
+    client_link: "ReplayLink"
+    stream_id: int
+    provider_link: Union["ReplayLink", None]
+    client_id: int
+    pending: List[Tuple[bytes, int]]
+    in_flight: Tuple[Deque[Tuple[int, float, int]], Deque[Tuple[int, float, int]]]
+
+    def __init__(self, index: int, client_link: "ReplayLink", stream_id: int):
+        self.index = index
+        self.client_link = client_link
+        self.stream_id = stream_id
+        self.provider_link = None
+        self.client_id = 0
+        # messages of the provider before the gateway opened the stream on a provider link
+        self.pending = []
+        self.in_flight = (deque(), deque())
+
+class ReplayLink(object):
+    """A websocket of a synthetic client or provider, with the streams on it by their id."""
+    websocket: object
+    queue: TimedQueue
+    streams: Dict[int, ReplayStream]
+    next_stream_id: int
+
+    def __init__(self, websocket, wait_histogram: Histogram):
+        self.websocket = websocket
+        self.queue = TimedQueue(wait_histogram)
+        self.streams = {}
+        self.next_stream_id = 1
+
+    def send(self, stream: ReplayStream, direction: int, stream_id: int, msg: bytes, second: int):
+        self.queue.put_nowait((stream, direction, pack_msg_provider_gathered(stream_id, msg), msg[0], second))
+
+    async def send_messages(self):
+        while True:
+            stream, direction, frame, msg_type, second = await self.queue.get()
+            stream.in_flight[direction].append((msg_type, time.perf_counter(), second))
+            await self.websocket.send(frame)
+
+class ReplayReport(object):
+    """What the replay measured: how far it fell behind the capture, how long the messages
+    took through the gateway and how long they waited in the queues on both sides."""
+    lag: List[float]
+    transit: Tuple[List[float], List[float]]
+    transit_by_second: Dict[Tuple[int, int], List[float]]
+    sent: int
+    skipped: int
+    streams: int
+    client_queue_wait: Histogram
+    provider_queue_wait: Histogram
+    gateway_queue_peaks: Dict[str, float]
+    gateway_samples_before: Dict[str, float]
+    gateway_samples_after: Dict[str, float]
+
+    def __init__(self):
+        self.lag = []
+        self.transit = ([], [])
+        self.transit_by_second = {}
+        self.sent = 0
+        self.skipped = 0
+        self.streams = 0
+        self.client_queue_wait = Histogram()
+        self.provider_queue_wait = Histogram()
+        self.gateway_queue_peaks = {}
+        self.gateway_samples_before = {}
+        self.gateway_samples_after = {}
+
+    def received(self, stream: ReplayStream, direction: int, msg_type: int):
+        # messages the gateway sent on its own, like the CLOSE of a stream it could not place, are not matched
+        in_flight = stream.in_flight[direction]
+        if in_flight and in_flight[0][0] == msg_type:
+            _, sent, second = in_flight.popleft()
+            transit = time.perf_counter() - sent
+            self.transit[direction].append(transit)
+            self.transit_by_second.setdefault((second, direction), []).append(transit)
+
+    def gateway_samples(self, samples: Dict[str, float]):
+        for series, value in samples.items():
+            if "_queue_frames" in series or "_queue_bytes" in series:
+                self.gateway_queue_peaks[series] = max(value, self.gateway_queue_peaks.get(series, 0))
+
+def percentile(values: List[float], fraction: float):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def format_ms(value: Union[float, None]):
+    return "-" if value is None else "{:.2f}".format(value * 1000)
+
+def replayed_open(record: CaptureRecord, index: int):
+    """The OPEN of a captured stream, targeting the synthetic provider."""
+    hostname = OPEN_HOSTNAME_PREFIX + str(index)
+    if record.msg_type != MSG_TYPE_OPEN or record.payload is None:
+        return pack_msg_open(hostname, 0)
+    payload = bytes(record.payload)
+    _, port = unpack_msg_open(payload)
+    return pack_msg_open(hostname, port, unpack_msg_open_flags(payload), unpack_msg_open_data(payload), unpack_msg_open_type(payload))
+
+def replayed_message(record: CaptureRecord):
+    """The captured message, or one of the same type and size if the payload was not captured."""
+    if record.payload is not None:
+        return bytes(record.payload)
+    if record.msg_type == MSG_TYPE_DATA:
+        return pack_msg_data(bytes(max(record.size - 5, 0)))
+    elif record.msg_type == MSG_TYPE_DATA_COMPRESSED:
+        return pack_msg_data_compressed(max(record.size - 5, 0), bytes(max(record.size - 5, 0)))
+    elif record.msg_type == MSG_TYPE_OPEN_FAIL:
+        return pack_msg_open_fail(OPEN_FAIL_ERROR)
+    return bytes([ record.msg_type ]) + bytes(max(record.size - 1, 0))
+
+def merged_records(captures: List[bytes]) -> Iterable[Tuple[int, CaptureRecord]]:
+    """The records of all captures in the order of their time, with the index of their capture."""
+    def indexed(index: int, capture: bytes):
+        for record in read_capture(capture):
+            yield index, record
+    return heapq.merge(*[ indexed(index, capture) for index, capture in enumerate(captures) ], key=lambda item: item[1].time)
+
+async def connect_gateway(path: str):
+    websocket = await websockets.connect(GATEWAY_URL + path + PROVIDER_NAME, subprotocols=subprotocols(PROTOCOL_VERSION), max_size=None)
+    await websocket.send(GATEWAY_PW.encode(encoding="utf-8"))
+    return wire_link(websocket, True)
+
+async def receive_as_client(link: ReplayLink, report: ReplayReport):
+    while True:
+        stream_id, msg = unpack_msg_provider(await link.websocket.recv())
+        stream = link.streams.get(stream_id)
+        if stream:
+            report.received(stream, CAPTURE_TO_CLIENT, msg[0])
+
+async def receive_as_provider(link: ReplayLink, streams_by_index: Dict[int, ReplayStream], report: ReplayReport):
+    while True:
+        client_id, msg = unpack_msg_provider(await link.websocket.recv())
+        if client_id == CONTROL_STREAM_ID:
+            continue
+        if msg[0] == MSG_TYPE_OPEN:
+            hostname, _ = unpack_msg_open(msg)
+            stream = streams_by_index.get(int(hostname[len(OPEN_HOSTNAME_PREFIX):]))
+            if not stream:
+                continue
+            stream.provider_link = link
+            stream.client_id = client_id
+            link.streams[client_id] = stream
+            report.received(stream, CAPTURE_TO_PROVIDER, msg[0])
+            for pending_msg, second in stream.pending:
+                link.send(stream, CAPTURE_TO_CLIENT, client_id, pending_msg, second)
+            stream.pending = []
+        else:
+            stream = link.streams.get(client_id)
+            if stream:
+                report.received(stream, CAPTURE_TO_PROVIDER, msg[0])
+
+async def fetch_metrics():
+    """Scrapes the metrics of the gateway, returns the samples by series."""
+    url = urllib.parse.urlparse(GATEWAY_URL)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or (443 if url.scheme == "wss" else 80), ssl=url.scheme == "wss" or None)
+    try:
+        writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n".format(METRICS_PATH, url.netloc).encode(encoding="latin-1"))
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200"):
+        raise ValueError(head.split(b"\r\n", 1)[0].decode(encoding="latin-1"))
+    samples = {}
+    for line in body.decode(encoding="utf-8").splitlines():
+        if line and not line.startswith("#"):
+            series, _, value = line.rpartition(" ")
+            samples[series] = float(value)
+    return samples
+
+async def watch_metrics(report: ReplayReport):
+    while True:
+        try:
+            report.gateway_samples(await fetch_metrics())
+        except (OSError, ValueError) as e:
+            log_internal_warn("could not fetch the metrics of the gateway: {}".format(e))
+        await asyncio.sleep(METRICS_INTERVAL)
+
+def gateway_queue_waits(report: ReplayReport):
+    """The wait histograms of the gateway queues during the replay, by queue."""
+    histograms: Dict[str, Histogram] = {}
+    for series, value in report.gateway_samples_after.items():
+        match = re.match(r'wsgw_queue_wait_seconds_bucket\{(?:.*,)?queue="([^"]*)"(?:,.*)?,le="([^"]*)"\}', series)
+        if not match:
+            continue
+        histogram = histograms.setdefault(match.group(1), Histogram())
+        le = float(match.group(2))
+        if le != float("inf") and le not in histogram.buckets:
+            continue
+        bucket = len(histogram.buckets) if le == float("inf") else histogram.buckets.index(le)
+        histogram.counts[bucket] += value - report.gateway_samples_before.get(series, 0)
+    for histogram in histograms.values():
+        # the samples are cumulative, the counts of the histogram are not
+        for bucket in range(len(histogram.counts) - 1, 0, -1):
+            histogram.counts[bucket] -= histogram.counts[bucket - 1]
+        histogram.count = sum(histogram.counts)
+    return histograms
+
+async def replay(captures: List[bytes]):
+    report = ReplayReport()
+    if METRICS_PATH:
+        report.gateway_samples_before = await fetch_metrics()
+
+    # the providers connect first, so the gateway can place the first streams
+    providers = [ ReplayLink(await connect_gateway("p/"), report.provider_queue_wait) for _ in range(REPLAY_PROVIDERS) ]
+    await asyncio.sleep(0.2)
+    clients = [ ReplayLink(await connect_gateway("m/"), report.client_queue_wait) for _ in range(REPLAY_CLIENTS) ]
+
+    streams: Dict[Tuple[int, int, int], ReplayStream] = {}
+    streams_by_index: Dict[int, ReplayStream] = {}
+    tasks = [ asyncio.ensure_future(link.send_messages()) for link in providers + clients ]
+    tasks += [ asyncio.ensure_future(receive_as_client(link, report)) for link in clients ]
+    tasks += [ asyncio.ensure_future(receive_as_provider(link, streams_by_index, report)) for link in providers ]
+    if METRICS_PATH:
+        tasks.append(asyncio.ensure_future(watch_metrics(report)))
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    capture_time = 0.0
+    try:
+        for capture_index, record in merged_records(captures):
+            capture_time = record.time
+            delay = started + record.time / REPLAY_SPEED - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            report.lag.append(max(-delay, 0.0))
+            if record.msg_type in SKIPPED_TYPES:
+                report.skipped += 1
+                continue
+
+            key = (capture_index, record.segment, record.stream_id)
+            stream = streams.get(key)
+            second = int(record.time)
+            if record.direction == CAPTURE_TO_PROVIDER:
+                if stream is None or record.msg_type == MSG_TYPE_OPEN:
+                    # streams opened before the capture started are opened when they are first seen
+                    client_link = clients[report.streams % len(clients)]
+                    stream = ReplayStream(report.streams, client_link, client_link.next_stream_id)
+                    client_link.next_stream_id += 1
+                    client_link.streams[stream.stream_id] = stream
+                    streams[key] = streams_by_index[stream.index] = stream
+                    report.streams += 1
+                    client_link.send(stream, CAPTURE_TO_PROVIDER, stream.stream_id, replayed_open(record, stream.index), second)
+                    if record.msg_type == MSG_TYPE_OPEN:
+                        report.sent += 1
+                        continue
+                stream.client_link.send(stream, CAPTURE_TO_PROVIDER, stream.stream_id, replayed_message(record), second)
+                if record.msg_type == MSG_TYPE_CLOSE:
+                    streams.pop(key, None)
+            elif stream is None:
+                # the stream was opened before the capture started and has not been seen yet
+                report.skipped += 1
+                continue
+            elif stream.provider_link:
+                stream.provider_link.send(stream, CAPTURE_TO_CLIENT, stream.client_id, replayed_message(record), second)
+            else:
+                stream.pending.append((replayed_message(record), second))
+            report.sent += 1
+
+        # waits for the messages still queued or on their way through the gateway
+        deadline = loop.time() + DRAIN_TIMEOUT
+        while loop.time() < deadline and any(stream.in_flight[0] or stream.in_flight[1] or stream.pending for stream in streams_by_index.values()):
+            await asyncio.sleep(0.05)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for link in providers + clients:
+            await link.websocket.close()
+
+    if METRICS_PATH:
+        report.gateway_samples_after = await fetch_metrics()
+        report.gateway_samples(report.gateway_samples_after)
+    print_report(report, loop.time() - started, capture_time)
+
+def print_report(report: ReplayReport, duration: float, capture_time: float):
+    received = sum(len(transit) for transit in report.transit)
+    print("replayed {} messages of {} streams in {:.2f}s, {:.2f}s of capture at {}x, {} received, {} skipped".format(
+        report.sent, report.streams, duration, capture_time, REPLAY_SPEED, received, report.skipped))
+
+    lag = sorted(report.lag)
+    if lag:
+        print("replay behind the capture ms: p50 {} p99 {} max {}".format(format_ms(percentile(lag, 0.5)), format_ms(percentile(lag, 0.99)), format_ms(lag[-1])))
+
+    print()
+    print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format("through the gateway", "messages", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for direction in (CAPTURE_TO_PROVIDER, CAPTURE_TO_CLIENT):
+        transit = sorted(report.transit[direction])
+        if transit:
+            print("{:<20} {:>10} {:>10} {:>10} {:>10} {:>10}".format(CAPTURE_DIRECTIONS[direction], len(transit),
+                format_ms(percentile(transit, 0.5)), format_ms(percentile(transit, 0.9)), format_ms(percentile(transit, 0.99)), format_ms(transit[-1])))
+
+    # the seconds of the capture during which the messages took longest, where the queues built up
+    slowest = sorted(report.transit_by_second.items(), key=lambda item: percentile(sorted(item[1]), 0.99), reverse=True)[:SLOWEST_SECONDS]
+    if slowest:
+        print()
+        print("{:<20} {:>18} {:>10} {:>10}".format("slowest seconds", "direction", "messages", "p99 ms"))
+        for (second, direction), transit in slowest:
+            print("{:<20} {:>18} {:>10} {:>10}".format(second, CAPTURE_DIRECTIONS[direction], len(transit), format_ms(percentile(sorted(transit), 0.99))))
+
+    print()
+    print("{:<42} {:>10} {:>10}".format("queue", "p50 ms", "p99 ms"))
+    for name, histogram in [ ("replay clients", report.client_queue_wait), ("replay providers", report.provider_queue_wait) ] + [ ("gateway " + queue, histogram) for queue, histogram in gateway_queue_waits(report).items() ]:
+        if histogram.count:
+            print("{:<42} {:>10} {:>10}".format(name, format_ms(histogram.quantile(0.5)), format_ms(histogram.quantile(0.99))))
+
+    if report.gateway_queue_peaks:
+        print()
+        print("{:<60} {:>12}".format("gateway queue", "peak"))
+        for series, peak in sorted(report.gateway_queue_peaks.items(), key=lambda item: item[1], reverse=True):
+            print("{:<60} {:>12.0f}".format(series, peak))
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('captures', nargs='+', help='Capture files written by the gateway, the files of several workers are replayed together.')
+    parser.add_argument('--speed', dest='speed', type=float, default=1.0, help='Replays the capture this many times faster.')
+    parser.add_argument('--clients', dest='clients', type=int, default=1, help='Number of multiplexed client websockets the streams are spread over.')
+    parser.add_argument('--providers', dest='providers', type=int, default=1, help='Number of provider websockets.')
+    parser.add_argument('--metrics-path', dest='metrics_path', help='Path of the metrics of the gateway, which are watched during the replay.')
+
+def main():
+    config = setup_args_and_config("Replay", add_arguments)
+    config.parse_gateway_password()
+    config.parse_gateway_url()
+    config.parse_gateway_protocol()
+    config.parse_provider_name()
+    config.finish()
+    setup_logging(config)
+
+    global GATEWAY_URL, GATEWAY_PW, PROTOCOL_VERSION, PROVIDER_NAME, REPLAY_SPEED, REPLAY_CLIENTS, REPLAY_PROVIDERS, METRICS_PATH
+    GATEWAY_URL = config.gateway_url if config.gateway_url.endswith("/") else config.gateway_url + "/"
+    GATEWAY_PW = config.gateway_pw
+    PROTOCOL_VERSION = config.gateway_protocol
+    PROVIDER_NAME = config.provider_name
+    REPLAY_SPEED = config.args.speed
+    REPLAY_CLIENTS = max(config.args.clients, 1)
+    REPLAY_PROVIDERS = max(config.args.providers, 1)
+    METRICS_PATH = config.args.metrics_path
+
+    captures = [ open_capture(path) for path in config.args.captures ]
+    asyncio.run(replay(captures))
+
+if __name__ == "__main__":
+    main()
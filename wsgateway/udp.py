@@ -0,0 +1,116 @@
+import asyncio
+import time
+from typing import Callable, Iterable, List, Union
+
+from wsgateway.batch import FrameQueue
+from wsgateway.log import log_internal_warn
+from wsgateway.messages import pack_msg_close, pack_msg_data, pack_msg_provider, unpack_msg_data, unpack_msg_open_fail, MSG_TYPE_DATA, MSG_TYPE_CLOSE, MSG_TYPE_OPEN_FAIL
+
+DEFAULT_UDP_IDLE_TIMEOUT = 60.0
+# datagrams are dropped while more than this many bytes wait to be sent over the websocket
+MAX_QUEUED_BYTES = 1048576
+# datagrams of a flow kept while its socket or stream is being opened
+MAX_PENDING_DATAGRAMS = 64
+
+class DatagramFlow(object):
+    """A flow of datagrams tunneled as a stream, every datagram is sent as one DATA message.
+
+    Stands in for the recv queue of the stream: messages put into it are handled right away,
+    DATA is sent with `send_datagram` and CLOSE closes the flow. Datagrams to the peer are
+    put into `send_queue` by `datagram_received`, which is called by the datagram protocol
+    and never awaits. Until the socket of the flow is attached, datagrams from the peer
+    are kept in `pending`. There is no flow control, datagrams are dropped while the send
+    queue is full or the socket can't keep up."""
+    __slots__ = ("stream_id", "send_queue", "send_datagram", "pending", "last_active", "closed", "on_close", "dropped")
+    stream_id: int
+    send_queue: FrameQueue
+    send_datagram: Union[Callable[[bytes], None], None]
+    pending: Union[List[bytes], None]
+    last_active: float
+    closed: bool
+    on_close: Union[Callable[["DatagramFlow"], None], None]
+    dropped: int
+
+    def __init__(self, send_queue: FrameQueue, stream_id: int = 0):
+        self.stream_id = stream_id
+        self.send_queue = send_queue
+        self.send_datagram = None
+        self.pending = None
+        self.last_active = time.monotonic()
+        self.closed = False
+        self.on_close = None
+        self.dropped = 0
+
+    def attach(self, send_datagram: Callable[[bytes], None]):
+        self.send_datagram = send_datagram
+        pending, self.pending = self.pending, None
+        for datagram in pending or ():
+            send_datagram(datagram)
+
+    def qsize(self):
+        return 0
+
+    def put_nowait(self, msg: bytes):
+        if self.closed:
+            return
+        self.last_active = time.monotonic()
+        if msg[0] == MSG_TYPE_DATA:
+            datagram = bytes(unpack_msg_data(msg))
+            if self.send_datagram:
+                self.send_datagram(datagram)
+            elif self.pending is None:
+                self.pending = [ datagram ]
+            elif len(self.pending) < MAX_PENDING_DATAGRAMS:
+                self.pending.append(datagram)
+            else:
+                self.dropped += 1
+        elif msg[0] == MSG_TYPE_CLOSE:
+            self.close(send_close=False)
+        elif msg[0] == MSG_TYPE_OPEN_FAIL:
+            # the CLOSE following it closes the flow
+            _, reason = unpack_msg_open_fail(msg)
+            log_internal_warn("udp flow {} could not be opened: {}".format(self.stream_id, reason))
+
+    async def put(self, msg: bytes):
+        self.put_nowait(msg)
+
+    def datagram_received(self, datagram: bytes):
+        if self.closed:
+            return
+        self.last_active = time.monotonic()
+        if self.send_queue.queued_bytes > MAX_QUEUED_BYTES:
+            self.dropped += 1
+            return
+        self.send_queue.put_nowait(pack_msg_provider(self.stream_id, pack_msg_data(datagram)))
+
+    def close(self, send_close: bool = True):
+        if self.closed:
+            return
+        self.closed = True
+        if send_close:
+            self.send_queue.put_nowait(pack_msg_provider(self.stream_id, pack_msg_close()))
+        if self.on_close:
+            self.on_close(self)
+
+class FlowProtocol(asyncio.DatagramProtocol):
+    """The socket of a single flow, connected to its target."""
+    flow: DatagramFlow
+
+    def __init__(self, flow: DatagramFlow):
+        self.flow = flow
+
+    def datagram_received(self, data: bytes, addr):
+        self.flow.datagram_received(data)
+
+    def error_received(self, exc: Exception):
+        # e.g. port unreachable, answered by the target for an earlier datagram. the flow
+        # stays open like a socket of an application would.
+        pass
+
+async def expire_flows(flows: Callable[[], Iterable[DatagramFlow]], idle_timeout: float):
+    """Closes the flows which neither sent nor received a datagram for `idle_timeout` seconds."""
+    while True:
+        await asyncio.sleep(idle_timeout / 2)
+        expired = time.monotonic() - idle_timeout
+        for flow in [ flow for flow in flows() if flow.last_active < expired ]:
+            flow.close()
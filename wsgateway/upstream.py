@@ -0,0 +1,196 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple, Union
+
+from wsgateway.tcp import TCPStream, open_unix_stream
+
+DEFAULT_DNS_TTL = 30.0
+DEFAULT_POOL_SIZE = 0
+DEFAULT_POOL_IDLE = 60.0
+MAX_DNS_ENTRIES = 4096
+
+class DNSCache(object):
+    """Resolves hostnames with `getaddrinfo` and keeps the addresses for `ttl` seconds.
+    Concurrent lookups of the same name share one resolution, failed lookups are not cached."""
+    ttl: float
+    entries: Dict[Tuple[str, int], Tuple[float, List[tuple]]]
+    pending: Dict[Tuple[str, int], asyncio.Future]
+    hits: int
+    misses: int
+
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, hostname: str, port: int):
+        key = (hostname, port)
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        if key in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+            if self.ttl > 0:
+                if len(self.entries) >= MAX_DNS_ENTRIES:
+                    self.expire()
+                self.entries[key] = (time.monotonic() + self.ttl, addresses)
+            future.set_result(addresses)
+            return addresses
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is raised here as well, without waiters it must not be logged as unretrieved
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [ key for key, (expires, _) in self.entries.items() if expires <= now ]:
+            del self.entries[key]
+
+async def connect_resolved(addresses: List[tuple], **kwargs):
+    """Opens a `TCPStream` to the first of the resolved addresses that accepts the connection."""
+    loop = asyncio.get_running_loop()
+    error = None
+    for family, _, proto, _, address in addresses:
+        try:
+            # the host is an ip address, which asyncio does not resolve again
+            _, stream = await loop.create_connection(lambda: TCPStream(**kwargs), address[0], address[1], family=family, proto=proto)
+            return stream
+        except OSError as e:
+            error = e
+    raise error or OSError("no addresses to connect to")
+
+class PooledTarget(object):
+    """The idle connections to one (hostname, port, unix)."""
+    __slots__ = ("streams", "connecting", "last_used")
+    streams: Deque[TCPStream]
+    connecting: int
+    last_used: float
+
+    def __init__(self):
+        self.streams = deque()
+        self.connecting = 0
+        self.last_used = time.monotonic()
+
+class UpstreamPool(object):
+    """Opens the tcp and unix socket connections of the streams, the hostname of a unix
+    socket is its path.
+
+    With a `size` above 0, up to `size` connections to every target which was
+    opened before are kept connected ahead of time, `acquire` takes one of them and opens
+    a replacement in the background. Targets which were not used for `idle_timeout` seconds
+    are dropped together with their connections. Connections closed by the target while
+    waiting in the pool are skipped."""
+    dns: DNSCache
+    size: int
+    idle_timeout: float
+    stream_kwargs: Dict[str, Any]
+    targets: Dict[Tuple[str, int, bool], PooledTarget]
+    hits: int
+    misses: int
+    prewarm_failures: int
+    sweeper: Union[asyncio.Task, None]
+
+    def __init__(self, dns: DNSCache, size: int = DEFAULT_POOL_SIZE, idle_timeout: float = DEFAULT_POOL_IDLE, **stream_kwargs):
+        self.dns = dns
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.stream_kwargs = stream_kwargs
+        self.targets = {}
+        self.hits = 0
+        self.misses = 0
+        self.prewarm_failures = 0
+        self.sweeper = None
+
+    def idle_connections(self):
+        return sum(len(target.streams) for target in self.targets.values())
+
+    async def connect(self, hostname: str, port: int, unix: bool = False):
+        if unix:
+            return await open_unix_stream(hostname, **self.stream_kwargs)
+        return await connect_resolved(await self.dns.resolve(hostname, port), **self.stream_kwargs)
+
+    async def acquire(self, hostname: str, port: int, unix: bool = False):
+        if self.size <= 0:
+            return await self.connect(hostname, port, unix)
+
+        key = (hostname, port, unix)
+        target = self.targets.get(key)
+        if target is None:
+            target = self.targets[key] = PooledTarget()
+            self.start_sweeper()
+        target.last_used = time.monotonic()
+
+        stream = None
+        while target.streams:
+            candidate = target.streams.popleft()
+            if not candidate.is_closing() and not candidate.eof:
+                stream = candidate
+                break
+            candidate.close()
+
+        self.refill(key, target)
+        if stream:
+            self.hits += 1
+            return stream
+        self.misses += 1
+        return await self.connect(hostname, port, unix)
+
+    def refill(self, key: Tuple[str, int, bool], target: PooledTarget):
+        for _ in range(self.size - len(target.streams) - target.connecting):
+            target.connecting += 1
+            asyncio.create_task(self.prewarm(key, target))
+
+    async def prewarm(self, key: Tuple[str, int, bool], target: PooledTarget):
+        try:
+            stream = await self.connect(*key)
+        except OSError:
+            # the next acquire connects on demand and reports the error
+            self.prewarm_failures += 1
+            return
+        finally:
+            target.connecting -= 1
+
+        if self.targets.get(key) is target:
+            target.streams.append(stream)
+        else:
+            stream.close()
+
+    def start_sweeper(self):
+        if self.sweeper is None or self.sweeper.done():
+            self.sweeper = asyncio.create_task(self.sweep())
+
+    async def sweep(self):
+        while self.targets:
+            await asyncio.sleep(self.idle_timeout / 2)
+            expired = time.monotonic() - self.idle_timeout
+            for key in [ key for key, target in self.targets.items() if target.last_used < expired ]:
+                for stream in self.targets.pop(key).streams:
+                    stream.close()
+            self.dns.expire()
+
+    def close(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+        for target in self.targets.values():
+            for stream in target.streams:
+                stream.close()
+        self.targets.clear()
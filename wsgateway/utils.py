@@ -1,51 +1,317 @@
-from typing import Dict, Union
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple, Union
 import asyncio
 import logging
+import time
+from wsgateway.messages import pack_msg_close, pack_msg_provider, pack_msg_data, pack_msg_data_compressed, pack_msg_window_update, pack_msg_window_ack, unpack_msg_data_view, unpack_msg_data_compressed, unpack_msg_window_update, unpack_msg_open_fail, MSG_TYPE_DATA, MSG_TYPE_DATA_COMPRESSED, MSG_TYPE_CLOSE, MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_WINDOW_ACK, MSG_TYPE_COMPRESS_ACK, MSG_TYPE_OPEN, MSG_TYPE_OPEN_ACK, MSG_TYPE_OPEN_FAIL
+from wsgateway.log import log_inbound, log_inbound_msg_close_connection, log_outbound_msg_close_connection, log_internal, log_internal_enabled, log_internal_warn, tracer
+from wsgateway.tcp import TCPStream
+from wsgateway.batch import FrameQueue
+from wsgateway.metrics import Histogram
+from wsgateway.relay import DEFAULT_GATHER_MESSAGES
+from wsgateway.flow import SendWindow, ReceiveWindow, DEFAULT_WINDOW_SIZE
+from wsgateway.compression import StreamCompressor, StreamDecompressor, compression_stats
 
-class KeyedQueueMap(object):
-    queue_map: Dict[Union[int, str], asyncio.Queue]
-    queue_map_lock: asyncio.Lock
-    id_counter: int
-
-    def __init__(self):
-        self.queue_map = {}
-        self.queue_map_lock = asyncio.Lock()
-        self.id_counter = 0
-
-    async def get_queue(self, id: Union[int, str]):
-        async with self.queue_map_lock:
-            return self.queue_map[id] if id in self.queue_map else None
-
-    async def has_queue(self, id: Union[int, str]):
-        async with self.queue_map_lock:
-            return id in self.queue_map
-
-    async def create_named_queue(self, id: Union[int, str]):
-        async with self.queue_map_lock:
-            queue = asyncio.Queue()
-            self.queue_map[id] = queue
-            return queue
-
-    async def create_inc_queue(self):
-        async with self.queue_map_lock:
-            self.id_counter += 1
-            new_id = self.id_counter
-            queue = asyncio.Queue()
-            self.queue_map[new_id] = queue
-            return new_id, queue
-
-    async def remove_queue(self, id: Union[int, str]):
-        async with self.queue_map_lock:
-            self.queue_map.pop(id, None)
-
-async def read_into_queue(queue: asyncio.Queue, reader: asyncio.StreamReader, close_event: Union[asyncio.Event, None] = None):
-    try:
-        while not reader.at_eof():
-            message = await reader.read(4096)
-            if len(message) > 0:
-                await queue.put(message)
+class TCPStreamEndpoint(object):
+    """The tcp side of a tunneled stream.
+
+    `read_data` and `send_data` are the relay source and sink for data going to the peer,
+    `write_message` is the relay sink for messages coming from the peer. It stops the pump
+    when the peer sends CLOSE. `write_messages` is the sink for a `gathered` source, it writes
+    the data of all messages that arrived together at once. Messages to the peer are sent with
+    `send_message`.
+
+    Data is sent compressed with `compression_level` once compression was enabled, by the
+    provider when accepting it or by the client when the provider sent COMPRESS_ACK.
+
+    On the client `opened` is resolved with True once the provider answered the OPEN with
+    OPEN_ACK and with False for OPEN_FAIL, whose reason is kept in `open_error`. Providers
+    which don't answer OPEN leave it pending."""
+    __slots__ = ("stream", "send_message", "send_window", "receive_window", "stream_id", "closed_remotely", "compression_level", "compressor", "decompressor", "opened", "open_error")
+    stream: TCPStream
+    send_message: Callable[[bytes], Awaitable]
+    send_window: SendWindow
+    receive_window: ReceiveWindow
+    stream_id: int
+    closed_remotely: bool
+    compression_level: Union[int, None]
+    compressor: Union[StreamCompressor, None]
+    decompressor: Union[StreamDecompressor, None]
+    opened: asyncio.Future
+    open_error: Union[Tuple[int, str], None]
+
+    def __init__(self, stream: TCPStream, send_message: Callable[[bytes], Awaitable], window_size: int = DEFAULT_WINDOW_SIZE, compression_level: Union[int, None] = None, stream_id: int = 0):
+        self.stream = stream
+        self.send_message = send_message
+        self.send_window = SendWindow()
+        self.receive_window = ReceiveWindow(window_size)
+        self.stream_id = stream_id
+        self.closed_remotely = False
+        self.compression_level = compression_level
+        self.compressor = None
+        self.decompressor = None
+        self.opened = asyncio.get_running_loop().create_future()
+        self.open_error = None
+
+    async def grant_window(self):
+        await self.send_message(pack_msg_window_update(self.receive_window.size))
+
+    def enable_compression(self):
+        if self.compression_level is not None and not self.compressor:
+            self.compressor = StreamCompressor(self.compression_level)
+
+    def log_compression(self):
+        # the totals keep changing, they are formatted right away
+        if self.compressor is not None and self.compressor.raw_bytes and log_internal_enabled():
+            log_internal("stream compressed %d to %d bytes%s. total: %s", self.compressor.raw_bytes, self.compressor.compressed_bytes, "" if self.compressor.active else ", bypassed", compression_stats.summary())
+
+    def read_first_data(self, max_size: int):
+        """Takes the data which is already buffered, to be sent along with the OPEN."""
+        data = self.stream.read_nowait(self.send_window.limit(max_size))
+        if not data:
+            return b""
+        if tracer.enabled:
+            tracer.frame("tcp->peer", self.stream_id, MSG_TYPE_OPEN, len(data))
+        self.send_window.consume(len(data))
+        return data
+
+    async def read_data(self):
+        while True:
+            await self.send_window.wait()
+            await self.stream.wait_readable()
+            # the first grant may have used up the credit while waiting for data
+            if self.send_window.credit is None or self.send_window.credit > 0:
+                break
+
+        data = self.stream.read_nowait(self.send_window.limit(self.stream.max_read_size))
+        if data:
+            self.send_window.consume(len(data))
+        return data
+
+    async def send_data(self, data: bytes):
+        if tracer.enabled:
+            tracer.frame("tcp->peer", self.stream_id, MSG_TYPE_DATA, len(data))
+        compressed = self.compressor.compress(data) if self.compressor and data else None
+        if compressed is None:
+            await self.send_message(pack_msg_data(data))
+        else:
+            await self.send_message(pack_msg_data_compressed(len(data), compressed))
+
+    async def write_data(self, data: bytes):
+        await self.write_chunks([ data ])
+
+    async def write_chunks(self, chunks: List[Union[bytes, memoryview]]):
+        """Writes the data of several messages with one vectored write and grants it back at once.
+        The socket is only drained once the transport buffers more than its high-water mark."""
+        if tracer.enabled:
+            for chunk in chunks:
+                tracer.frame("peer->tcp", self.stream_id, MSG_TYPE_DATA, len(chunk))
+        self.stream.writelines(chunks)
+        if self.stream.needs_drain():
+            await self.stream.drain()
+        increment = self.receive_window.consume(sum(len(chunk) for chunk in chunks))
+        if increment:
+            await self.send_message(pack_msg_window_update(increment))
+
+    def decompress(self, message: bytes):
+        raw_len, compressed = unpack_msg_data_compressed(message)
+        if not self.decompressor:
+            self.decompressor = StreamDecompressor()
+        return self.decompressor.decompress(compressed, raw_len)
+
+    async def write_messages(self, messages: List[bytes]):
+        chunks = []
+        for message in messages:
+            if message[0] == MSG_TYPE_DATA:
+                self.send_window.data_received()
+                chunks.append(unpack_msg_data_view(message))
+            elif message[0] == MSG_TYPE_DATA_COMPRESSED:
+                self.send_window.data_received()
+                chunks.append(self.decompress(message))
             else:
-                await asyncio.sleep(0.001)
-    finally:
-        if close_event:
-            close_event.set()
\ No newline at end of file
+                # the data before the message is written first, CLOSE ends the stream after it
+                if chunks:
+                    await self.write_chunks(chunks)
+                    chunks = []
+                if await self.write_message(message) is False:
+                    return False
+        if chunks:
+            await self.write_chunks(chunks)
+
+    async def write_message(self, message: bytes):
+        if message[0] == MSG_TYPE_DATA:
+            self.send_window.data_received()
+            await self.write_data(unpack_msg_data_view(message))
+        elif message[0] == MSG_TYPE_DATA_COMPRESSED:
+            self.send_window.data_received()
+            await self.write_data(self.decompress(message))
+        elif message[0] == MSG_TYPE_COMPRESS_ACK:
+            self.enable_compression()
+        elif message[0] == MSG_TYPE_OPEN_ACK:
+            if not self.opened.done():
+                self.opened.set_result(True)
+        elif message[0] == MSG_TYPE_OPEN_FAIL:
+            # the provider closes the stream right after
+            self.open_error = unpack_msg_open_fail(message)
+            log_internal_warn("stream {} could not be opened: {}".format(self.stream_id, self.open_error[1]))
+            if not self.opened.done():
+                self.opened.set_result(False)
+        elif message[0] == MSG_TYPE_WINDOW_UPDATE:
+            if self.send_window.grant(unpack_msg_window_update(message)):
+                await self.send_message(pack_msg_window_ack())
+        elif message[0] == MSG_TYPE_CLOSE:
+            log_inbound_msg_close_connection()
+            self.closed_remotely = True
+            self.stream.close()
+            await self.stream.wait_closed()
+            return False
+        elif message[0] != MSG_TYPE_WINDOW_ACK:
+            log_inbound("unexpected message: %s", message[:10].hex())
+
+class StreamRelay(object):
+    """A tunneled tcp stream of the provider, which has no task of its own while it is idle.
+
+    Stands in for the recv queue of the stream like a `DatagramFlow`. Messages put into it
+    wait in `pending` until the stream is started, then a writer task writes them and ends
+    once none are left. Bytes arriving on the socket start a reader task, which sends them
+    to the gateway and ends once nothing is buffered. An idle stream only costs this record,
+    its endpoint and its socket, the queue and the tasks exist while there is data to relay.
+    The bytes of the pending messages are counted in `queued_bytes`.
+
+    The stream is finished once the gateway sent CLOSE, the socket reached eof or relaying
+    failed: the other task is cancelled, CLOSE is sent unless the gateway closed the stream,
+    the socket is closed and `on_close` is called."""
+    __slots__ = ("stream_id", "send_queue", "wait_histogram", "endpoint", "pending", "queued_bytes", "writer", "reader", "started", "closing", "on_close")
+    stream_id: int
+    send_queue: FrameQueue
+    wait_histogram: Union[Histogram, None]
+    endpoint: Union[TCPStreamEndpoint, None]
+    # messages and the time they were put
+    pending: Union[Deque[Tuple[bytes, float]], None]
+    queued_bytes: int
+    writer: Union[asyncio.Task, None]
+    reader: Union[asyncio.Task, None]
+    started: bool
+    closing: bool
+    on_close: Union[Callable[["StreamRelay"], None], None]
+
+    def __init__(self, send_queue: FrameQueue, stream_id: int, wait_histogram: Union[Histogram, None] = None):
+        self.stream_id = stream_id
+        self.send_queue = send_queue
+        self.wait_histogram = wait_histogram
+        self.endpoint = None
+        self.pending = None
+        self.queued_bytes = 0
+        self.writer = None
+        self.reader = None
+        self.started = False
+        self.closing = False
+        self.on_close = None
+
+    async def send_message(self, message: bytes):
+        await self.send_queue.put(pack_msg_provider(self.stream_id, message))
+
+    def attach(self, endpoint: TCPStreamEndpoint):
+        """Attaches the endpoint of the opened socket, the relay starts with `start`."""
+        self.endpoint = endpoint
+
+    def start(self):
+        self.started = True
+        self.endpoint.stream.on_readable = self.readable
+        if self.pending:
+            self.writer = asyncio.ensure_future(self.write())
+        self.readable()
+
+    def qsize(self):
+        return len(self.pending) if self.pending else 0
+
+    def put_nowait(self, msg: bytes):
+        if self.closing:
+            return
+        if self.pending is None:
+            self.pending = deque()
+        self.pending.append((msg, time.monotonic() if self.wait_histogram else 0.0))
+        self.queued_bytes += len(msg)
+        if self.started and self.writer is None:
+            self.writer = asyncio.ensure_future(self.write())
+
+    async def put(self, msg: bytes):
+        self.put_nowait(msg)
+
+    def take_pending(self):
+        messages = []
+        now = time.monotonic() if self.wait_histogram else 0.0
+        while self.pending and len(messages) < DEFAULT_GATHER_MESSAGES:
+            msg, put_time = self.pending.popleft()
+            self.queued_bytes -= len(msg)
+            if self.wait_histogram:
+                self.wait_histogram.observe(now - put_time)
+            messages.append(msg)
+        return messages
+
+    async def write(self):
+        try:
+            while self.pending:
+                if await self.endpoint.write_messages(self.take_pending()) is False:
+                    self.finish()
+                    return
+        except Exception as e:
+            log_internal("stream %d could not be written: %s", self.stream_id, e)
+            self.finish()
+        finally:
+            self.writer = None
+            if not self.pending:
+                self.pending = None
+
+    def readable(self):
+        stream = self.endpoint.stream
+        if self.reader is None and not self.closing and (stream.pending or stream.eof):
+            self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        stream = self.endpoint.stream
+        try:
+            while stream.pending or stream.eof:
+                data = await self.endpoint.read_data()
+                if data is None:
+                    self.finish()
+                    return
+                await self.endpoint.send_data(data)
+        except Exception as e:
+            log_internal("stream %d could not be read: %s", self.stream_id, e)
+            self.finish()
+        finally:
+            self.reader = None
+
+    def finish(self):
+        if self.closing:
+            return
+        self.closing = True
+        current = asyncio.current_task()
+        for task in (self.writer, self.reader):
+            if task is not None and task is not current:
+                task.cancel()
+        asyncio.ensure_future(self.close())
+
+    async def close(self):
+        endpoint = self.endpoint
+        try:
+            if endpoint is None:
+                # the socket is still being opened, its opener closes it
+                await self.send_message(pack_msg_close())
+                return
+            stream = endpoint.stream
+            stream.on_readable = None
+            if not endpoint.closed_remotely:
+                log_outbound_msg_close_connection()
+                await self.send_message(pack_msg_close())
+            endpoint.log_compression()
+            if not stream.is_closing():
+                log_internal("closing the tcp socket")
+                stream.close()
+                await stream.wait_closed()
+        finally:
+            self.pending = None
+            self.queued_bytes = 0
+            if self.on_close:
+                self.on_close(self)
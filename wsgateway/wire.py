@@ -0,0 +1,206 @@
+import struct
+from typing import Iterable, List, Union
+
+from wsgateway.messages import frame_len, slice_payload, GATHER_MIN_SIZE, CONTROL_STREAM_ID, MSG_TYPE_DATA, MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_HELLO, MSG_TYPE_BATCH
+
+# Version 2 of the wire format drops the lengths websocket messages carry already. A message
+# is the varint stream id (only on links carrying several streams) followed by the inner
+# message of version 1, of which these types are shortened:
+# - DATA: the type and the data
+# - WINDOW_UPDATE: the type and the varint increment
+# - HELLO: the type and the varint features
+# - BATCH: on the control stream, the type and every message prefixed by its varint length
+# DATA messages of at least `GATHER_MIN_SIZE` bytes in version 1 are left as they are, so their
+# payload is neither copied when sending nor when receiving. A shortened one is shorter than
+# that, which tells both forms apart.
+#
+# Version 1 is used within the tools, the messages are translated when they are sent or
+# received on a version 2 link. The version of a link is chosen with the websocket
+# subprotocol when it is opened, peers offering no subprotocol use version 1.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+DEFAULT_PROTOCOL_VERSION = PROTOCOL_V1
+SUBPROTOCOLS = { PROTOCOL_V2: "wsgw.v2" }
+
+PROVIDER_HEADER = struct.Struct("!II")
+DATA_HEADER = struct.Struct("!cI")
+
+TYPE_BYTES = [ bytes([ msg_type ]) for msg_type in range(256) ]
+# varints of the values below 128, which are a single byte
+SMALL_VARINTS = TYPE_BYTES[:0x80]
+
+def subprotocols(max_version: int):
+    """The subprotocols to offer or accept, the latest version first. None for version 1,
+    websockets sends an empty list as an invalid header."""
+    return [ SUBPROTOCOLS[version] for version in sorted(SUBPROTOCOLS, reverse=True) if version <= max_version ] or None
+
+def negotiated_version(subprotocol: Union[str, None]):
+    for version, name in SUBPROTOCOLS.items():
+        if name == subprotocol:
+            return version
+    return PROTOCOL_V1
+
+def pack_varint(value: int):
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def unpack_varint(data: bytes, offset: int):
+    """Returns the value and the offset after it."""
+    byte = data[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+def join_payload(head: bytes, payload: bytes) -> Union[bytes, List[bytes]]:
+    if len(payload) < GATHER_MIN_SIZE:
+        return head + payload
+    return [ head, payload ]
+
+def pack_msg_v2(stream_id: Union[int, None], msg: bytes, offset: int = 0) -> Union[bytes, List[bytes]]:
+    """Translates an inner message of version 1, starting at `offset` of `msg`, into a version 2
+    message. `stream_id` is None on links without stream ids. Large payloads are not copied,
+    the header and the payload are returned as a list like `pack_msg_provider_gathered` does."""
+    msg_type = msg[offset]
+    head = b"" if stream_id is None else pack_varint(stream_id)
+    if msg_type == MSG_TYPE_DATA and len(msg) - offset < GATHER_MIN_SIZE:
+        return head + TYPE_BYTES[msg_type] + msg[offset + DATA_HEADER.size:]
+    elif msg_type in (MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_HELLO):
+        _, value = DATA_HEADER.unpack_from(msg, offset)
+        return head + TYPE_BYTES[msg_type] + pack_varint(value)
+    elif not offset:
+        return join_payload(head, msg) if head else msg
+    return join_payload(head, slice_payload(msg, offset, len(msg)))
+
+def unpack_msg_v2(message: bytes, offset: int, end: int):
+    """Translates the version 2 message between `offset` and `end` of `message`, after its
+    stream id, into an inner message of version 1. Large payloads are returned as a
+    memoryview sharing the memory of `message`."""
+    msg_type = message[offset]
+    if msg_type == MSG_TYPE_DATA and end - offset < GATHER_MIN_SIZE:
+        return DATA_HEADER.pack(TYPE_BYTES[msg_type], end - offset - 1) + message[offset + 1:end]
+    elif msg_type in (MSG_TYPE_WINDOW_UPDATE, MSG_TYPE_HELLO):
+        value, _ = unpack_varint(message, offset + 1)
+        return DATA_HEADER.pack(TYPE_BYTES[msg_type], value)
+    elif msg_type == MSG_TYPE_BATCH:
+        return unpack_batch_v2(message, offset + 1, end)
+    elif not offset and end == len(message):
+        return message
+    return slice_payload(message, offset, end)
+
+def unpack_msg_v2_provider(message: bytes):
+    """Returns the stream id and the inner message of version 1 of a version 2 message with
+    a stream id, which `unpack_msg_provider` and `frame_len` take like a provider message."""
+    stream_id, offset = unpack_varint(message, 0)
+    return stream_id, unpack_msg_v2(message, offset, len(message))
+
+def unpack_batch_v2(message: bytes, offset: int, end: int):
+    """Returns the inner message of a version 1 batch with the translated messages of a version 2 batch."""
+    frames = [ TYPE_BYTES[MSG_TYPE_BATCH] ]
+    while offset < end:
+        msg_len, offset = unpack_varint(message, offset)
+        stream_id, msg_offset = unpack_varint(message, offset)
+        msg = unpack_msg_v2(message, msg_offset, offset + msg_len)
+        frames.append(PROVIDER_HEADER.pack(stream_id, len(msg)))
+        frames.append(msg)
+        offset += msg_len
+    return b"".join(frames)
+
+def iter_batch_parts(parts: Iterable[bytes]):
+    """Yields the stream id and the inner message of the provider messages in the parts of
+    a version 1 batch, following its type. Gathered messages are a part with their header
+    followed by a part with the inner message."""
+    gathered_id = None
+    for part in parts:
+        if gathered_id is not None:
+            yield gathered_id, part
+            gathered_id = None
+            continue
+        offset = 0
+        while offset < len(part):
+            stream_id, msg_len = PROVIDER_HEADER.unpack_from(part, offset)
+            offset += PROVIDER_HEADER.size
+            if offset + msg_len > len(part):
+                gathered_id = stream_id
+                break
+            yield stream_id, part[offset:offset + msg_len]
+            offset += msg_len
+
+def pack_batch_v2(parts: Iterable[bytes]) -> Union[bytes, List[bytes]]:
+    out = [ pack_varint(CONTROL_STREAM_ID) + TYPE_BYTES[MSG_TYPE_BATCH] ]
+    joined = bytearray()
+    for stream_id, msg in iter_batch_parts(parts):
+        frame = pack_msg_v2(stream_id, msg)
+        joined += pack_varint(frame_len(frame))
+        if isinstance(frame, list):
+            out.append(bytes(joined))
+            joined = bytearray()
+            out.extend(frame)
+        else:
+            joined += frame
+    out.append(bytes(joined))
+    if len(out) == 2:
+        return out[0] + out[1]
+    return out
+
+def pack_msg_v2_provider(frame: Union[bytes, List[bytes]]) -> Union[bytes, List[bytes]]:
+    """Translates a provider message of version 1, as returned by `pack_msg_provider`,
+    `pack_msg_provider_gathered` or `pack_msg_batch`, into a version 2 message."""
+    if isinstance(frame, list):
+        stream_id, _ = PROVIDER_HEADER.unpack_from(frame[0])
+        if stream_id == CONTROL_STREAM_ID and frame[1][0] == MSG_TYPE_BATCH:
+            return pack_batch_v2(frame[2:])
+        return pack_msg_v2(stream_id, frame[1])
+
+    stream_id, _ = PROVIDER_HEADER.unpack_from(frame)
+    if stream_id == CONTROL_STREAM_ID and frame[PROVIDER_HEADER.size] == MSG_TYPE_BATCH:
+        return pack_batch_v2([ memoryview(frame)[PROVIDER_HEADER.size + 1:] ])
+    return pack_msg_v2(stream_id, frame, PROVIDER_HEADER.size)
+
+class WireLink(object):
+    """A websocket using version 2, which sends and receives version 1 messages like a
+    websocket of version 1. `multiplexed` links carry provider messages, the others the inner
+    messages of a single stream. Other attributes are those of the websocket."""
+    websocket: object
+    multiplexed: bool
+
+    def __init__(self, websocket, multiplexed: bool):
+        self.websocket = websocket
+        self.multiplexed = multiplexed
+
+    def __getattr__(self, name: str):
+        return getattr(self.websocket, name)
+
+    async def send(self, message: Union[bytes, List[bytes]]):
+        if self.multiplexed:
+            await self.websocket.send(pack_msg_v2_provider(message))
+        else:
+            await self.websocket.send(pack_msg_v2(None, message))
+
+    async def recv(self):
+        """Multiplexed links return the stream id and the inner message, see `unpack_msg_v2_provider`."""
+        message = await self.websocket.recv()
+        if self.multiplexed:
+            return unpack_msg_v2_provider(message)
+        return unpack_msg_v2(message, 0, len(message))
+
+def wire_link(websocket, multiplexed: bool):
+    """Wraps the websocket if it uses version 2 of the wire format."""
+    if negotiated_version(websocket.subprotocol) == PROTOCOL_V2:
+        return WireLink(websocket, multiplexed)
+    return websocket